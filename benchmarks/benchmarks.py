@@ -0,0 +1,215 @@
+"""benchmarks of the stages of bundle creation over synthetic CA hierarchies
+
+Run with asv (see `asv.conf.json`): every stage records its wall time (`time_run`), the peak RSS of the benchmark
+process (`peakmem_run`) and its throughput in certificates per second (`track_throughput`) for each corpus size and
+layout (see `corpus`). Results are saved as JSON in `.asv/results`, so regressions show up across commits.
+"""
+import os
+
+import io
+import shutil
+import tempfile
+import threading
+import time
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+from . import corpus
+
+sizes = [10, 1000, 10000, 100000]
+
+
+class _Stage(ABC):
+    """a stage of the pipeline, run over each corpus size and layout"""
+    params = (sizes, corpus.layouts)
+    param_names = ['certs', 'layout']
+    timeout = 1200
+    number = 1
+    repeat = (1, 5, 60.0)
+
+    def setup_cache(self):
+        directory = os.path.abspath('corpus')
+        for n in sizes:
+            corpus.generate(directory, n)
+        return directory
+    setup_cache.timeout = 3600
+
+    def setup(self, directory, n, layout):
+        self.n = n
+        self.directory = os.path.join(directory, str(n))
+        self.paths = corpus.path(self.directory, layout)
+        self.urls = [Path(path).as_uri() for path in self.paths]
+
+    @abstractmethod
+    def run(self):
+        """run the stage once over the corpus set up by `setup`"""
+
+    def time_run(self, directory, n, layout):
+        self.run()
+
+    def peakmem_run(self, directory, n, layout):
+        self.run()
+
+    def track_throughput(self, directory, n, layout):
+        start = time.perf_counter()
+        self.run()
+        return self.n / (time.perf_counter() - start)
+    track_throughput.unit = 'certs/s'
+
+
+def _fetch(urls):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from dodcerts.create import _open_resource
+
+    with ThreadPoolExecutor() as executor:
+        for _, fileobj in executor.map(_open_resource, urls):
+            fileobj.close()
+
+
+class Fetch(_Stage):
+    """retrieve the resources from `file://` urls into spooled temporary files"""
+
+    def run(self):
+        _fetch(self.urls)
+
+
+class FetchHTTP(_Stage):
+    """retrieve the resources from a local HTTP server into spooled temporary files"""
+
+    def setup(self, directory, n, layout):
+        import functools
+        from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+        super().setup(directory, n, layout)
+
+        class Handler(SimpleHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=self.directory))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        self.urls = [base + Path(path).relative_to(self.directory).as_posix() for path in self.paths]
+
+    def teardown(self, directory, n, layout):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run(self):
+        _fetch(self.urls)
+
+
+class Extract(_Stage):
+    """read the certificates from the retrieved resources, extracting them from archive"""
+
+    def setup(self, directory, n, layout):
+        from dodcerts.create import Resource
+
+        super().setup(directory, n, layout)
+        self.resources = []
+        for url, path in zip(self.urls, self.paths):
+            with open(path, 'rb') as f:
+                self.resources.append((Resource(url, None, None), f.read()))
+
+    def run(self):
+        from dodcerts.create import _iter_members
+
+        for resource, contents in self.resources:
+            for _ in _iter_members(resource, io.BytesIO(contents)):
+                pass
+
+
+class Parse(Extract):
+    """load the extracted certificates"""
+
+    def setup(self, directory, n, layout):
+        from dodcerts.create import _iter_members
+
+        super().setup(directory, n, layout)
+        self.members = [contents for resource, data in self.resources
+                        for _, contents in _iter_members(resource, io.BytesIO(data))]
+        del self.resources
+
+    def run(self):
+        from dodcerts.create import load_cert
+
+        for contents in self.members:
+            load_cert(contents)
+
+
+class Describe(Parse):
+    """describe the loaded certificates as bundle comments"""
+
+    def setup(self, directory, n, layout):
+        from dodcerts.create import load_cert
+
+        super().setup(directory, n, layout)
+        self.certs = [load_cert(contents) for contents in self.members]
+        del self.members
+
+    def run(self):
+        from dodcerts.create import describe_cert
+
+        for cert in self.certs:
+            describe_cert(cert)
+
+
+class Write(Describe):
+    """write the records of the described certificates to a bundle file"""
+
+    def setup(self, directory, n, layout):
+        from cryptography.hazmat.primitives.serialization import Encoding
+
+        from dodcerts.create import describe_cert
+
+        super().setup(directory, n, layout)
+        self.records = [describe_cert(cert).encode() + cert.public_bytes(Encoding.PEM) for cert in self.certs]
+        del self.certs
+
+    def run(self):
+        from dodcerts.create import BundleWriter
+
+        with tempfile.TemporaryFile() as f:
+            writer = BundleWriter(f)
+            writer.write_header()
+            for record in self.records:
+                writer.write_record(record)
+
+
+class CreatePemBundle(_Stage):
+    """create a bundle from the `file://` urls of the resources, end to end"""
+
+    def setup(self, directory, n, layout):
+        super().setup(directory, n, layout)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self, directory, n, layout):
+        shutil.rmtree(self.tmpdir)
+
+    def run(self):
+        from dodcerts.create import create_pem_bundle
+
+        # a new destination each run, so no records of a previous bundle are reused
+        destination = tempfile.mkdtemp(dir=self.tmpdir)
+        create_pem_bundle(os.path.join(destination, 'bundle.pem'), urls=self.urls, set_env_var=False)
+
+
+class DownloadResources(CreatePemBundle):
+    """write the certificates of the resources to a directory"""
+
+    def run(self):
+        from dodcerts.create import download_resources
+
+        download_resources(self.urls, tempfile.mkdtemp(dir=self.tmpdir))
+
+
+class IterCertificates(_Stage):
+    """parse the certificates of the resources without writing a bundle"""
+
+    def run(self):
+        from dodcerts.create import iter_certificates
+
+        for _ in iter_certificates(urls=self.urls):
+            pass
@@ -0,0 +1,124 @@
+"""synthetic CA hierarchies for the benchmarks, generated offline with `cryptography`
+
+A corpus of `n` certificates holds one root, one intermediate per 100 certificates and leaves issued by the
+intermediates in turn, laid out as:
+
+* `der/`: one DER encoded `.cer` file per certificate
+* `pem/`: one PEM encoded `.pem` file per certificate
+* `certs.zip`: the DER files as members of a zip archive
+* `certs.tar.gz`: the PEM files as members of a gzipped tar archive
+"""
+import os
+
+import tarfile
+import zipfile
+
+from datetime import datetime
+
+layouts = ['der', 'pem', 'zip', 'tar']
+
+
+def _name(common_name):
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+
+    return x509.Name([
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, 'U.S. Government'),
+        x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, 'Benchmark'),
+        x509.NameAttribute(NameOID.COMMON_NAME, common_name),
+    ])
+
+
+def _issue(name, key, issuer_name, issuer_key, ca):
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes
+
+    return x509.CertificateBuilder().subject_name(name).issuer_name(issuer_name).public_key(
+        key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(
+        datetime(2020, 1, 1)).not_valid_after(datetime(2040, 1, 1)).add_extension(
+        x509.BasicConstraints(ca=ca, path_length=None), critical=True).add_extension(
+        x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False).add_extension(
+        x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()), critical=False).sign(
+        issuer_key, hashes.SHA256())
+
+
+def hierarchy(n):
+    """issue a synthetic CA hierarchy
+
+    Args:
+        n(int, required):
+            number of certificates
+
+    Yields:
+        each certificate as a `cryptography.x509.Certificate`, issuers first
+    """
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    root_key = ec.generate_private_key(ec.SECP256R1())
+    root_name = _name('Benchmark Root')
+    yield _issue(root_name, root_key, root_name, root_key, True)
+
+    intermediates = []
+    for i in range(min(n - 1, max(1, n // 100))):
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = _name('Benchmark Intermediate {}'.format(i))
+        intermediates.append((name, key))
+        yield _issue(name, key, root_name, root_key, True)
+
+    # leaves share a key, their keys are irrelevant to the pipeline and generating them dominates otherwise
+    leaf_key = ec.generate_private_key(ec.SECP256R1())
+    for i in range(n - 1 - len(intermediates)):
+        issuer_name, issuer_key = intermediates[i % len(intermediates)]
+        yield _issue(_name('leaf{}.benchmark.example'.format(i)), leaf_key, issuer_name, issuer_key, False)
+
+
+def generate(directory, n):
+    """write a corpus of `n` certificates in every layout, unless it already exists
+
+    Args:
+        directory(str, required):
+            location of the corpus; see `path`
+        n(int, required):
+            number of certificates
+
+    Returns:
+        the location of the corpus
+    """
+    from cryptography.hazmat.primitives.serialization import Encoding
+
+    directory = os.path.join(directory, str(n))
+    if os.path.exists(os.path.join(directory, 'certs.tar.gz')):
+        return directory
+    os.makedirs(os.path.join(directory, 'der'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'pem'), exist_ok=True)
+    with zipfile.ZipFile(os.path.join(directory, 'certs.zip'), 'w', zipfile.ZIP_DEFLATED) as z:
+        for i, cert in enumerate(hierarchy(n)):
+            name = 'cert{:06d}'.format(i)
+            der = cert.public_bytes(Encoding.DER)
+            with open(os.path.join(directory, 'der', name + '.cer'), 'wb') as f:
+                f.write(der)
+            with open(os.path.join(directory, 'pem', name + '.pem'), 'wb') as f:
+                f.write(cert.public_bytes(Encoding.PEM))
+            z.writestr('certs/' + name + '.cer', der)
+    with tarfile.open(os.path.join(directory, 'certs.tar.gz'), 'w:gz') as tar:
+        tar.add(os.path.join(directory, 'pem'), arcname='certs')
+    return directory
+
+
+def path(directory, layout):
+    """get the files or archive of a layout of a corpus
+
+    Args:
+        directory(str, required):
+            location of the corpus, as returned by `generate`
+        layout(str, required):
+            one of `layouts`
+
+    Returns:
+        list of pathnames
+    """
+    if layout == 'zip':
+        return [os.path.join(directory, 'certs.zip')]
+    if layout == 'tar':
+        return [os.path.join(directory, 'certs.tar.gz')]
+    return [os.path.join(directory, layout, file) for file in sorted(os.listdir(os.path.join(directory, layout)))]
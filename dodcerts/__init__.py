@@ -1,5 +1,11 @@
-from . import _version
-__version__ = _version.get_versions()['version']
-del _version.get_versions
+from .bundle import cadata, ssl_context, where, where_dir  # noqa: F401
 
-from .bundle import where
+
+def __getattr__(name):
+    # resolve the version lazily; in a source checkout it may require running git
+    if name == '__version__':
+        from ._version import get_versions
+        global __version__
+        __version__ = get_versions()['version']
+        return __version__
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -0,0 +1,134 @@
+"""crash-safe publication of files
+
+Files are written to a temporary file in the directory of their destination, flushed to disk and
+moved into place with `os.replace`, so readers see either the previous or the new file in full,
+never a partial one, and a crash leaves the previous file intact. Readers need no locks.
+"""
+import os
+
+import tempfile
+
+from contextlib import contextmanager
+
+
+def _umask():
+    """get the file mode creation mask of the process"""
+    # read without changing it where possible, as the mask is shared by every thread of the process
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except OSError:
+        pass
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def stage(path, mode='wb'):
+    """open a temporary file in the directory of `path`, with the permissions of the file at `path`
+
+    A new file gets the permissions `open` would have created it with, as restricted by the umask.
+
+    Args:
+        path(str, required):
+            pathname the file is to be published to
+        mode(str, optional, default='wb'):
+            mode in which the file is opened
+
+    Returns:
+        the open file object; its `name` is the pathname of the temporary file
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    f = tempfile.NamedTemporaryFile(mode, dir=directory, prefix='.' + name + '.', suffix='.tmp',
+                                    delete=False)
+    try:
+        permissions = os.stat(path).st_mode & 0o777
+    except OSError:
+        permissions = 0o666 & ~_umask()
+    os.chmod(f.name, permissions)
+    return f
+
+
+def _fsync_directory(directory):
+    # make the rename itself durable; directories cannot be opened on Windows, where renames are
+    # journaled
+    if os.name != 'posix':
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def publish(f, path, fsync=True):
+    """flush and close a staged file, and move it into place
+
+    Args:
+        f(file-like, required):
+            the staged file; see `stage`
+        path(str, required):
+            pathname the file is published to
+        fsync(bool, optional, default=True):
+            determines whether the file and its directory are flushed to disk
+    """
+    f.flush()
+    if fsync:
+        os.fsync(f.fileno())
+    f.close()
+    os.replace(f.name, path)
+    if fsync:
+        _fsync_directory(os.path.dirname(os.path.abspath(path)))
+
+
+def discard(f):
+    """close a staged file and remove it, unless it was published"""
+    f.close()
+    if os.path.exists(f.name):
+        os.remove(f.name)
+
+
+def link(target, path, fsync=True):
+    """atomically point a symbolic link at `path` to `target`, replacing any file at `path`
+
+    Args:
+        target(str, required):
+            pathname of the file linked to, in the directory of `path`; the link is relative
+        path(str, required):
+            pathname of the link
+        fsync(bool, optional, default=True):
+            determines whether the directory is flushed to disk
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    staging = os.path.join(directory, '.{}.{}.tmp'.format(name, os.getpid()))
+    if os.path.lexists(staging):
+        os.remove(staging)
+    os.symlink(os.path.basename(target), staging)
+    os.replace(staging, path)
+    if fsync:
+        _fsync_directory(directory)
+
+
+@contextmanager
+def atomic_write(path, mode='wb', fsync=True):
+    """write a file through a staged temporary file that is published once the block completes
+
+    Args:
+        path(str, required):
+            pathname the file is published to
+        mode(str, optional, default='wb'):
+            mode in which the staged file is opened
+        fsync(bool, optional, default=True):
+            passed to `publish`
+
+    Yields:
+        the staged file; it is discarded if the block raises
+    """
+    f = stage(path, mode)
+    try:
+        yield f
+        publish(f, path, fsync=fsync)
+    finally:
+        discard(f)
@@ -1,6 +1,17 @@
 import os
 
-from importlib.resources import files
+# the bundle is located relative to this module rather than through importlib.resources to keep
+# `where` import-free
+_bundle_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dod-ca-certs.pem')
+_capath_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dod-ca-certs')
+
+# caches keyed by bundle path (and options) -> ((bundle size, bundle mtime), value)
+_cadata = {}
+_contexts = {}
+_locks = {}
+
+_pem_begin = b'-----BEGIN CERTIFICATE-----'
+_pem_end = b'-----END CERTIFICATE-----'
 
 
 def where():
@@ -9,4 +20,118 @@ def where():
     Returns:
         the filepath of the DoD Certificate chain as a PEM bundle
     """
-    return os.getenv('DOD_CA_CERTS_PEM_PATH', files('dodcerts') / 'dod-ca-certs.pem')
+    return os.getenv('DOD_CA_CERTS_PEM_PATH', _bundle_path)
+
+
+def where_dir():
+    """get the path of the DoD Certificate chain as an OpenSSL hashed certificate directory
+
+    The directory holds one PEM file per certificate named by subject hash (the `openssl rehash`
+    layout), suitable as the `capath` of `ssl.SSLContext.load_verify_locations`, so that OpenSSL
+    only loads the certificates a handshake needs.
+
+    Returns:
+        the path of the DoD Certificate chain as a hashed certificate directory
+    """
+    return os.getenv('DOD_CA_CERTS_DIR_PATH', _capath_path)
+
+
+def _lock(name):
+    import threading
+
+    # dict.setdefault is atomic, so concurrent callers always share the same lock
+    return _locks.setdefault(name, threading.Lock())
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _read_cadata(path, form):
+    import base64
+
+    with open(path, 'rb') as f:
+        contents = f.read()
+    blocks = []
+    start = contents.find(_pem_begin)
+    while start > -1:
+        end = contents.index(_pem_end, start) + len(_pem_end)
+        blocks.append(contents[start:end])
+        start = contents.find(_pem_begin, end)
+    if form == 'pem':
+        return '\n'.join([block.decode('ascii') for block in blocks]) + '\n'
+    return b''.join([base64.b64decode(b''.join(block.splitlines()[1:-1])) for block in blocks])
+
+
+def cadata(form='der', revalidate=True):
+    """get the certificates of the DoD Certificate chain as a single in-memory blob
+
+    The blob is read from the bundle (see `where`) once and then held in memory; it is read again
+    only when the bundle path, size, or modification time changes. The result may be passed directly
+    as `cadata` to `ssl.SSLContext.load_verify_locations`.
+
+    Args:
+        form(str, optional, default='der'):
+            'der' for concatenated DER encoded certificates as bytes, or 'pem' for concatenated PEM
+            encoded certificates, without comments, as a string
+        revalidate(bool, optional, default=True):
+            determines whether the bundle is checked (stat) for changes; if False, a blob already
+            held for the bundle path is returned without touching the filesystem
+
+    Returns:
+        the certificates as bytes ('der') or string ('pem')
+    """
+    assert form in ['der', 'pem']
+    path = os.fspath(where())
+    key = (path, form)
+
+    cached = _cadata.get(key)
+    if cached is not None and not revalidate:
+        return cached[1]
+    stamp = _stamp(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    with _lock('cadata'):
+        # another thread may have read the bundle while this one waited
+        cached = _cadata.get(key)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, _read_cadata(path, form))
+            _cadata[key] = cached
+    return cached[1]
+
+
+def ssl_context(purpose=None):
+    """get an SSL context trusting the DoD Certificate chain
+
+    The context is built once per bundle path (see `where`), bundle size and modification time, and
+    `purpose`, and is then shared; it is rebuilt automatically when the bundle file or
+    `DOD_CA_CERTS_PEM_PATH` changes. The returned context is shared between callers and threads and
+    should not be modified.
+
+    Args:
+        purpose(ssl.Purpose, optional, default=None):
+            passed to `ssl.create_default_context`; defaulted to `ssl.Purpose.SERVER_AUTH`
+
+    Returns:
+        an `ssl.SSLContext` trusting the certificates of the bundle
+    """
+    import ssl
+
+    if purpose is None:
+        purpose = ssl.Purpose.SERVER_AUTH
+    path = os.fspath(where())
+    key = (path, purpose)
+    stamp = _stamp(path)
+
+    cached = _contexts.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    with _lock('ssl_context'):
+        # another thread may have built the context while this one waited
+        cached = _contexts.get(key)
+        if cached is None or cached[0] != stamp:
+            # trust is loaded from the in-memory certificates, shared with `cadata`
+            cached = (stamp, ssl.create_default_context(purpose, cadata=cadata('der')))
+            _contexts[key] = cached
+    return cached[1]
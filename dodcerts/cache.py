@@ -0,0 +1,162 @@
+import os
+
+import hashlib
+import json
+import tempfile
+
+
+class DownloadCache(object):
+    """persistent store of downloaded resources and the HTTP validators (ETag/Last-Modified)
+    returned with them
+
+    Each url is keyed by the SHA-256 of the url itself; the payload and its metadata are stored
+    side-by-side as `<key>.payload` and `<key>.json` within `cache_dir`.
+
+    Args:
+        cache_dir(str, required):
+            directory in which cached resources are stored; created if it does not exist
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _key(self, url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def payload_path(self, url):
+        """get the path of the cached payload for `url`"""
+        return os.path.join(self.cache_dir, self._key(url) + '.payload')
+
+    def metadata_path(self, url):
+        """get the path of the cached metadata for `url`"""
+        return os.path.join(self.cache_dir, self._key(url) + '.json')
+
+    def load(self, url):
+        """get the cached metadata for `url`
+
+        Args:
+            url(str, required):
+                url of the cached resource
+
+        Returns:
+            dictionary of metadata (`url`, `etag`, `last_modified`, `size`, `sha256`) or None if
+            `url` is not cached
+        """
+        if not os.path.isfile(self.payload_path(url)):
+            return None
+        try:
+            with open(self.metadata_path(url), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def conditional_headers(self, url):
+        """get the request headers used to revalidate the cached copy of `url`
+
+        Args:
+            url(str, required):
+                url of the resource
+
+        Returns:
+            dictionary of `If-None-Match`/`If-Modified-Since` headers; empty if `url` is not cached
+        """
+        headers = {}
+        metadata = self.load(url)
+        if metadata is not None:
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+        return headers
+
+    def open_payload(self):
+        """open a temporary file, within `cache_dir`, for writing a new payload; see `store`"""
+        return tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp', delete=False)
+
+    def store(self, url, payload, metadata):
+        """publish a payload written to a file returned by `open_payload` along with its metadata
+
+        Args:
+            url(str, required):
+                url of the resource
+            payload(str, required):
+                path of the temporary payload file
+            metadata(dict, required):
+                metadata of the resource; see `load`
+        """
+        os.replace(payload, self.payload_path(url))
+        with tempfile.NamedTemporaryFile('w', dir=self.cache_dir, suffix='.tmp', delete=False) as f:
+            json.dump(metadata, f)
+        os.replace(f.name, self.metadata_path(url))
+
+
+class ParseCache(object):
+    """content-addressed store of rendered certificate records backed by SQLite
+
+    Records are keyed by the SHA-256 of the raw (DER or PEM) certificate file bytes so that
+    unchanged certificates are never parsed twice, regardless of their file name or location. Each
+    record is stored with the info the bundle is indexed and ordered by (see
+    `dodcerts.create.record_info`), so known certificates are not parsed for it either.
+
+    Args:
+        cache_dir(str, required):
+            directory in which the cache database (`parsed.sqlite`) is stored; created if it does
+            not exist
+    """
+    filename = 'parsed.sqlite'
+
+    def __init__(self, cache_dir):
+        import sqlite3
+
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.path = os.path.join(self.cache_dir, self.filename)
+        self._connection = sqlite3.connect(self.path)
+        with self._connection:
+            # records of earlier versions were stored without their info
+            self._connection.execute('DROP TABLE IF EXISTS records')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS certificates '
+                                     '(digest TEXT PRIMARY KEY, record BLOB NOT NULL, '
+                                     'info TEXT NOT NULL)')
+
+    @staticmethod
+    def digest(contents):
+        """get the key of raw certificate file bytes"""
+        return hashlib.sha256(contents).hexdigest()
+
+    def get(self, digest):
+        """look up the record of a key
+
+        Args:
+            digest(str, required):
+                the key; see `digest`
+
+        Returns:
+            tuple of the record as bytes and its info as a dictionary, or None if the key is not in
+            the cache
+        """
+        row = self._connection.execute('SELECT record, info FROM certificates WHERE digest = ?',
+                                       (digest, )).fetchone()
+        return (row[0], json.loads(row[1])) if row is not None else None
+
+    def put_many(self, records):
+        """store several records at once
+
+        Args:
+            records(iterable, required):
+                iterable of (key, record, info) tuples
+        """
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO certificates VALUES (?, ?, ?)',
+                                         [(key, record, json.dumps(info))
+                                          for key, record, info in records])
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,145 @@
+import os
+
+import hashlib
+import re
+
+from . import der as _der
+from .atomic import atomic_write
+from .der import pem_to_der
+
+# file names of an OpenSSL hashed certificate directory: <subject hash>.<n>
+_capath_name = re.compile(r'^[0-9a-f]{8}\.[0-9]+$')
+
+# string types OpenSSL canonicalizes (ASN1_MASK_CANON) and the codecs to decode them
+_canon_codecs = {
+    0x0c: 'utf-8',  # UTF8String
+    0x13: 'latin-1',  # PrintableString
+    0x14: 'latin-1',  # T61String
+    0x16: 'latin-1',  # IA5String
+    0x1a: 'latin-1',  # VisibleString
+    0x1c: 'utf-32-be',  # UniversalString
+    0x1e: 'utf-16-be',  # BMPString
+}
+
+
+def _canonical_string(value):
+    """canonicalize a string value as OpenSSL does: trim and collapse whitespace, lower case ASCII
+    letters"""
+    encoded = re.sub(rb'[ \t\n\v\f\r]+', b' ', value.encode('utf-8')).strip(b' ')
+    return bytes([c + 32 if 0x41 <= c <= 0x5a else c for c in encoded])
+
+
+def name_hash(data, start, end):
+    """compute the OpenSSL hash of a DER encoded name; see `subject_hash`
+
+    Args:
+        data(bytes, required):
+            bytes holding the name
+        start(int, required):
+            offset of the contents of the name (the SEQUENCE of relative distinguished names)
+        end(int, required):
+            offset of the end of the name
+
+    Returns:
+        the hash as 8 lower case hexadecimal characters
+    """
+    canon = b''
+    for _, rdn_start, _, rdn_end in _der.children(data, start, end):
+        attributes = []
+        for _, atv_start, _, atv_end in _der.children(data, rdn_start, rdn_end):
+            (_, _, oid_elem, oid_end), (tag, value_start, value_elem, value_end) = \
+                _der.children(data, atv_start, atv_end)
+            if tag in _canon_codecs:
+                value = data[value_start:value_end].decode(_canon_codecs[tag], errors='replace')
+                value = _der.encode(0x0c, _canonical_string(value))
+            else:
+                value = data[value_elem:value_end]
+            attributes.append(_der.encode(0x30, data[oid_elem:oid_end] + value))
+        # DER orders the members of a SET by their encoding
+        canon += _der.encode(0x31, b''.join(sorted(attributes)))
+    digest = hashlib.sha1(canon).digest()
+    return '{:08x}'.format(int.from_bytes(digest[:4], 'little'))
+
+
+def subject_hash(der):
+    """compute the OpenSSL subject hash of a certificate (as `openssl x509 -subject_hash`)
+
+    The hash is the first four bytes, read little-endian, of the SHA-1 of the subject's canonical
+    encoding: each relative distinguished name is DER encoded as a SET of its attributes with string
+    values converted to lower case UTF8String with whitespace trimmed and collapsed. The certificate
+    is walked directly so that certificates `cryptography` refuses to load are hashed as OpenSSL
+    would.
+
+    Args:
+        der(bytes, required):
+            the DER encoded certificate
+
+    Returns:
+        the hash as 8 lower case hexadecimal characters
+    """
+    return name_hash(der, *_der.tbs_fields(der)['subject'])
+
+
+def issuer_hash(der):
+    """compute the OpenSSL issuer hash of a certificate (as `openssl x509 -issuer_hash`); see
+    `subject_hash`
+
+    Args:
+        der(bytes, required):
+            the DER encoded certificate
+
+    Returns:
+        the hash as 8 lower case hexadecimal characters
+    """
+    return name_hash(der, *_der.tbs_fields(der)['issuer'])
+
+
+def write_capath(directory, pems):
+    """write certificates as an OpenSSL hashed certificate directory (the `openssl rehash` or
+    `c_rehash` layout)
+
+    Each certificate is written in PEM format to `<subject hash>.<n>`, numbered in the order of
+    `pems` among the certificates sharing a subject hash. The directory is updated incrementally:
+    files whose contents are unchanged are left untouched and stale hashed files are removed; any
+    other files are preserved.
+
+    Args:
+        directory(str, required):
+            the directory to write; created if it does not exist
+        pems(iterable, required):
+            iterable of PEM encoded certificates as bytes, any text around the PEM block is dropped
+
+    Returns:
+        dictionary of the counts of `written`, `unchanged` and `removed` files
+    """
+    os.makedirs(directory, exist_ok=True)
+    wanted = {}
+    counts = {}
+    for pem in pems:
+        start = pem.index(b'-----BEGIN CERTIFICATE-----')
+        end = pem.index(b'-----END CERTIFICATE-----', start) + len(b'-----END CERTIFICATE-----')
+        h = subject_hash(pem_to_der(pem))
+        n = counts.get(h, 0)
+        counts[h] = n + 1
+        wanted['{}.{}'.format(h, n)] = pem[start:end] + b'\n'
+
+    stats = {'written': 0, 'unchanged': 0, 'removed': 0}
+    for name in os.listdir(directory):
+        if _capath_name.match(name) and name not in wanted:
+            os.remove(os.path.join(directory, name))
+            stats['removed'] += 1
+    for name, pem in wanted.items():
+        fpath = os.path.join(directory, name)
+        try:
+            with open(fpath, 'rb') as f:
+                if f.read() == pem:
+                    stats['unchanged'] += 1
+                    continue
+        except OSError:
+            pass
+        # replaced atomically, OpenSSL may be reading the directory; durability is left to the
+        # bundle
+        with atomic_write(fpath, fsync=False) as f:
+            f.write(pem)
+        stats['written'] += 1
+    return stats
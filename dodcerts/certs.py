@@ -0,0 +1,59 @@
+"""loading certificates and reading their fields
+
+Shared by the bundle builder (`dodcerts.create`), its index, the verifier and the CRL reader, so
+that none of them depends on another to read a certificate.
+"""
+
+# extensions of the certificate and CRL files read from resources
+cert_exts = ['cer', 'crt', 'pem']
+crl_exts = ['crl']
+
+
+def load_cert(contents):
+    """load a certificate from DER, falling back to PEM, encoded bytes
+
+    Args:
+        contents(bytes, required):
+            the encoded certificate
+
+    Returns:
+        the certificate as a `cryptography.x509.Certificate`
+
+    Raises:
+        ValueError: if `contents` is not a DER or PEM encoded certificate
+    """
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.x509 import load_der_x509_certificate, load_pem_x509_certificate
+
+    try:
+        return load_der_x509_certificate(contents, backend=default_backend())
+    except ValueError:
+        return load_pem_x509_certificate(contents, backend=default_backend())
+
+
+def key_identifiers(cert):
+    """get the key identifiers of a certificate
+
+    Args:
+        cert(cryptography.x509.Certificate, required):
+            the certificate
+
+    Returns:
+        tuple of the subject key identifier and the key identifier of the authority key identifier
+        extension, each as bytes or None if the certificate does not have it (or its extensions
+        cannot be read)
+    """
+    from cryptography import x509
+
+    try:
+        extensions = cert.extensions
+    except ValueError:
+        return None, None
+    identifiers = []
+    for cls, attribute in [(x509.SubjectKeyIdentifier, 'digest'),
+                           (x509.AuthorityKeyIdentifier, 'key_identifier')]:
+        try:
+            identifiers.append(getattr(extensions.get_extension_for_class(cls).value, attribute))
+        except x509.ExtensionNotFound:
+            identifiers.append(None)
+    return tuple(identifiers)
@@ -1,22 +1,26 @@
 import sys
 
-import argparse
-from argparse import _HelpAction
+from . import where
 
-from . import __version__, where
 
 def parse_args(args):
     '''Parse command line arguments
-    
+
     Args:
         args(iterable):
-            passed to argparser 
+            passed to argparser
 
     Returns:
         argparser parsing results
     '''
+    import argparse
+    from argparse import _HelpAction
+
+    from . import __version__
+
     p = argparse.ArgumentParser(
-        description='dodcerts is a tool that provides the DoD Certificate chain as a PEM bundle. Returns path to file.',
+        description='dodcerts is a tool that provides the DoD Certificate chain as a PEM bundle. '
+                    'Returns path to file.',
         add_help=False,
     )
     p.add_argument(
@@ -30,7 +34,224 @@ def parse_args(args):
         version='dodcerts %s' % __version__,
         help="Show the dodcerts version number and exit",
     )
-    return p.parse_args(args)
+    commands = p.add_subparsers(dest='command', metavar='{create,verify,update}')
+
+    p_create = commands.add_parser(
+        'create',
+        description='Create a PEM bundle from the specified resources. Returns path to file.',
+        help="Create a PEM bundle from the specified resources.",
+    )
+    p_create.add_argument(
+        'destination',
+        help="Pathname for the created PEM bundle.",
+    )
+    p_create.add_argument(
+        '-u', '--url',
+        action='append',
+        dest='urls',
+        help="URL of a resource (certificate or archive) to bundle; may be repeated.",
+    )
+    p_create.add_argument(
+        '-r', '--resource-dir',
+        help="Directory of resources to bundle; URL resources are downloaded to it if specified.",
+    )
+    p_create.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=1,
+        help="Number of processes parsing certificates; 0 uses the process pool default of one "
+             "process per CPU (default: 1).",
+    )
+    p_create.add_argument(
+        '--max-workers',
+        type=int,
+        help="Maximum number of resources downloaded concurrently.",
+    )
+    p_create.add_argument(
+        '--cache-dir',
+        help="Directory of a persistent download cache.",
+    )
+    p_create.add_argument(
+        '--capath',
+        help="Also write the certificates to this OpenSSL hashed certificate directory.",
+    )
+    p_create.add_argument(
+        '--crl-dir',
+        help="Index the revoked serials of CRL resources that verify against the bundle into this "
+             "directory.",
+    )
+    p_create.add_argument(
+        '--reproducible',
+        action='store_true',
+        help="Fix the creation time of the bundle to SOURCE_DATE_EPOCH (or the epoch if unset).",
+    )
+    p_create.add_argument(
+        '--versions',
+        type=int,
+        help="Publish the bundle to a versioned file behind a symbolic link, keeping this many "
+             "versions.",
+    )
+    p_create.add_argument(
+        '--metrics',
+        help="Export per-stage metrics of the run to this file in Prometheus textfile format.",
+    )
+    p_create.add_argument(
+        '--keep-duplicates',
+        action='store_true',
+        help="Keep certificates with the same fingerprint as one already bundled.",
+    )
+
+    p_verify = commands.add_parser(
+        'verify',
+        description='Validate the chains of certificates up to the roots of the PEM bundle. Prints '
+                    'one result per certificate, exits with 1 if any is invalid.',
+        help="Validate certificate chains against the PEM bundle.",
+    )
+    p_verify.add_argument(
+        'paths',
+        nargs='+',
+        metavar='path',
+        help="Certificate (DER or PEM) or directory of certificates to validate.",
+    )
+    p_verify.add_argument(
+        '-b', '--bundle',
+        help="PEM bundle of trusted certificates (default: the dodcerts bundle).",
+    )
+    p_verify.add_argument(
+        '-w', '--workers',
+        type=int,
+        help="Number of threads validating certificates.",
+    )
+    p_verify.add_argument(
+        '--crl-dir',
+        help="Revoked-serial index (see create --crl-dir) against which certificates are checked; "
+             "certificates whose issuer has no current CRL in it are invalid.",
+    )
+
+    p_update = commands.add_parser(
+        'update',
+        description='Rebuild a PEM bundle only if the certificates of its resources changed since '
+                    'the bundle was built from them. Prints the outcome of the check of each '
+                    'resource, exits with 1 if the bundle is unchanged.',
+        help="Rebuild a PEM bundle if its resources changed.",
+    )
+    p_update.add_argument(
+        'destination',
+        help="Pathname of the PEM bundle.",
+    )
+    p_update.add_argument(
+        '-u', '--url',
+        action='append',
+        dest='urls',
+        required=True,
+        help="URL of a resource (certificate or archive) of the bundle; may be repeated.",
+    )
+    p_update.add_argument(
+        '--cache-dir',
+        required=True,
+        help="Directory of the persistent download cache the bundle was built with.",
+    )
+    p_update.add_argument(
+        '--check',
+        action='store_true',
+        help="Only check the resources; exits with 0 if the bundle needs to be rebuilt.",
+    )
+    p_update.add_argument(
+        '--capath',
+        help="Also write the certificates to this OpenSSL hashed certificate directory.",
+    )
+    p_update.add_argument(
+        '--max-workers',
+        type=int,
+        help="Maximum number of resources checked and downloaded concurrently.",
+    )
+    parsed = p.parse_args(args)
+    if parsed.command == 'create' and parsed.urls is None and parsed.resource_dir is None:
+        p_create.error('at least one of --url or --resource-dir is required')
+    if parsed.command == 'create' and parsed.workers < 0:
+        p_create.error('argument -w/--workers: must be 0 (the default of one process per CPU) or '
+                       'more')
+    return parsed
+
+
+def create(args):
+    '''Create a PEM bundle from the parsed command line arguments
+
+    Args:
+        args(argparse.Namespace):
+            parsed `create` command line arguments
+
+    Returns:
+        the filepath of the created PEM bundle
+    '''
+    from .create import create_pem_bundle
+
+    metrics = None
+    if args.metrics is not None:
+        from .metrics import Metrics
+        metrics = Metrics()
+    destination = create_pem_bundle(
+        destination=args.destination,
+        urls=args.urls,
+        resource_dir=args.resource_dir,
+        set_env_var=False,
+        max_workers=args.max_workers,
+        cache_dir=args.cache_dir,
+        workers=args.workers if args.workers > 0 else None,  # 0: one process per CPU
+        dedupe=not args.keep_duplicates,
+        capath=args.capath,
+        crl_dir=args.crl_dir,
+        observer=metrics,
+        versions=args.versions,
+        reproducible=args.reproducible,
+    )
+    if metrics is not None:
+        from .metrics import write_textfile
+        write_textfile(args.metrics, metrics)
+    return destination
+
+
+def verify(args):
+    '''Validate certificate chains from the parsed command line arguments, printing one result per
+    certificate
+
+    Args:
+        args(argparse.Namespace):
+            parsed `verify` command line arguments
+
+    Returns:
+        whether all of the certificates are valid
+    '''
+    from .verify import verify_certificates
+
+    valid = True
+    for result in verify_certificates(args.paths, bundle=args.bundle, workers=args.workers,
+                                      crl_dir=args.crl_dir):
+        print('{}: {}'.format(result.source, 'OK' if result.valid else result.error))
+        valid = valid and result.valid
+    return valid
+
+
+def update(args):
+    '''Check the resources of a PEM bundle, and rebuild it if they changed, from the parsed command
+    line arguments, printing one result per resource
+
+    Args:
+        args(argparse.Namespace):
+            parsed `update` command line arguments
+
+    Returns:
+        whether the bundle was updated (or, with `--check`, needs to be)
+    '''
+    from .update import update_bundle
+
+    updated, checks = update_bundle(args.destination, args.urls, args.cache_dir, check=args.check,
+                                    capath=args.capath, max_workers=args.max_workers)
+    for check in checks:
+        print('{}: {} ({})'.format(check.url, 'changed' if check.changed else 'unchanged',
+                                   check.reason))
+    return updated
+
 
 def cli():
     '''Command line interface for package
@@ -38,5 +259,19 @@ def cli():
     Returns:
         the filepath of the DoD Certificate chain as a PEM bundle
     '''
-    parse_args(sys.argv[1:])
-    print(str(where()))
+    # fast path: without arguments only the bundle is located, argparse and the version are never
+    # loaded
+    if not sys.argv[1:]:
+        print(str(where()))
+        return
+    args = parse_args(sys.argv[1:])
+    if args.command == 'create':
+        print(create(args))
+    elif args.command == 'verify':
+        if not verify(args):
+            sys.exit(1)
+    elif args.command == 'update':
+        if not update(args):
+            sys.exit(1)
+    else:
+        print(str(where()))
@@ -1,28 +1,59 @@
 import os
 import sys
 
+import hashlib
+import json
 import logging
-import tarfile
+import shutil
 import tempfile
-import zipfile
+import time
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.serialization import Encoding
-from cryptography.x509 import Certificate, load_der_x509_certificate, load_pem_x509_certificate
-from cryptography.x509.name import NameOID
-from datetime import datetime
-from urllib.request import urlopen
+from collections import deque, namedtuple
+from datetime import datetime, timezone
 
+from .cache import DownloadCache, ParseCache
+from .atomic import atomic_write, discard, link, publish, stage
+from .capath import issuer_hash, subject_hash, write_capath
+from .certs import cert_exts, crl_exts, key_identifiers, load_cert
+from .crl import ingest_crl, load_issuers
+from .der import pem_to_der
+from .index import digest_prefix, index_path, index_row, write_index
+from .metrics import observe
+
+# heavy dependencies (cryptography, archive and network modules, executors) are imported by the
+# functions that use them so that importing this module stays cheap
 log = logging.getLogger('dod-certs')
-ch = logging.StreamHandler(sys.stdout)
-ch.setLevel(logging.INFO)
-# create formatter and add it to the handlers
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-ch.setFormatter(formatter)
-# add the handlers to the logger
-log.addHandler(ch)
 
-cert_exts = ['cer', 'crt', 'pem']
+
+def _init_logging():
+    """attach the stdout handler to the `dod-certs` logger, once, on first use of the module's entry
+    points"""
+    if getattr(log, '_dodcerts_handler', None) is not None:
+        return
+    ch = logging.StreamHandler(sys.stdout)
+    ch.setLevel(logging.INFO)
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    # add the handlers to the logger
+    log.addHandler(ch)
+    log._dodcerts_handler = ch
+
+
+# default file name ordering rules of `classify_files`: CAs first then Roots
+cert_order = ['ca', 'root']
+default_buffer_size = 64 * 1024
+default_spool_size = 16 * 1024 * 1024
+default_chunksize = 64
+
+# record of a retrieved resource; `size` and `sha256` are computed while the resource streams,
+# `etag` and `last_modified` are the HTTP validators it was retrieved with (None if unknown)
+Resource = namedtuple('Resource', ['url', 'size', 'sha256', 'etag', 'last_modified'])
+Resource.__new__.__defaults__ = (None, None)
+
+# record of a parsed certificate, see `iter_certificates`
+Certificate = namedtuple('Certificate',
+                         ['fingerprint', 'subject', 'issuer', 'not_after', 'pem', 'source'])
 
 
 def describe_cert(cert):
@@ -35,6 +66,9 @@ def describe_cert(cert):
     Returns:
         certification information as a string
     """
+    from cryptography.x509 import Certificate
+    from cryptography.x509.name import NameOID
+
     assert isinstance(cert, Certificate)
     info = (
         "\n"
@@ -45,26 +79,694 @@ def describe_cert(cert):
     ).format(
         cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value,
         *[cert.issuer.get_attributes_for_oid(oid)[0].value
-          for oid in [NameOID.ORGANIZATION_NAME, NameOID.ORGANIZATIONAL_UNIT_NAME, NameOID.COMMON_NAME]],
+          for oid in [NameOID.ORGANIZATION_NAME, NameOID.ORGANIZATIONAL_UNIT_NAME,
+                      NameOID.COMMON_NAME]],
         cert.not_valid_after_utc,
     )
 
     return info
 
 
-def download_resources(urls, destination=None):
+def render_cert(contents):
+    """load a certificate and render it as a bundle record
+
+    Args:
+        contents(bytes, required):
+            the DER or PEM encoded certificate
+
+    Returns:
+        the certificate's info and public key in PEM format as bytes, or None if the certificate
+        cannot be loaded
+    """
+    return _render(contents)[0]
+
+
+def record_info(cert):
+    """get the fields of a certificate by which its record is indexed and ordered within a bundle
+
+    The info is kept alongside the record (see `dodcerts.cache.ParseCache` and `_write_manifest`),
+    so that known records are indexed and ordered without parsing their certificates again.
+
+    Args:
+        cert(cryptography.x509.Certificate, required):
+            the certificate
+
+    Returns:
+        JSON serializable dictionary of the `row`, the first four fields of the certificate's index
+        row (see `dodcerts.index.index_row`), and its chain `node` (see `chain_node`), with bytes
+        hex encoded
+    """
+    fingerprint, subject, ski, expires = index_row(cert, 0, 0)[:4]
+    node = chain_node(cert)
+    return {
+        'row': [fingerprint.hex(), subject.hex(), ski.hex(), expires],
+        'node': [key.hex() if key is not None else None for key in node[:2]] + list(node[2:]),
+    }
+
+
+def _info_keys(info):
+    """decode the info of a record; see `record_info`
+
+    Returns:
+        tuple of the index row (with an offset and length of 0) and the chain node
+    """
+    fingerprint, subject, ski, expires = info['row']
+    row = (bytes.fromhex(fingerprint), bytes.fromhex(subject), bytes.fromhex(ski), expires, 0, 0)
+    ski, aki, subject, issuer = info['node']
+    return row, (bytes.fromhex(ski) if ski is not None else None,
+                 bytes.fromhex(aki) if aki is not None else None, subject, issuer)
+
+
+def _render(contents):
+    """load a certificate and render it as a bundle record along with its info; see `render_cert`
+    and `record_info`
+
+    Returns:
+        tuple of the record and its info, or of None and None if the certificate cannot be loaded
+    """
+    from cryptography.hazmat.primitives.serialization import Encoding
+
+    try:
+        cert = load_cert(contents)
+    except ValueError:
+        return None, None
+    return describe_cert(cert).encode() + cert.public_bytes(Encoding.PEM), record_info(cert)
+
+
+def _render_item(item):
+    """render a (digest, contents, known record, its info) item unless its record is known
+
+    Returns:
+        tuple of the digest, the record (None if the certificate cannot be loaded), its info, and
+        the time taken to render it (None if it was not rendered)
+    """
+    digest, contents, record, info = item
+    if record is not None:
+        if info is None:
+            # a record of a manifest written before the info was kept alongside records
+            info = record_info(load_cert(pem_to_der(record)))
+        return digest, record, info, None
+    start = time.perf_counter()
+    record, info = _render(contents)
+    return digest, record, info, time.perf_counter() - start
+
+
+def _render_records(items, workers=1, cache=None):
+    """render certificates as bundle records, reusing the records of previously rendered
+    certificates
+
+    Args:
+        items(iterable, required):
+            iterable of (digest, contents, record, info) tuples, where `digest` is the SHA-256 hex
+            digest of the DER or PEM encoded certificate `contents`, `record` is its previously
+            rendered record, if known, else None, and `info` is the info of that record (see
+            `record_info`), if known, else None
+        workers(int, optional, default=1):
+            passed to `_ordered_map`
+        cache(ParseCache, optional, default=None):
+            cache of previously rendered records; updated with newly rendered records
+
+    Yields:
+        tuple of the record of each certificate, or None if it cannot be loaded (see `render_cert`),
+        its info (see `record_info`), and the time taken to render it, or None if a known record was
+        reused
+    """
+    def lookup():
+        for digest, contents, record, info in items:
+            if record is None and cache is not None:
+                record, info = cache.get(digest) or (None, None)
+            # only the contents of certificates without a known record are passed to the workers
+            if record is not None:
+                yield digest, None, record, info
+            else:
+                yield digest, contents, None, None
+
+    rendered = []
+    try:
+        for digest, record, info, seconds in _ordered_map(_render_item, lookup(), workers=workers):
+            if seconds is not None and record is not None and cache is not None:
+                rendered.append((digest, record, info))
+                if len(rendered) >= 1000:
+                    cache.put_many(rendered)
+                    rendered = []
+            yield record, info, seconds
+    finally:
+        if rendered:
+            cache.put_many(rendered)
+
+
+def read_header(path):
+    """read the header of a bundle, without reading its records
+
+    Args:
+        path(str, required):
+            pathname of the bundle
+
+    Returns:
+        the header as bytes (empty if the bundle has none)
+    """
+    header = b''
+    with open(path, 'rb') as f:
+        for line in iter(f.readline, b''):
+            if not line.startswith(b'# Bundle '):
+                break
+            header += line
+    return header
+
+
+def bundle_digest(path):
+    """read the SHA-256 digest of the records of a bundle from its header
+
+    Bundles with the same records have the same digest, regardless of their creation time, so
+    comparing digests detects changed bundles without reading them.
+
+    Args:
+        path(str, required):
+            pathname of the bundle
+
+    Returns:
+        the digest as a hex string, or None if the bundle's header has none
+    """
+    for line in read_header(path).splitlines():
+        if line.startswith(digest_prefix):
+            return line[len(digest_prefix):].decode()
+    return None
+
+
+def manifest_path(destination):
+    """get the pathname of the manifest written alongside a bundle
+
+    Args:
+        destination(str, required):
+            pathname of the bundle
+
+    Returns:
+        pathname of the manifest
+    """
+    return destination + '.manifest.json'
+
+
+def _load_manifest(destination):
+    """load the manifest of an existing bundle
+
+    The manifest is only returned if the bundle it describes is still intact, so that its records
+    may be copied into a rebuilt bundle.
+
+    Args:
+        destination(str, required):
+            pathname of the bundle
+
+    Returns:
+        the manifest as a dictionary or None if the bundle or its manifest are missing or
+        inconsistent
+    """
+    try:
+        with open(manifest_path(destination), 'r') as f:
+            manifest = json.load(f)
+        st = os.stat(destination)
+        if (st.st_size, st.st_mtime_ns) != (manifest['bundle_size'], manifest['bundle_mtime']):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return manifest
+
+
+def _write_manifest(destination, entries, resources=()):
+    """write the manifest of a bundle
+
+    Args:
+        destination(str, required):
+            pathname of the bundle
+        entries(list, required):
+            list of input entries, each a dictionary of the input file name (`path`), its stat (see
+            `_directory_sources`; `source`, `mtime` and `ctime` are None if not read from disk),
+            `sha256`, and the `offset` and `length` of its record in the bundle (None if the input
+            could not be loaded or was dropped); loaded inputs also have the `info` of their record
+            (see `record_info`), and dropped duplicates the `duplicate_of` input path
+        resources(iterable, optional, default=()):
+            iterable of the resources retrieved for the bundle, each a dictionary of the fields of
+            its `Resource`, so that changes to the resources are detected against the bundle (see
+            `dodcerts.update`)
+    """
+    st = os.stat(destination)
+    with atomic_write(manifest_path(destination), 'w') as f:
+        json.dump({'bundle_size': st.st_size, 'bundle_mtime': st.st_mtime_ns,
+                   'resources': list(resources), 'entries': entries}, f, indent=1)
+
+
+def _map_batch(func, batch):
+    return [func(item) for item in batch]
+
+
+def _ordered_map(func, iterable, workers=1, chunksize=default_chunksize):
+    """apply `func` to every item of `iterable`, optionally across a pool of processes
+
+    Items are submitted to the pool in batches of `chunksize` and only a bounded number of batches
+    is in flight at a time, so `iterable` is consumed lazily; results are yielded in the order of
+    `iterable`.
+
+    Args:
+        func(callable, required):
+            picklable function applied to each item
+        iterable(iterable, required):
+            items to process
+        workers(int, optional, default=1):
+            number of worker processes; 1 applies `func` serially in the calling process, None uses
+            one process per CPU
+        chunksize(int, optional, default=default_chunksize):
+            number of items submitted to a worker at a time
+
+    Yields:
+        the result of `func` for each item
+    """
+    if workers == 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    max_pending = 2 * (workers or os.cpu_count() or 1)
+    iterator = iter(iterable)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        while True:
+            while len(pending) < max_pending:
+                batch = [item for _, item in zip(range(chunksize), iterator)]
+                if not batch:
+                    break
+                pending.append(executor.submit(_map_batch, func, batch))
+            if not pending:
+                break
+            yield from pending.popleft().result()
+
+
+class BundleWriter(object):
+    """write the records of a PEM bundle to a binary file handle as soon as they are produced
+
+    Args:
+        f(file-like, required):
+            binary file-like object to which the bundle is written
+
+    Attributes:
+        bytes_written(int):
+            number of bytes written to `f`
+        certs_written(int):
+            number of certificates written to `f`
+        sha256(hashlib.sha256):
+            hash of the records written to `f`, i.e. of the bundle without its header
+        header(bytes):
+            the header written to `f`
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes_written = 0
+        self.certs_written = 0
+        self.sha256 = hashlib.sha256()
+        self.header = b''
+        self._digest_offset = None
+
+    def _write(self, data):
+        self.f.write(data)
+        self.bytes_written += len(data)
+
+    def write_header(self, created=None):
+        """write the bundle header: the creation time and the digest of the records (see `finish`)
+
+        Args:
+            created(datetime.datetime, optional, default=None):
+                bundle creation time; defaulted to the `SOURCE_DATE_EPOCH` environment variable
+                (seconds since the epoch) if set, else to now
+        """
+        if created is None and os.getenv('SOURCE_DATE_EPOCH'):
+            created = datetime.fromtimestamp(int(os.environ['SOURCE_DATE_EPOCH']), timezone.utc)
+        header = "# Bundle Created: {} \n".format(created or datetime.now()).encode()
+        # the digest is only known once the records are written, a placeholder of the same width is
+        # written first
+        self._digest_offset = self.bytes_written + len(header) + len(digest_prefix)
+        header += digest_prefix + b'0' * 64 + b'\n'
+        self._write(header)
+        self.header = header
+
+    def write_record(self, record):
+        """write a rendered certificate record; see `render_cert`
+
+        Args:
+            record(bytes, required):
+                the certificate's info and public key in PEM format
+        """
+        self._write(record)
+        self.sha256.update(record)
+        self.certs_written += 1
+
+    def finish(self):
+        """fill in the digest of the records in the header; `f` must be seekable
+
+        Returns:
+            the digest as a hex string
+        """
+        digest = self.sha256.hexdigest()
+        if self._digest_offset is not None:
+            self.f.seek(self._digest_offset)
+            self.f.write(digest.encode())
+            self.f.seek(0, os.SEEK_END)
+            self.header = self.header[:-65] + digest.encode() + b'\n'
+        return digest
+
+    def write_cert(self, cert):
+        """write a certificate's info and public key in PEM format
+
+        Args:
+            cert(cryptography.x509.Certificate, required):
+                the certificate to write
+        """
+        from cryptography.hazmat.primitives.serialization import Encoding
+
+        self.write_record(describe_cert(cert).encode() + cert.public_bytes(Encoding.PEM))
+
+
+def _fetch_resource(url, fileobj, buffer_size=default_buffer_size, cache=None):
+    """retrieve a single resource and stream it into `fileobj` in chunks of `buffer_size` bytes
+
+    When a `cache` is provided, the request is made conditional on the validators
+    (ETag/Last-Modified) of the cached copy and the cached payload is reused if the server responds
+    with 304 Not Modified.
+
+    Args:
+        url(str, required):
+            url of the resource to retrieve
+        fileobj(file-like, required):
+            binary file-like object to which the resource is written
+        buffer_size(int, optional, default=default_buffer_size):
+            number of bytes read from the response and written to `fileobj` at a time
+        cache(DownloadCache, optional, default=None):
+            cache of previously downloaded resources
+
+    Returns:
+        `Resource` describing the retrieved resource
+    """
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+    log.info('Downloading resource: {}'.format(url))
+    headers = cache.conditional_headers(url) if cache is not None else {}
+    try:
+        response = urlopen(Request(url, headers=headers))
+    except HTTPError as e:
+        if e.code != 304 or cache is None:
+            raise
+        # not modified, reuse the cached payload
+        metadata = cache.load(url)
+        with open(cache.payload_path(url), 'rb') as f:
+            shutil.copyfileobj(f, fileobj, buffer_size)
+        log.info('Resource not modified, reused cached copy of: {}'.format(url))
+        return Resource(url=url, size=metadata['size'], sha256=metadata['sha256'],
+                        etag=metadata.get('etag'), last_modified=metadata.get('last_modified'))
+
+    digest = hashlib.sha256()
+    size = 0
+    payload = cache.open_payload() if cache is not None else None
+    try:
+        with response:
+            for chunk in iter(lambda: response.read(buffer_size), b''):
+                fileobj.write(chunk)
+                if payload is not None:
+                    payload.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        resource = Resource(url=url, size=size, sha256=digest.hexdigest(),
+                            etag=response.headers.get('ETag'),
+                            last_modified=response.headers.get('Last-Modified'))
+        if payload is not None:
+            payload.close()
+            cache.store(url, payload.name, dict(resource._asdict()))
+    finally:
+        if payload is not None:
+            payload.close()
+            if os.path.exists(payload.name):
+                os.remove(payload.name)
+    log.info('Resource retrieved: {} ({} bytes, sha256: {})'.format(url, resource.size,
+                                                                    resource.sha256))
+    return resource
+
+
+def _open_resource(url, buffer_size=default_buffer_size, cache=None, spool_size=default_spool_size):
+    """retrieve a single resource into a spooled temporary file
+
+    The resource is held in memory unless it exceeds `spool_size` bytes, in which case it is rolled
+    over to an anonymous temporary file.
+
+    Args:
+        url(str, required):
+            url of the resource to retrieve
+        buffer_size(int, optional, default=default_buffer_size):
+            passed to `_fetch_resource`
+        cache(DownloadCache, optional, default=None):
+            passed to `_fetch_resource`
+        spool_size(int, optional, default=default_spool_size):
+            maximum number of bytes held in memory
+
+    Returns:
+        tuple of the `Resource` and the spooled file, rewound to its start
+    """
+    fileobj = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    try:
+        resource = _fetch_resource(url, fileobj, buffer_size=buffer_size, cache=cache)
+    except BaseException:
+        fileobj.close()
+        raise
+    fileobj.seek(0)
+    return resource, fileobj
+
+
+def _ingest(name, fileobj, crl_dir, issuers):
+    """stream a CRL into the revoked-serial index in `crl_dir`, logging (rather than raising)
+    rejected CRLs"""
+    try:
+        issuer, count = ingest_crl(fileobj, crl_dir, issuers)
+    except ValueError as e:
+        log.warning('Rejected CRL {}: {}'.format(name, e))
+    else:
+        log.info('Indexed {} revoked serials of issuer {} from: {}'.format(count, issuer, name))
+
+
+def _spool(fileobj):
+    """copy a binary file-like object into a spooled temporary file"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=default_spool_size)
+    shutil.copyfileobj(fileobj, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+def _iter_members(resource, fileobj, crls=None):
+    """read the certificates from a retrieved resource, extracting them from archive (if necessary)
+
+    Args:
+        resource(Resource, required):
+            the retrieved resource
+        fileobj(file-like, required):
+            seekable binary file-like object holding the resource
+        crls(list, optional, default=None):
+            if specified, CRLs (the resource or archive members with a `crl_exts` extension) are
+            appended to this list as tuples of their path and a spooled copy (see `_spool`), rather
+            than yielded
+
+    Yields:
+        tuple of the path (within the archive) and contents (bytes) of each certificate; the
+        resource itself is yielded, by file name and regardless of its extension, if it is not an
+        archive
+    """
+    import tarfile
+    import zipfile
+
+    def is_crl(name):
+        return crls is not None and any([name.endswith(ext) for ext in crl_exts])
+
+    if tarfile.is_tarfile(fileobj):
+        fileobj.seek(0)
+        try:
+            with tarfile.open(mode='r:*', fileobj=fileobj) as tar:
+                for member in tar:
+                    if member.isfile() and is_crl(member.name):
+                        crls.append((member.name, _spool(tar.extractfile(member))))
+                    elif member.isfile() and any([member.name.endswith(ext) for ext in cert_exts]):
+                        yield member.name, tar.extractfile(member).read()
+            log.info('Extracted archive: {}'.format(resource.url))
+        except tarfile.TarError:
+            log.warning('Unable to extract resource: {}'.format(resource.url))
+        return
+    fileobj.seek(0)
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        try:
+            with zipfile.ZipFile(fileobj) as this_zip:
+                for member in this_zip.infolist():
+                    if not member.is_dir() and is_crl(member.filename):
+                        with this_zip.open(member) as f:
+                            crls.append((member.filename, _spool(f)))
+                    elif not member.is_dir() and \
+                            any([member.filename.endswith(ext) for ext in cert_exts]):
+                        yield member.filename, this_zip.read(member)
+            log.info('Extracted zip: {}'.format(resource.url))
+        except zipfile.BadZipFile:
+            log.warning('Unable to extract resource: {}'.format(resource.url))
+        return
+    fileobj.seek(0)
+    if is_crl(resource.url):
+        crls.append((os.path.basename(resource.url), _spool(fileobj)))
+        return
+    yield os.path.basename(resource.url), fileobj.read()
+
+
+def _unique_name(path, names):
+    """get the file name of an archive member or resource, numbered (e.g. `a.1.cer`) if it is
+    already in `names`
+
+    Args:
+        path(str, required):
+            path of the member within its archive, or file name of the resource
+        names(set, required):
+            the file names already given; updated with the returned name
+
+    Returns:
+        the file name
+    """
+    name = os.path.basename(path)
+    if name in names:
+        stem, ext = os.path.splitext(name)
+        n = 1
+        while '{}.{}{}'.format(stem, n, ext) in names:
+            n += 1
+        name = '{}.{}{}'.format(stem, n, ext)
+    names.add(name)
+    return name
+
+
+def iter_resources(urls, max_workers=None, buffer_size=default_buffer_size, cache_dir=None,
+                   spool_size=default_spool_size, crls=None, resources=None, observer=None):
+    """retrieve resources and read the certificates they contain without writing them to disk
+
+    Resources are fetched concurrently by a pool of threads into spooled temporary files; archive
+    members are read straight from those files. Certificates are yielded in the order of `urls`, and
+    in archive order within each resource. Certificates are named by file name; a file name already
+    given to a certificate of a previous resource or archive member is numbered (see `_unique_name`)
+    and logged, so that no certificate is shadowed by another.
+
+    Args:
+        urls(iterable, required):
+            iterable of urls (e.g. https://militarycac.org/maccerts/AllCerts.zip) as strings
+        max_workers(int, optional, default=None):
+            maximum number of resources fetched concurrently; defaulted to the
+            `concurrent.futures.ThreadPoolExecutor` default, 1 fetches the resources sequentially
+        buffer_size(int, optional, default=default_buffer_size):
+            number of bytes streamed from each response at a time
+        cache_dir(str, optional, default=None):
+            location of a persistent download cache; when specified, resources are requested
+            conditionally on the validators of their cached copies and the cached payload is reused
+            when unmodified
+        spool_size(int, optional, default=default_spool_size):
+            maximum number of bytes of each resource held in memory before it is rolled over to a
+            temporary file
+        crls(list, optional, default=None):
+            if specified, CRLs are appended to this list as tuples of their file name (numbered like
+            certificates) and a spooled copy, rather than yielded; the copies must be closed by the
+            caller
+        resources(list, optional, default=None):
+            if specified, appended with the `Resource` of each retrieved resource, in the order of
+            `urls`
+        observer(callable, optional, default=None):
+            receives the `fetch` and `extract` events of each resource; see `dodcerts.metrics`
+
+    Yields:
+        tuple of the file name and contents (bytes) of each certificate
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    _init_logging()
+    if isinstance(urls, str):
+        urls = [urls, ]
+    urls = [url for url in urls if url]
+    assert all([isinstance(url, str) for url in urls])
+
+    cache = DownloadCache(cache_dir) if cache_dir is not None else None
+
+    def fetch(url):
+        start = time.perf_counter()
+        resource, fileobj = _open_resource(url, buffer_size, cache, spool_size)
+        return resource, fileobj, time.perf_counter() - start
+
+    names = set()
+    # fetch the resources concurrently and process them in order
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch, url) for url in urls]
+        try:
+            for future in futures:
+                resource, fileobj, seconds = future.result()
+                observe(observer, 'fetch', resource.url, bytes=resource.size, seconds=seconds)
+                if resources is not None:
+                    resources.append(resource)
+                with fileobj:
+                    # time spent extracting, excluding the time the consumer spends on each
+                    # certificate
+                    resource_crls = [] if crls is not None else None
+                    members = _iter_members(resource, fileobj, resource_crls)
+                    count, seconds = 0, 0.0
+                    while True:
+                        start = time.perf_counter()
+                        member = next(members, None)
+                        seconds += time.perf_counter() - start
+                        if member is None:
+                            break
+                        count += 1
+                        path, contents = member
+                        name = _unique_name(path, names)
+                        if name != os.path.basename(path):
+                            log.warning('Renamed {} of {} to {}: another certificate has the same '
+                                        'file name'.format(path, resource.url, name))
+                        yield name, contents
+                    for path, crl in resource_crls or []:
+                        crls.append((_unique_name(path, names), crl))
+                    observe(observer, 'extract', resource.url, certificates=count, seconds=seconds)
+        finally:
+            # release the resources of any abandoned fetches
+            for future in futures:
+                if not future.cancel() and future.exception() is None:
+                    future.result()[1].close()
+
+
+def download_resources(urls, destination=None, max_workers=None, buffer_size=default_buffer_size,
+                       cache_dir=None, crls=False, resources=None, observer=None):
     """retrieve, place, and extract resources from archive (if necessary) into `certs` directory
 
+    Resources are fetched concurrently; certificates are then written in the order of `urls` so that
+    the contents of `destination` are deterministic. Archive members are written directly to
+    `destination` by file name, the archive itself is never written to disk.
+
     Args:
         urls(iterable, required):
             iterable of urls (e.g. https://militarycac.org/maccerts/AllCerts.zip) as strings
         destination(string, optional, default=None):
-            location to which resources are downloaded; defaulted to a new temporary directory that must then be managed
-            by the calling process
+            location to which resources are downloaded; defaulted to a new temporary directory that
+            must then be managed by the calling process
+        max_workers(int, optional, default=None):
+            maximum number of resources fetched concurrently; passed to `iter_resources`
+        buffer_size(int, optional, default=default_buffer_size):
+            number of bytes streamed from each response at a time; passed to `iter_resources`
+        cache_dir(str, optional, default=None):
+            location of a persistent download cache; passed to `iter_resources`
+        crls(bool, optional, default=False):
+            determines whether CRLs (resources and archive members with a `crl_exts` extension) are
+            also written to `destination`
+        resources(list, optional, default=None):
+            appended with the `Resource` of each retrieved resource; passed to `iter_resources`
+        observer(callable, optional, default=None):
+            receives the events of the pipeline; passed to `iter_resources`
 
     Returns:
         path to the downloaded resources as a string
     """
+    _init_logging()
     if destination is None:
         destination = tempfile.mkdtemp(prefix='certs_')
         log.info('Created temporary directory')
@@ -72,105 +774,737 @@ def download_resources(urls, destination=None):
         os.mkdir(destination)
     assert os.path.isdir(destination)
 
-    if isinstance(urls, str):
-        urls = [urls, ]
+    crl_files = [] if crls else None
+    try:
+        for name, contents in iter_resources(urls, max_workers=max_workers, buffer_size=buffer_size,
+                                             cache_dir=cache_dir, crls=crl_files,
+                                             resources=resources, observer=observer):
+            fpath = os.path.join(destination, name)
+            with open(fpath, 'wb') as f:
+                f.write(contents)
+            log.info('Resource written to: {}'.format(fpath))
+        for name, crl in crl_files or []:
+            fpath = os.path.join(destination, name)
+            with open(fpath, 'wb') as f:
+                shutil.copyfileobj(crl, f)
+            log.info('Resource written to: {}'.format(fpath))
+    finally:
+        for _, crl in crl_files or []:
+            crl.close()
+    return destination
+
+
+def parse_cert(contents, source=None):
+    """load a certificate and describe it as a `Certificate` record
+
+    Args:
+        contents(bytes, required):
+            the DER or PEM encoded certificate
+        source(str, optional, default=None):
+            reported as the `source` of the record
+
+    Returns:
+        the `Certificate`, or None if the certificate cannot be loaded; `fingerprint` is the SHA-256
+        hex digest of the DER encoding, `subject` and `issuer` are RFC 4514 strings, and `pem` is
+        the PEM encoding as bytes
+    """
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.serialization import Encoding
+
+    try:
+        cert = load_cert(contents)
+    except ValueError:
+        return None
+    return Certificate(
+        fingerprint=cert.fingerprint(hashes.SHA256()).hex(),
+        subject=cert.subject.rfc4514_string(),
+        issuer=cert.issuer.rfc4514_string(),
+        not_after=cert.not_valid_after_utc,
+        pem=cert.public_bytes(Encoding.PEM),
+        source=source,
+    )
+
+
+def _parse_item(item):
+    source, contents = item
+    start = time.perf_counter()
+    cert = parse_cert(contents, source)
+    return source, cert, time.perf_counter() - start
+
+
+def iter_certificates(urls=None, resource_dir=None, max_workers=None,
+                      buffer_size=default_buffer_size, cache_dir=None, workers=1, dedupe=True,
+                      observer=None):
+    """parse certificates from the specified resources, one at a time, without writing a bundle
+
+    The generator counterpart of `create_pem_bundle`: certificates are read (see `iter_resources`),
+    parsed (by `workers` processes, in bounded batches) and yielded in input order, so only a batch
+    of certificates is held in memory at a time.
+
+    Args:
+        urls(iterable, optional, default=None):
+            if specified, resources are retrieved and their certificates are read in memory by
+            `iter_resources`; `urls` or `resource_dir` must be specified
+        resource_dir(str, optional, default=None):
+            location of resources to process, in file name order; ignored if `urls` is specified
+        max_workers(int, optional, default=None):
+            maximum number of resources fetched concurrently; passed to `iter_resources`
+        buffer_size(int, optional, default=default_buffer_size):
+            number of bytes streamed from each response at a time; passed to `iter_resources`
+        cache_dir(str, optional, default=None):
+            location of a persistent download cache; passed to `iter_resources`
+        workers(int, optional, default=1):
+            number of processes parsing certificates; passed to `_ordered_map`
+        dedupe(bool, optional, default=True):
+            determines whether certificates with the fingerprint of a certificate already yielded
+            are dropped
+        observer(callable, optional, default=None):
+            receives the events of the pipeline (see `dodcerts.metrics`); passed to `iter_resources`
+
+    Yields:
+        the `Certificate` of each certificate; files that are not certificates are logged and
+        skipped
+    """
+    _init_logging()
+    if urls is not None:
+        items = iter_resources(urls, max_workers=max_workers, buffer_size=buffer_size,
+                               cache_dir=cache_dir, observer=observer)
+    else:
+        assert resource_dir is not None  # `urls` or `resource_dir` must be specified
+        paths = [os.path.join(resource_dir, file) for file in sorted(os.listdir(resource_dir))
+                 if any([file.endswith(ext) for ext in cert_exts])]
+
+        def read():
+            for path in paths:
+                if os.path.isfile(path):
+                    with open(path, 'rb') as f:
+                        yield path, f.read()
+        items = read()
 
-    # process the resources
-    for url in urls:
-        assert isinstance(url, str)
-        if not url:
+    fingerprints = set()
+    for source, cert, seconds in _ordered_map(_parse_item, items, workers=workers):
+        observe(observer, 'parse', source, seconds=seconds, failed=cert is None, reused=False)
+        if cert is None:
+            log.warning('Unable to load public key from: {}'.format(source))
             continue
-        log.info('Downloading resource: {}'.format(url))
-        response = urlopen(url)
-        fpath = os.path.join(destination, os.path.basename(url))
-        with open(fpath, 'wb') as f:
-            f.write(response.read())
-        log.info('Resource written to: {}'.format(fpath))
-
-        if tarfile.is_tarfile(fpath):
-            with open(fpath, 'rb') as f:
-                try:
-                    tar = tarfile.open(mode='r:*', fileobj=f)
-                    for file in tar:
-                        if any([file.name.endswith(ext) for ext in cert_exts]):
-                            tar.extract(member=file, path=destination)
-                    tar.close()
-                except tarfile.TarError as e:
-                    log.warning('Unable to extract resource: {}'.format(fpath))
-            os.remove(fpath)
-            log.info('Extracted archive and removed: {}'.format(fpath))
-        elif zipfile.is_zipfile(fpath):
-            try:
-                this_zip = zipfile.ZipFile(fpath)
-                for file in this_zip.filelist:
-                    if any([file.filename.endswith(ext) for ext in cert_exts]):
-                        this_zip.filename = os.path.basename(this_zip.filename)
-                        this_zip.extract(member=file, path=destination)
-                this_zip.close()
-                os.remove(fpath)
-                log.info('Extracted zip and removed: {}'.format(fpath))
-            except tarfile.TarError as e:
-                log.warning('Unable to extract resource: {}'.format(fpath))
-    return destination
+        if dedupe:
+            if cert.fingerprint in fingerprints:
+                log.info('Dropped duplicate certificate: {}'.format(source))
+                continue
+            fingerprints.add(cert.fingerprint)
+        yield cert
+
+
+def classify_files(files, rules=None):
+    """sort certificate files into ordered buckets in a single pass
+
+    Each file is considered once and placed in the bucket of the first rule it matches; files
+    without a certificate extension or matching no rule are dropped.
+
+    Args:
+        files(iterable, required):
+            iterable of file names as strings
+        rules(iterable, optional, default=None):
+            iterable of rules, each either a string that is matched (case-insensitively) against any
+            part of the file name or a callable that receives the file name and returns whether it
+            matches; defaulted to `cert_order`
+
+    Returns:
+        list of lists of file names, one per rule, each in the order of `files`
+    """
+    if rules is None:
+        rules = cert_order
+    matchers = []
+    for rule in rules:
+        if isinstance(rule, str):
+            matchers.append(lambda file, rule=rule.lower(): rule in file.lower())
+        else:
+            assert callable(rule)
+            matchers.append(rule)
+
+    buckets = [[] for _ in matchers]
+    for file in files:
+        if not any([file.endswith(ext) for ext in cert_exts]):
+            continue
+        for bucket, matches in zip(buckets, matchers):
+            if matches(file):
+                bucket.append(file)
+                break
+    return buckets
+
+
+def chain_node(cert):
+    """get the issuer graph node of a certificate; see `chain_order`
+
+    Args:
+        cert(cryptography.x509.Certificate, required):
+            the certificate
+
+    Returns:
+        tuple of the certificate's subject key identifier, authority key identifier, subject hash
+        and issuer hash
+    """
+    from cryptography.hazmat.primitives.serialization import Encoding
+
+    der = cert.public_bytes(Encoding.DER)
+    return key_identifiers(cert) + (subject_hash(der), issuer_hash(der))
+
+
+def chain_order(nodes):
+    """order certificates along their issuer graph so that every certificate precedes its issuer
+
+    A certificate's issuer is the first certificate whose subject key identifier matches its
+    authority key identifier (and whose subject matches its issuer), else the first certificate
+    whose subject matches its issuer. Each chain is emitted contiguously, leaves first then
+    intermediates then the root, with chains and siblings in the order of `nodes`; certificates
+    whose issuer is not among `nodes` are treated as roots. The graph is indexed with dictionaries,
+    so ordering takes linear time.
+
+    Args:
+        nodes(list, required):
+            list of certificate nodes; see `chain_node`
+
+    Returns:
+        list of the indices of `nodes` in bundle order
+    """
+    by_ski = {}
+    by_subject = {}
+    for i, (ski, _, subject, _) in enumerate(nodes):
+        if ski is not None:
+            by_ski.setdefault(ski, []).append(i)
+        by_subject.setdefault(subject, []).append(i)
+
+    children = [[] for _ in nodes]
+    roots = []
+    for i, (_, aki, _, issuer) in enumerate(nodes):
+        candidates = []
+        if aki is not None:
+            candidates = [j for j in by_ski.get(aki, []) if j != i and nodes[j][2] == issuer]
+        if not candidates:
+            candidates = [j for j in by_subject.get(issuer, []) if j != i]
+        if candidates:
+            children[candidates[0]].append(i)
+        else:
+            roots.append(i)
+
+    order = []
+    visited = [False] * len(nodes)
+
+    def visit(root):
+        # iterative post-order traversal: a certificate is emitted after all of the certificates it
+        # issued
+        visited[root] = True
+        stack = [(root, iter(children[root]))]
+        while stack:
+            node, pending = stack[-1]
+            child = next((c for c in pending if not visited[c]), None)
+            if child is None:
+                stack.pop()
+                order.append(node)
+            else:
+                visited[child] = True
+                stack.append((child, iter(children[child])))
+
+    for root in roots:
+        visit(root)
+    # certificates only reachable through an issuer cycle (e.g. cross-certificates)
+    for i in range(len(nodes)):
+        if not visited[i]:
+            visit(i)
+    return order
+
+
+def _prune_versions(destination, current, keep):
+    """remove all but the `keep` most recent versioned files of a bundle, always keeping `current`
+    """
+    import re
 
+    directory, name = os.path.split(destination)
+    pattern = re.compile(re.escape(name) + r'\.[0-9a-f]{16}$')
+    paths = [os.path.join(directory, file) for file in os.listdir(directory) if pattern.match(file)]
+    paths = sorted([path for path in paths if path != current],
+                   key=lambda path: os.stat(path).st_mtime_ns, reverse=True)
+    for path in paths[max(0, keep - 1):]:
+        os.remove(path)
+        log.info('Removed previous bundle version: {}'.format(path))
 
-def create_pem_bundle(destination, urls=None, resource_dir=None, set_env_var=True):
+
+def _directory_sources(resource_dir, files):
+    """describe the inputs of a bundle read from a resource directory
+
+    Args:
+        resource_dir(str, required):
+            the resource directory
+        files(list, required):
+            file names of the inputs within `resource_dir`, in bundle order
+
+    Yields:
+        tuple of the file name, the stat of the input (a dictionary of its absolute `source` path,
+        `size`, and `mtime` and `ctime` in nanoseconds), and a callable reading the contents of each
+        input
+    """
+    for file in files:
+        path = os.path.abspath(os.path.join(resource_dir, file))
+        st = os.stat(path)
+
+        def read(path=path):
+            with open(path, 'rb') as f:
+                return f.read()
+        stat = {'source': path, 'size': st.st_size, 'mtime': st.st_mtime_ns,
+                'ctime': st.st_ctime_ns}
+        yield file, stat, read
+
+
+def _stream_sources(stream, rules):
+    """describe the inputs of a bundle streamed from retrieved resources; see `iter_resources`
+
+    Args:
+        stream(iterable, required):
+            iterable of the file name and contents of each certificate
+        rules(iterable, required):
+            rules of `classify_files`; files matching no rule are dropped before they are parsed
+
+    Yields:
+        tuple of the file name, the stat of the input (its `size`, and None `source`, `mtime` and
+        `ctime` as the input is not read from disk; see `_directory_sources`), and a callable
+        returning the contents of each input
+    """
+    for file, contents in stream:
+        if any(classify_files([file], rules)):
+            stat = {'source': None, 'size': len(contents), 'mtime': None, 'ctime': None}
+            yield file, stat, lambda contents=contents: contents
+
+
+def _read_inputs(sources, entries, manifest=None, bundle=None):
+    """read the inputs of a bundle, reusing the records of the previous bundle for unchanged inputs
+
+    Args:
+        sources(iterable, required):
+            iterable of inputs; see `_directory_sources`
+        entries(list, required):
+            appended with the manifest entry of each input (see `_write_manifest`), as it is read
+        manifest(dict, optional, default=None):
+            manifest of the previous bundle; see `_load_manifest`
+        bundle(file-like, optional, default=None):
+            the previous bundle, opened in binary mode; required with `manifest`
+
+    Yields:
+        tuple of the SHA-256 hex digest of each input, its contents (None if its record is reused
+        without reading it), its record in the previous bundle (None if unknown), and the info of
+        that record; see `_render_records`
+    """
+    def stat_key(entry):
+        # inputs are only known unchanged by the stat of the same file, wherever its resource
+        # directory is
+        return entry.get('source'), entry['size'], entry['mtime'], entry.get('ctime')
+
+    by_stat, by_hash = {}, {}
+    if manifest is not None:
+        by_stat = {stat_key(e): e for e in manifest['entries'] if e.get('source') is not None}
+        by_hash = {e['sha256']: e for e in manifest['entries'] if e['offset'] is not None}
+
+    def previous_record(entry):
+        bundle.seek(entry['offset'])
+        return bundle.read(entry['length'])
+
+    for file, stat, read in sources:
+        entry = dict(path=file, **stat)
+        entries.append(entry)
+        old = by_stat.get(stat_key(entry)) if entry['source'] is not None else None
+        if old is not None:
+            # unchanged input, reuse its record without reading it
+            entry['sha256'] = old['sha256']
+            if old['offset'] is not None:
+                yield old['sha256'], None, previous_record(old), old.get('info')
+                continue
+        contents = read()
+        entry['sha256'] = hashlib.sha256(contents).hexdigest()
+        old = by_hash.get(entry['sha256'])
+        if old is not None:
+            yield entry['sha256'], contents, previous_record(old), old.get('info')
+        else:
+            yield entry['sha256'], contents, None, None
+
+
+def _parsed_records(records, entries, observer=None):
+    """pair rendered records with the manifest entries of their inputs, dropping inputs that are not
+    certificates
+
+    Args:
+        records(iterable, required):
+            iterable of the record of each input, its info and the time taken to render it; see
+            `_render_records`
+        entries(list, required):
+            manifest entries of the inputs, in the order of `records`; see `_read_inputs`
+        observer(callable, optional, default=None):
+            receives the `parse` event of each input; see `dodcerts.metrics`
+
+    Yields:
+        tuple of the entry, record, index row (see `dodcerts.index.index_row`) and chain node (see
+        `chain_node`) of each certificate
+    """
+    for i, (record, info, seconds) in enumerate(records):
+        entry = entries[i]
+        entry['offset'] = entry['length'] = None
+        observe(observer, 'parse', entry['path'], seconds=seconds or 0.0, failed=record is None,
+                reused=seconds is None)
+        if record is None:
+            log.warning('Unable to load public key from: {}'.format(entry['path']))
+            continue
+        entry['info'] = info
+        yield (entry, record) + _info_keys(info)
+
+
+class _Fingerprints(object):
+    """keeps the first input of each certificate fingerprint, in bundle order
+
+    Args:
+        dedupe(bool, optional, default=True):
+            determines whether inputs are dropped; if False every input is kept
+    """
+
+    def __init__(self, dedupe=True):
+        self.dedupe = dedupe
+        self.paths = {}
+
+    def keep(self, entry, row):
+        """check whether an input is kept, recording the input it duplicates (`duplicate_of`) in its
+        entry if not"""
+        if not self.dedupe:
+            return True
+        fingerprint = row[0]
+        if fingerprint in self.paths:
+            entry['duplicate_of'] = self.paths[fingerprint]
+            log.info('Dropped duplicate certificate: {} (same as {})'.format(entry['path'],
+                                                                             entry['duplicate_of']))
+            return False
+        self.paths[fingerprint] = entry['path']
+        return True
+
+
+def _staged_records(parsed, rules, keep, chain=True):
+    """stage parsed records in a spooled temporary file, then order them
+
+    Records are ordered by their sorted and classified file names (see `classify_files`), as if read
+    from a directory, then deduplicated, then ordered along their issuer graph (see `chain_order`)
+    if `chain`. Only the records' offsets in the staging file and their chain nodes are held in
+    memory.
+
+    Args:
+        parsed(iterable, required):
+            iterable of parsed records; see `_parsed_records`
+        rules(iterable, required):
+            rules of `classify_files`
+        keep(callable, required):
+            called with the entry and index row of each record, in file order, to determine whether
+            it is kept; see `_Fingerprints.keep`
+        chain(bool, optional, default=True):
+            determines whether the records are ordered along their issuer graph
+
+    Yields:
+        tuple of the entry, record and index row of each kept certificate, in bundle order
+    """
+    with tempfile.SpooledTemporaryFile(max_size=default_spool_size) as stash:
+        pending = []
+        for entry, record, row, node in parsed:
+            pending.append((entry, row, node, stash.tell(), len(record)))
+            stash.write(record)
+        ranks = {file: i for i, file in enumerate(
+            [file for bucket in classify_files(sorted([item[0]['path'] for item in pending]), rules)
+             for file in bucket])}
+        pending = [item for item in sorted(pending, key=lambda item: ranks[item[0]['path']])
+                   if keep(item[0], item[1])]
+        indices = chain_order([item[2] for item in pending]) if chain else range(len(pending))
+        for i in indices:
+            entry, row, _, offset, length = pending[i]
+            stash.seek(offset)
+            yield entry, stash.read(length), row
+
+
+def _write_records(writer, records, written=None):
+    """write ordered records to a bundle, recording their offsets in their manifest entries
+
+    Args:
+        writer(BundleWriter, required):
+            the bundle writer, with its header written
+        records(iterable, required):
+            iterable of the entry, record and index row of each certificate, in bundle order
+        written(list, optional, default=None):
+            if specified, appended with each record written
+
+    Returns:
+        tuple of the index rows of the written records and the time spent writing them, excluding
+        the time spent producing them
+    """
+    rows = []
+    seconds = 0.0
+    for entry, record, row in records:
+        start = time.perf_counter()
+        entry['offset'] = writer.bytes_written
+        entry['length'] = len(record)
+        rows.append(row[:4] + (entry['offset'], entry['length']))
+        writer.write_record(record)
+        if written is not None:
+            written.append(record)
+        seconds += time.perf_counter() - start
+    return rows, seconds
+
+
+def _publish_bundle(f, writer, destination, versions=None):
+    """publish a finished, staged bundle unless the bundle in place is identical
+
+    Args:
+        f(file-like, required):
+            the staged bundle; see `dodcerts.atomic.stage`
+        writer(BundleWriter, required):
+            the writer of the staged bundle, finished
+        destination(str, required):
+            pathname of the bundle
+        versions(int, optional, default=None):
+            see `create_pem_bundle`
+
+    Returns:
+        whether the bundle in place was identical, and left in place
+    """
+    digest = writer.sha256.hexdigest()
+    version = '{}.{}'.format(destination, digest[:16]) if versions is not None else None
+    # an identical bundle is left in place, so that the caches of its readers (keyed by mtime)
+    # remain valid
+    unchanged = os.path.exists(destination) and all([
+        read_header(destination) == writer.header,
+        os.path.getsize(destination) == writer.bytes_written,
+        os.path.islink(destination) == (version is not None),
+        version is None or os.path.realpath(destination) == os.path.realpath(version),
+    ])
+    if unchanged:
+        log.info('Bundle unchanged: {} (sha256: {})'.format(destination, digest))
+    elif version is None:
+        publish(f, destination)
+    else:
+        publish(f, version)
+        link(version, destination)
+        _prune_versions(destination, version, versions)
+    return unchanged
+
+
+def _ingest_crls(crl_dir, bundle, files):
+    """stream CRLs into a revoked-serial index, each verified against the certificates of a bundle
+
+    Args:
+        crl_dir(str, required):
+            the index directory; see `dodcerts.crl`
+        bundle(str, required):
+            pathname of the bundle of trusted certificates; see `dodcerts.crl.load_issuers`
+        files(iterable, required):
+            iterable of the name and a binary file-like object of each CRL; rejected CRLs are logged
+            and skipped
+    """
+    issuers = load_issuers(bundle)
+    for name, fileobj in files:
+        _ingest(name, fileobj, crl_dir, issuers)
+
+
+def _open_files(directory, files):
+    """open files of a directory in turn
+
+    Yields:
+        tuple of the name and binary file object of each file, closed once the next is opened
+    """
+    for file in files:
+        with open(os.path.join(directory, file), 'rb') as f:
+            yield file, f
+
+
+def create_pem_bundle(destination, urls=None, resource_dir=None, set_env_var=True, max_workers=None,
+                      buffer_size=default_buffer_size, cache_dir=None, order=None, workers=1,
+                      dedupe=True, capath=None, crl_dir=None, observer=None, versions=None,
+                      reproducible=False):
     """create a PEM formatted certificate bundle from the specified resources
 
+    The bundle is written to a temporary file in the directory of `destination`, flushed to disk and
+    published with `os.replace` (see `dodcerts.atomic`): processes reading the bundle during a
+    rebuild see the previous bundle or the new one, never a partial one, and a crashed rebuild
+    leaves the previous bundle intact.
+
+    A manifest of the inputs (absolute path, size, mtime, ctime and hash) and the offsets of their
+    records in the bundle is written alongside the bundle (see `manifest_path`), as is an index for
+    random access into the bundle (see `dodcerts.index`). When the bundle is rebuilt, the records of
+    inputs whose file is unchanged since the manifest was written, or whose contents are those of an
+    input of the previous bundle, are copied from the previous bundle rather than parsed again. The
+    manifest also records the size, hash and HTTP validators of the retrieved resources, against
+    which `dodcerts.update` checks them.
+
+    By default the certificates are ordered along their issuer graph (see `chain_order`) so that
+    each certificate precedes its issuer; records are then staged in a spooled temporary file until
+    the graph is complete. Certificates read from `urls` are parsed as they stream (see
+    `iter_resources`) and staged likewise, then ordered by file name as if read from a directory, so
+    only their records' offsets and chain nodes are held in memory.
+
     Args:
         destination(str, required):
             pathname for created pem bundle file
         urls(iterable, optional, default=None):
-            passed to `download_resources` if specified, else the existing contents of `resource_dir` are processed;
-            `urls` and/or `resource_dir` must be specified
+            if specified, resources are retrieved and their certificates are read in memory by
+            `iter_resources`, else the existing contents of `resource_dir` are processed; `urls`
+            and/or `resource_dir` must be specified
         resource_dir(str, optional, default=None):
-            location of resources to process; passed to `download_resources` along with `urls` if both specified, else
-            a temporary location is utilized
+            location of resources to process; passed to `download_resources` along with `urls` if
+            both specified, else nothing is written to disk other than the bundle
         set_env_var(bool, optional, default=True):
-            determines whether the `DOD_CA_CERTS_PEM_PATH` environmental variable is set with the value of created pem
-            bundle pathname
+            determines whether the `DOD_CA_CERTS_PEM_PATH` environmental variable is set with the
+            value of created pem bundle pathname
+        max_workers(int, optional, default=None):
+            maximum number of resources fetched concurrently; passed to `iter_resources`
+        buffer_size(int, optional, default=default_buffer_size):
+            number of bytes streamed from each response at a time; passed to `iter_resources`
+        cache_dir(str, optional, default=None):
+            location of a persistent cache; passed to `iter_resources` and also used to keep a
+            `ParseCache` of rendered certificate records so that unchanged certificates are not
+            parsed again
+        order(iterable, optional, default=None):
+            if specified, rules ordering the certificates within the bundle by file name (e.g.
+            `cert_order`, CAs first then Roots) passed to `classify_files`, files matching no rule
+            are dropped; by default all certificates are ordered by issuer
+        workers(int, optional, default=1):
+            number of processes parsing certificates; 1 parses serially, None uses one process per
+            CPU; the bundle is identical regardless
+        dedupe(bool, optional, default=True):
+            determines whether certificates with the SHA-256 fingerprint of a certificate already in
+            the bundle (e.g. the same certificate in DER and PEM encodings) are dropped; dropped
+            inputs are logged and recorded in the manifest with the path of the input they duplicate
+            as `duplicate_of`
+        capath(str, optional, default=None):
+            if specified, the bundled certificates are also written to this directory as an OpenSSL
+            hashed certificate directory (see `dodcerts.capath.write_capath`), which is updated
+            incrementally; with `set_env_var`, the `DOD_CA_CERTS_DIR_PATH` environmental variable is
+            set with its pathname
+        crl_dir(str, optional, default=None):
+            if specified, CRLs among the resources (and in `resource_dir`) are streamed into a
+            revoked-serial index in this directory (see `dodcerts.crl`) for use by
+            `dodcerts.verify`, once the bundle is written; each CRL is verified against the
+            certificates of the bundle, and CRLs that do not verify, are not current, or are older
+            than the indexed CRL of their issuer are logged and skipped
+        observer(callable, optional, default=None):
+            receives the events of each stage of the pipeline, e.g. a `dodcerts.metrics.Metrics`;
+            see `dodcerts.metrics`
+        versions(int, optional, default=None):
+            if specified, the bundle is published to a versioned file (`destination` suffixed with
+            the first 16 hex digits of the bundle's SHA-256) and `destination` is atomically
+            replaced by a symbolic link to it; the `versions` most recent versioned files are kept,
+            so readers holding a previous version may finish with it
+        reproducible(bool, optional, default=False):
+            determines whether the creation time of the header is fixed, to `SOURCE_DATE_EPOCH` if
+            set (see `BundleWriter.write_header`) else to the epoch, so that bundles of the same
+            certificates are byte-identical
 
     Returns:
         pathname of created pem bundle file
     """
+    _init_logging()
+    rules = [lambda file: True] if order is None else order
+    # CRL files of `resource_dir`, and spooled CRLs of streamed resources: (file name, file-like)
+    crl_files = []
+    crls = [] if crl_dir is not None and resource_dir is None else None
+    resources = []
+    stream = None
     if resource_dir is not None:
-        assert os.exists(resource_dir)
-        assert os.is_dir(resource_dir)
+        if urls is not None:
+            download_resources(urls, resource_dir, max_workers=max_workers, buffer_size=buffer_size,
+                               cache_dir=cache_dir, crls=crl_dir is not None, resources=resources,
+                               observer=observer)
+        assert os.path.isdir(resource_dir)
+        files = [file for file in os.listdir(resource_dir)
+                 if os.path.isfile(os.path.join(resource_dir, file))]
+        if crl_dir is not None:
+            crl_files = sorted([file for file in files
+                                if any([file.endswith(ext) for ext in crl_exts])])
+            files = [file for file in files if file not in crl_files]
+        # classify the sorted file list into ordered buckets
+        sources = _directory_sources(
+            resource_dir,
+            [file for bucket in classify_files(sorted(files), rules) for file in bucket])
     else:
         assert urls is not None  # `urls` or `resource_dir` must be specified
+        # parse the certificates as they stream from the retrieved resources, nothing is written to
+        # disk; they are ordered once all of them are staged
+        stream = iter_resources(urls, max_workers=max_workers, buffer_size=buffer_size,
+                                cache_dir=cache_dir, crls=crls, resources=resources,
+                                observer=observer)
+        sources = _stream_sources(stream, rules)
 
-    if urls is not None:
-        resource_dir = download_resources(urls, resource_dir)
-
-    # create empty bytes stream
-    pem_bundle = "# Bundle Created: {} \n".format(datetime.now()).encode()
-    # get file list
-    files = sorted(os.listdir(resource_dir))
-    # process CAs first then Roots
-    for cert_type in ['ca', 'root']:
-        for file in files:
-            if any([file.endswith(ext) for ext in cert_exts]):
-                fpath = os.path.join(resource_dir, file)
-                if file.lower().find(cert_type) > -1 and os.path.isfile(fpath):
-                    with open(fpath, 'rb') as f:
-                        contents = f.read()
-                        try:
-                            cert = load_der_x509_certificate(contents, backend=default_backend())
-                        except ValueError:
-                            try:
-                                cert = load_pem_x509_certificate(contents, backend=default_backend())
-                            except ValueError:
-                                log.warning('Unable to load public key from: {}'.format(file))
-                                continue
-                        # add cert's info and public key in PEM format to the bytes stream
-                        pem_bundle += describe_cert(cert).encode()
-                        pem_bundle += cert.public_bytes(Encoding.PEM)
     destination = os.path.abspath(destination)
-    with open(destination, 'wb') as f:
-        f.write(pem_bundle)
+    previous = _load_manifest(destination)
+    previous_bundle = open(destination, 'rb') if previous is not None else None
+    entries = []
+    written = [] if capath is not None else None
+    # write to a temporary file so that the records of the previous bundle remain readable
+    # throughout
+    parse_cache = ParseCache(cache_dir) if cache_dir is not None else None
+    f = stage(destination)
+    try:
+        with f:
+            writer = BundleWriter(f)
+            writer.write_header(created=datetime.fromtimestamp(0, timezone.utc)
+                                if reproducible and not os.getenv('SOURCE_DATE_EPOCH') else None)
+            records = _render_records(_read_inputs(sources, entries, previous, previous_bundle),
+                                      workers=workers, cache=parse_cache)
+            try:
+                parsed = _parsed_records(records, entries, observer)
+                keep = _Fingerprints(dedupe).keep
+                if order is not None and resource_dir is not None:
+                    # already in bundle order, records are written as they are parsed
+                    ordered = ((entry, record, row)
+                               for entry, record, row, _ in parsed if keep(entry, row))
+                else:
+                    # records await the issuer graph, or the file order of streamed resources
+                    ordered = _staged_records(parsed, rules, keep, chain=order is None)
+                rows, write_seconds = _write_records(writer, ordered, written)
+            finally:
+                # flush newly rendered records to the cache before closing it
+                records.close()
+                if stream is not None:
+                    stream.close()
+                if previous_bundle is not None:
+                    previous_bundle.close()
+            start = time.perf_counter()
+            writer.finish()
+            unchanged = _publish_bundle(f, writer, destination, versions)
+    finally:
+        if parse_cache is not None:
+            parse_cache.close()
+        discard(f)
+    _write_manifest(destination, entries, [dict(resource._asdict()) for resource in resources])
+    if not unchanged or not os.path.exists(index_path(destination)):
+        write_index(destination, rows)
+    log.info('Bundle written to: {} ({} certificates, {} bytes)'.format(
+        destination, writer.certs_written, writer.bytes_written))
+    duplicates = sum(['duplicate_of' in entry for entry in entries])
+    observe(observer, 'write', destination, certificates=writer.certs_written,
+            duplicates=duplicates, bytes=writer.bytes_written,
+            seconds=write_seconds + time.perf_counter() - start)
+    if duplicates:
+        log.info('Dropped {} duplicate certificates'.format(duplicates))
+
+    if capath is not None:
+        capath = os.path.abspath(capath)
+        stats = write_capath(capath, written)
+        log.info('Hashed certificate directory updated: {} ({written} written, {unchanged} '
+                 'unchanged, {removed} removed)'.format(capath, **stats))
+
+    if crl_dir is not None:
+        # CRLs are only indexed once verified against the certificates of the bundle
+        try:
+            _ingest_crls(crl_dir, destination,
+                         _open_files(resource_dir, crl_files) if resource_dir is not None else crls)
+        finally:
+            for _, crl in crls or []:
+                crl.close()
 
     if set_env_var:
         os.environ['DOD_CA_CERTS_PEM_PATH'] = destination
         log.info('Set DOD_CA_CERTS_PEM_PATH environment variable')
+        if capath is not None:
+            os.environ['DOD_CA_CERTS_DIR_PATH'] = capath
+            log.info('Set DOD_CA_CERTS_DIR_PATH environment variable')
 
     return destination
@@ -0,0 +1,577 @@
+"""streaming ingestion of certificate revocation lists (CRLs) into compact revoked-serial indexes
+
+CRLs are parsed as they stream, one revoked entry at a time, and their serial numbers are written to
+a revoked-serial list per issuer (`<issuer hash>.rsl`, see `dodcerts.capath.name_hash`) within an
+index directory:
+
+* a header: magic, width of the serials, number of serials, and the thisUpdate and nextUpdate of the
+  CRL (seconds since the epoch, nextUpdate 0 if unspecified)
+* the revoked serial numbers, sorted and fixed-width (left padded with zeros)
+
+optionally fronted by a Bloom filter (`<issuer hash>.bloom`) so that most lookups of serials that
+are not revoked never touch the list. Lists are sorted externally (in bounded runs merged from
+temporary files), so neither ingestion nor lookups hold a CRL in memory.
+
+CRLs are retrieved over plain HTTP, so they are only trusted once verified: the TBSCertList is
+hashed as it streams and its signature is checked against the public keys of the trusted
+certificates of its issuer (see `load_issuers`). A CRL that does not verify, is not current, or is
+older than the CRL of the issuer's list leaves that list in place.
+"""
+import os
+
+import base64
+import hashlib
+import heapq
+import mmap
+import struct
+import tempfile
+
+from datetime import datetime, timezone
+
+from .atomic import atomic_write
+from .capath import name_hash, subject_hash
+from .certs import load_cert
+from .der import children, pem_to_der
+
+serial_width = 20  # RFC 5280 limits serial numbers to 20 octets
+run_size = 1000000  # serials sorted in memory at a time
+bloom_bits = 10  # bits of Bloom filter per serial (~1% false positives)
+bloom_hashes = 7
+
+_list_magic = b'DODRSL2\n'
+_list_header = struct.Struct('<8sHQqq')
+_bloom_magic = b'DODBLM1\n'
+_bloom_header = struct.Struct('<8sQB')
+
+# signature algorithms of CRLs, by the contents of their DER encoded object identifier: (key type,
+# hash)
+_signature_algorithms = {
+    bytes.fromhex('2a864886f70d010105'): ('rsa', 'sha1'),  # sha1WithRSAEncryption
+    bytes.fromhex('2a864886f70d01010b'): ('rsa', 'sha256'),  # sha256WithRSAEncryption
+    bytes.fromhex('2a864886f70d01010c'): ('rsa', 'sha384'),  # sha384WithRSAEncryption
+    bytes.fromhex('2a864886f70d01010d'): ('rsa', 'sha512'),  # sha512WithRSAEncryption
+    bytes.fromhex('2a8648ce3d040302'): ('ecdsa', 'sha256'),  # ecdsa-with-SHA256
+    bytes.fromhex('2a8648ce3d040303'): ('ecdsa', 'sha384'),  # ecdsa-with-SHA384
+    bytes.fromhex('2a8648ce3d040304'): ('ecdsa', 'sha512'),  # ecdsa-with-SHA512
+}
+
+
+def serial_key(serial):
+    """get the fixed-width key of a serial number
+
+    Args:
+        serial(bytes or int, required):
+            the contents of the serial number INTEGER (big-endian two's complement) or the serial
+            number
+
+    Returns:
+        the key as `serial_width` bytes; serials longer than `serial_width` octets (which violate
+        RFC 5280) are hashed
+    """
+    if isinstance(serial, int):
+        serial = serial.to_bytes(max(1, (serial.bit_length() + 8) // 8), 'big', signed=True)
+    serial = serial.lstrip(b'\x00')
+    if len(serial) > serial_width:
+        return hashlib.sha1(serial).digest()
+    return serial.rjust(serial_width, b'\x00')
+
+
+class _Stream(object):
+    """reads DER elements from a binary file-like object without loading it
+
+    Attributes:
+        tee(callable):
+            if set, receives every byte read, e.g. the `update` of a hash
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.position = 0
+        self.tee = None
+
+    def read(self, n):
+        data = self.fileobj.read(n)
+        while len(data) < n:
+            chunk = self.fileobj.read(n - len(data))
+            if not chunk:
+                raise ValueError('Truncated CRL')
+            data += chunk
+        self.position += n
+        if self.tee is not None:
+            self.tee(data)
+        return data
+
+    def header(self):
+        """read the header of the next element
+
+        Returns:
+            tuple of the element's tag and the length of its contents
+        """
+        tag, length = self.read(2)
+        if length & 0x80:
+            length = int.from_bytes(self.read(length & 0x7f), 'big')
+        return tag, length
+
+    def skip(self, n):
+        while n > 0:
+            n -= len(self.read(min(n, 64 * 1024)))
+
+
+def _pem_stream(fileobj):
+    """decode a PEM encoded CRL into a temporary file, line by line"""
+    decoded = tempfile.TemporaryFile()
+    for line in fileobj:
+        line = line.strip()
+        if line.startswith(b'-----END'):
+            break
+        if line and not line.startswith(b'-----BEGIN'):
+            decoded.write(base64.b64decode(line))
+    decoded.seek(0)
+    return decoded
+
+
+def _time(value, tag):
+    """decode a UTCTime (two digit years 50-99 are 19xx) or GeneralizedTime as a timezone aware
+    `datetime.datetime`"""
+    value = value.decode('ascii')
+    if tag == 0x17:
+        value = ('19' if int(value[:2]) >= 50 else '20') + value
+    return datetime.strptime(value, '%Y%m%d%H%M%SZ').replace(tzinfo=timezone.utc)
+
+
+class CRLReader(object):
+    """reads a DER or PEM encoded CRL as it streams
+
+    The fields preceding the revoked certificates are read on construction. `revoked` then streams
+    the revoked serial numbers, hashing the TBSCertList as it goes, and reads the signature that
+    follows, so that `verify` checks the CRL without it ever being held in memory.
+
+    Args:
+        fileobj(file-like, required):
+            binary file-like object positioned at the start of the CRL
+
+    Attributes:
+        issuer(str):
+            hash of the CRL issuer's name; see `dodcerts.capath.name_hash`
+        this_update(datetime.datetime):
+            issue time of the CRL
+        next_update(datetime.datetime):
+            time by which the next CRL is issued, or None if unspecified
+
+    Raises:
+        ValueError: if `fileobj` does not hold a CRL or the CRL is signed with an unsupported
+        algorithm
+    """
+
+    def __init__(self, fileobj):
+        first = fileobj.read(1)
+        if first == b'-':
+            fileobj = _pem_stream(_Prefixed(first, fileobj))
+        elif first != b'\x30':
+            raise ValueError('Not a CRL')
+        else:
+            fileobj = _Prefixed(first, fileobj)
+        stream = self._stream = _Stream(fileobj)
+
+        tag, _ = stream.header()  # CertificateList
+        # the bytes of the TBSCertList read before its signature algorithm (hence its hash) is known
+        signed = bytearray()
+        stream.tee = signed.extend
+        tag_tbs, tbs_length = stream.header()  # TBSCertList
+        if tag != 0x30 or tag_tbs != 0x30:
+            raise ValueError('Not a CRL')
+        self._tbs_end = stream.position + tbs_length
+        tag, length = stream.header()
+        if tag == 0x02:
+            # version
+            stream.skip(length)
+            tag, length = stream.header()
+        self._algorithm = stream.read(length)
+        try:
+            (_, oid_start, _, oid_end), *_ = children(self._algorithm, 0, len(self._algorithm))
+            self._key_type, self._hash = _signature_algorithms[self._algorithm[oid_start:oid_end]]
+        except (IndexError, KeyError, ValueError):
+            raise ValueError('Unsupported CRL signature algorithm')
+        self._digest = hashlib.new(self._hash, signed)
+        stream.tee = self._digest.update
+
+        tag, length = stream.header()
+        self.issuer = name_hash(stream.read(length), 0, length)
+        tag, length = stream.header()
+        self.this_update = _time(stream.read(length), tag)
+        self.next_update = None
+        # header of the element following the update times within the TBSCertList, if any
+        self._next = None
+        if stream.position < self._tbs_end:
+            tag, length = stream.header()
+            if tag in (0x17, 0x18):
+                self.next_update = _time(stream.read(length), tag)
+                if stream.position < self._tbs_end:
+                    self._next = stream.header()
+            else:
+                self._next = (tag, length)
+        self.signature = None
+
+    def revoked(self):
+        """stream the revoked serial numbers, then read the signature of the CRL
+
+        Yields:
+            the key (see `serial_key`) of each revoked serial number
+        """
+        stream = self._stream
+        if self._next is not None and self._next[0] == 0x30:
+            # revokedCertificates (else crlExtensions, whose header was read)
+            end = stream.position + self._next[1]
+            while stream.position < end:
+                _, length = stream.header()
+                entry = stream.read(length)
+                # userCertificate INTEGER, revocationDate, crlEntryExtensions (optional)
+                start = 2 if entry[1] < 0x80 else 2 + (entry[1] & 0x7f)
+                size = entry[1] if entry[1] < 0x80 else int.from_bytes(entry[2:start], 'big')
+                yield serial_key(entry[start:start + size])
+        stream.skip(self._tbs_end - stream.position)
+        stream.tee = None
+
+        tag, length = stream.header()
+        if tag != 0x30 or stream.read(length) != self._algorithm:
+            raise ValueError('CRL signature algorithm does not match its TBSCertList')
+        tag, length = stream.header()
+        if tag != 0x03:
+            raise ValueError('Not a CRL')
+        # BIT STRING: the number of unused bits, then the signature
+        self.signature = stream.read(length)[1:]
+
+    def verify(self, public_key):
+        """check the signature of the CRL, once `revoked` is exhausted
+
+        Args:
+            public_key(cryptography public key, required):
+                public key of a certificate of the CRL issuer
+
+        Returns:
+            whether the CRL was signed with the private key of `public_key`
+        """
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa, utils
+
+        if self.signature is None:
+            raise ValueError('CRL signature not read')
+        algorithm = utils.Prehashed(getattr(hashes, self._hash.upper())())
+        try:
+            if self._key_type == 'rsa' and isinstance(public_key, rsa.RSAPublicKey):
+                public_key.verify(self.signature, self._digest.digest(), padding.PKCS1v15(),
+                                  algorithm)
+            elif self._key_type == 'ecdsa' and isinstance(public_key, ec.EllipticCurvePublicKey):
+                public_key.verify(self.signature, self._digest.digest(), ec.ECDSA(algorithm))
+            else:
+                return False
+        except InvalidSignature:
+            return False
+        return True
+
+
+class _Prefixed(object):
+    """a binary file-like object with bytes already read from it pushed back"""
+
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, n=-1):
+        prefix, self.prefix = self.prefix, b''
+        if n < 0:
+            return prefix + self.fileobj.read()
+        return prefix + self.fileobj.read(n - len(prefix)) if n > len(prefix) else prefix
+
+    def __iter__(self):
+        prefix, self.prefix = self.prefix, b''
+        first = True
+        for line in self.fileobj:
+            if first:
+                line, first = prefix + line, False
+            yield line
+        if first and prefix:
+            yield prefix
+
+
+def load_issuers(bundle):
+    """load the public keys of the certificates of a PEM bundle, by subject hash, to verify CRLs
+    with
+
+    Args:
+        bundle(str, required):
+            pathname of the PEM bundle of trusted certificates
+
+    Returns:
+        dictionary of OpenSSL subject hash (see `dodcerts.capath.subject_hash`) to the list of
+        public keys of the certificates with that hash; certificates that cannot be loaded are
+        skipped
+    """
+    import re
+
+    with open(bundle, 'rb') as f:
+        contents = f.read()
+    issuers = {}
+    for pem in re.findall(rb'-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----', contents,
+                          re.DOTALL):
+        try:
+            cert = load_cert(pem)
+        except ValueError:
+            continue
+        issuers.setdefault(subject_hash(pem_to_der(pem)), []).append(cert.public_key())
+    return issuers
+
+
+def _bloom_positions(key, m):
+    digest = hashlib.sha256(key).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:16], 'little') | 1
+    return [(h1 + i * h2) % m for i in range(bloom_hashes)]
+
+
+def _sorted_unique(keys):
+    """sort keys externally, in runs of `run_size` merged from temporary files, dropping duplicates
+    """
+    runs = []
+    try:
+        while True:
+            run = sorted([key for _, key in zip(range(run_size), keys)])
+            if not run:
+                break
+            f = tempfile.TemporaryFile()
+            f.write(b''.join(run))
+            f.seek(0)
+            runs.append(f)
+
+        def read_run(f):
+            for chunk in iter(lambda: f.read(serial_width * 4096), b''):
+                for i in range(0, len(chunk), serial_width):
+                    yield chunk[i:i + serial_width]
+
+        previous = None
+        for key in heapq.merge(*[read_run(f) for f in runs]):
+            if key != previous:
+                yield key
+                previous = key
+    finally:
+        for f in runs:
+            f.close()
+
+
+def _list_updates(path):
+    """get the thisUpdate and nextUpdate of the CRL of a revoked-serial list
+
+    Returns:
+        tuple of the thisUpdate and nextUpdate (None if unspecified) as timezone aware
+        `datetime.datetime`s, or None if there is no list at `path` (or it predates the update
+        times)
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(_list_header.size)
+    except FileNotFoundError:
+        return None
+    if len(header) != _list_header.size or not header.startswith(_list_magic):
+        return None
+    _, _, _, this_update, next_update = _list_header.unpack(header)
+    return (datetime.fromtimestamp(this_update, timezone.utc),
+            datetime.fromtimestamp(next_update, timezone.utc) if next_update else None)
+
+
+def _write_bloom(path, bloom_path, count):
+    """write the Bloom filter of the revoked-serial list at `path`"""
+    m = max(8, count * bloom_bits)
+    bits = bytearray((m + 7) // 8)
+    with open(path, 'rb') as f:
+        f.seek(_list_header.size)
+        for chunk in iter(lambda: f.read(serial_width * 4096), b''):
+            for i in range(0, len(chunk), serial_width):
+                for position in _bloom_positions(chunk[i:i + serial_width], m):
+                    bits[position >> 3] |= 1 << (position & 7)
+    with atomic_write(bloom_path) as f:
+        f.write(_bloom_header.pack(_bloom_magic, m, bloom_hashes))
+        f.write(bits)
+
+
+def ingest_crl(fileobj, directory, issuers, bloom=True, at=None):
+    """stream a CRL into the revoked-serial list of its issuer, replacing any previous list of the
+    issuer
+
+    Args:
+        fileobj(file-like, required):
+            binary file-like object holding the DER or PEM encoded CRL
+        directory(str, required):
+            the index directory; created if it does not exist
+        issuers(dict, required):
+            public keys of the trusted CRL issuers by subject hash; see `load_issuers`
+        bloom(bool, optional, default=True):
+            determines whether a Bloom filter is written in front of the list
+        at(datetime.datetime, optional, default=None):
+            time at which the CRL must be current; defaults to now
+
+    Returns:
+        tuple of the issuer hash and the number of revoked serial numbers
+
+    Raises:
+        ValueError: if the CRL cannot be read, is not current at `at`, is older than the CRL of the
+            issuer's list, or its signature does not verify against a key of `issuers`; the issuer's
+            list, if any, is left in place
+    """
+    at = at or datetime.now(timezone.utc)
+    crl = CRLReader(fileobj)
+    keys = issuers.get(crl.issuer, [])
+    if not keys:
+        raise ValueError('CRL issuer {} is not a trusted certificate'.format(crl.issuer))
+    if crl.this_update > at:
+        raise ValueError('CRL of issuer {} is not yet valid'.format(crl.issuer))
+    if crl.next_update is not None and crl.next_update < at:
+        raise ValueError('CRL of issuer {} has expired'.format(crl.issuer))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, crl.issuer + '.rsl')
+    previous = _list_updates(path)
+    if previous is not None and crl.this_update < previous[0]:
+        raise ValueError('CRL of issuer {} is older than the indexed CRL'.format(crl.issuer))
+
+    bloom_path = os.path.join(directory, crl.issuer + '.bloom')
+    with atomic_write(path) as f:
+        f.write(_list_header.pack(_list_magic, serial_width, 0, 0, 0))
+        count = 0
+        for key in _sorted_unique(crl.revoked()):
+            f.write(key)
+            count += 1
+        if not any(crl.verify(key) for key in keys):
+            # discards the staged list
+            raise ValueError('CRL signature of issuer {} does not verify'.format(crl.issuer))
+        f.seek(0)
+        this_update = int(crl.this_update.timestamp())
+        next_update = int(crl.next_update.timestamp()) if crl.next_update is not None else 0
+        f.write(_list_header.pack(_list_magic, serial_width, count, this_update, next_update))
+        f.flush()
+        # the Bloom filter is published before its list, so the list is never probed through a stale
+        # filter that rules out its serials
+        if bloom:
+            _write_bloom(f.name, bloom_path, count)
+        elif os.path.exists(bloom_path):
+            os.remove(bloom_path)
+    return crl.issuer, count
+
+
+class RevocationIndex(object):
+    """looks up serial numbers in the revoked-serial lists of an index directory
+
+    Lists and Bloom filters are memory mapped on first use per issuer; lookups are a Bloom filter
+    probe and, unless it rules the serial out, a binary search.
+
+    Args:
+        directory(str, required):
+            the index directory; see `ingest_crl`
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._issuers = {}
+        self._files = []
+
+    def _map(self, path):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        self._files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._files.append(m)
+        return m
+
+    def _load(self, issuer):
+        if issuer not in self._issuers:
+            serials = self._map(os.path.join(self.directory, issuer + '.rsl'))
+            bloom = self._map(os.path.join(self.directory, issuer + '.bloom'))
+            if serials is not None:
+                magic, width, count, this_update, next_update = _list_header.unpack_from(serials, 0)
+                if magic != _list_magic or width != serial_width:
+                    raise ValueError('Not a revoked-serial list: {}'.format(issuer))
+                serials = (serials, count, datetime.fromtimestamp(this_update, timezone.utc),
+                           datetime.fromtimestamp(next_update, timezone.utc)
+                           if next_update else None)
+            if bloom is not None:
+                magic, m, _ = _bloom_header.unpack_from(bloom, 0)
+                if magic != _bloom_magic:
+                    raise ValueError('Not a Bloom filter: {}'.format(issuer))
+                bloom = (bloom, m)
+            self._issuers[issuer] = (serials, bloom)
+        return self._issuers[issuer]
+
+    def has_issuer(self, issuer):
+        """check whether a CRL of an issuer was ingested
+
+        Args:
+            issuer(str, required):
+                the issuer hash; see `dodcerts.capath.issuer_hash`
+        """
+        return self._load(issuer)[0] is not None
+
+    def updates(self, issuer):
+        """get the thisUpdate and nextUpdate of the ingested CRL of an issuer
+
+        Args:
+            issuer(str, required):
+                the issuer hash; see `dodcerts.capath.issuer_hash`
+
+        Returns:
+            tuple of the thisUpdate and nextUpdate (None if unspecified) as timezone aware
+            `datetime.datetime`s, or None if no CRL of the issuer was ingested
+        """
+        serials = self._load(issuer)[0]
+        return None if serials is None else serials[2:]
+
+    def is_revoked(self, issuer, serial):
+        """check whether a serial number is revoked by an issuer
+
+        Args:
+            issuer(str, required):
+                the issuer hash; see `dodcerts.capath.issuer_hash`
+            serial(bytes or int, required):
+                the serial number; see `serial_key`
+
+        Returns:
+            whether the serial number is in the issuer's revoked-serial list (False if no CRL of the
+            issuer was ingested)
+        """
+        serials, bloom = self._load(issuer)
+        if serials is None:
+            return False
+        key = serial_key(serial)
+        if bloom is not None:
+            bits, m = bloom
+            offset = _bloom_header.size
+            if not all([bits[offset + (position >> 3)] & (1 << (position & 7))
+                        for position in _bloom_positions(key, m)]):
+                return False
+        data, count = serials[:2]
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = _list_header.size + mid * serial_width
+            value = data[start:start + serial_width]
+            if value == key:
+                return True
+            if value < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return False
+
+    def close(self):
+        for f in reversed(self._files):
+            f.close()
+        self._files = []
+        self._issuers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,80 @@
+"""minimal reader for DER encoded X.509 certificates
+
+Only locates the names of a certificate, so that their OpenSSL hashes (see `dodcerts.capath`) are
+computed from the encoding itself; every other field is read through `cryptography`.
+"""
+import base64
+
+_tbs_fields = ['version', 'serial', 'signature', 'issuer', 'validity', 'subject', 'spki']
+
+
+def read(data, offset):
+    """read the header of the DER element starting at `offset`
+
+    Returns:
+        tuple of the element's tag, the offset of its contents, and the offset of its end
+    """
+    tag = data[offset]
+    length = data[offset + 1]
+    start = offset + 2
+    if length & 0x80:
+        n = length & 0x7f
+        length = int.from_bytes(data[start:start + n], 'big')
+        start += n
+    return tag, start, start + length
+
+
+def children(data, start, end):
+    """iterate over the elements within data[start:end]
+
+    Yields:
+        tuple of each element's tag, the offset of its contents, the offset of the element, and the
+        offset of its end
+    """
+    offset = start
+    while offset < end:
+        tag, contents, stop = read(data, offset)
+        yield tag, contents, offset, stop
+        offset = stop
+
+
+def encode(tag, contents):
+    """encode a DER element"""
+    length = len(contents)
+    if length < 0x80:
+        return bytes([tag, length]) + contents
+    encoded = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([tag, 0x80 | len(encoded)]) + encoded + contents
+
+
+def pem_to_der(pem):
+    """decode a PEM encoded certificate
+
+    Args:
+        pem(bytes, required):
+            the PEM encoded certificate, any text around the PEM block is ignored
+
+    Returns:
+        the DER encoded certificate
+    """
+    start = pem.index(b'-----BEGIN CERTIFICATE-----')
+    end = pem.index(b'-----END CERTIFICATE-----', start)
+    return base64.b64decode(b''.join(pem[start:end].splitlines()[1:]))
+
+
+def tbs_fields(der):
+    """locate the fields of the TBSCertificate of a DER encoded certificate
+
+    Args:
+        der(bytes, required):
+            the DER encoded certificate
+
+    Returns:
+        dictionary of field name (`serial`, `signature`, `issuer`, `validity`, `subject`, `spki`
+        and, if present, `version`) to a tuple of the offsets of its contents start and end
+    """
+    _, cert_start, _ = read(der, 0)
+    _, tbs_start, tbs_end = read(der, cert_start)
+    elements = list(children(der, tbs_start, tbs_end))
+    names = _tbs_fields if elements[0][0] == 0xa0 else _tbs_fields[1:]
+    return {name: (start, end) for name, (_, start, _, end) in zip(names, elements)}
@@ -0,0 +1,318 @@
+"""sidecar offset index for random access into a PEM bundle
+
+The index (`<bundle>.idx`) is a compact binary file:
+
+* a header: magic, number of certificates, and the size and SHA-256 of the records of the indexed
+  bundle (see `dodcerts.create.bundle_digest`)
+* one fixed-width row per certificate, sorted by SHA-256 fingerprint: fingerprint, OpenSSL subject
+  hash, SHA-1 of the subject key identifier, expiry (seconds since the epoch), and the offset and
+  length of its record in the bundle
+* three arrays of row numbers ordering the rows by subject hash, subject key identifier and expiry
+
+so that lookups are binary searches over the memory mapped index and only the requested records are
+read from the memory mapped bundle.
+"""
+import os
+
+import hashlib
+import mmap
+import struct
+
+from datetime import datetime, timezone
+
+from .atomic import atomic_write
+from .capath import subject_hash
+from .certs import key_identifiers, load_cert
+from .der import pem_to_der
+
+_magic = b'DODIDX2\n'
+_header = struct.Struct('<8sIQ32s')
+_row = struct.Struct('<32s4s20sqQI')
+_position = struct.Struct('<I')
+
+_no_ski = bytes(20)
+
+# header line of a bundle holding the SHA-256 of its records (everything after the header)
+digest_prefix = b'# Bundle Digest: sha256:'
+
+
+def index_path(bundle):
+    """get the pathname of the index of a bundle
+
+    Args:
+        bundle(str, required):
+            pathname of the bundle
+
+    Returns:
+        pathname of the index
+    """
+    return os.fspath(bundle) + '.idx'
+
+
+def _ski_key(ski):
+    return hashlib.sha1(ski).digest() if ski is not None else _no_ski
+
+
+def index_row(cert, offset, length):
+    """compute the index row of a certificate
+
+    Args:
+        cert(cryptography.x509.Certificate, required):
+            the certificate
+        offset(int, required):
+            offset of the certificate's record in the bundle
+        length(int, required):
+            length of the certificate's record in the bundle
+
+    Returns:
+        the row as a tuple
+    """
+    from cryptography.hazmat.primitives.serialization import Encoding
+
+    der = cert.public_bytes(Encoding.DER)
+    return (
+        hashlib.sha256(der).digest(),
+        bytes.fromhex(subject_hash(der)),
+        _ski_key(key_identifiers(cert)[0]),
+        int(cert.not_valid_after_utc.timestamp()),
+        offset,
+        length,
+    )
+
+
+def _records_digest(f):
+    """get the SHA-256 of the records of a bundle, from its digest header line if it has one, else
+    by hashing them
+
+    Args:
+        f(file-like, required):
+            binary file-like object (e.g. a memory map) positioned at the start of the bundle
+
+    Returns:
+        the digest as bytes
+    """
+    digest = hashlib.sha256()
+    for line in iter(f.readline, b''):
+        if line.startswith(digest_prefix):
+            return bytes.fromhex(line[len(digest_prefix):].decode())
+        if not line.startswith(b'# Bundle '):
+            digest.update(line)
+            break
+    for chunk in iter(lambda: f.read(64 * 1024), b''):
+        digest.update(chunk)
+    return digest.digest()
+
+
+def _scan(contents):
+    """locate the records of a bundle
+
+    Yields:
+        tuple of the DER encoded certificate, and the offset and length of its record
+    """
+    end_marker = b'-----END CERTIFICATE-----\n'
+    # records follow the header lines ("# Bundle Created", "# Bundle Digest")
+    start = 0
+    while contents.startswith(b'# Bundle ', start):
+        start = contents.index(b'\n', start) + 1
+    end = contents.find(end_marker, start)
+    while end > -1:
+        end += len(end_marker)
+        yield pem_to_der(contents[start:end]), start, end - start
+        start = end
+        end = contents.find(end_marker, start)
+
+
+def write_index(bundle, rows=None):
+    """write the index of a bundle
+
+    Args:
+        bundle(str, required):
+            pathname of the bundle
+        rows(iterable, optional, default=None):
+            iterable of rows (see `index_row`) of the certificates in the bundle; by default the
+            bundle is scanned, skipping certificates that cannot be loaded
+
+    Returns:
+        pathname of the index
+    """
+    if rows is None:
+        with open(bundle, 'rb') as f:
+            rows = []
+            for der, offset, length in _scan(f.read()):
+                try:
+                    rows.append(index_row(load_cert(der), offset, length))
+                except ValueError:
+                    continue
+    rows = sorted(rows)
+    n = len(rows)
+    orders = [
+        sorted(range(n), key=lambda i: (rows[i][1], rows[i][4])),
+        sorted(range(n), key=lambda i: (rows[i][2], rows[i][4])),
+        sorted(range(n), key=lambda i: (rows[i][3], rows[i][4])),
+    ]
+
+    with open(bundle, 'rb') as f:
+        digest = _records_digest(f)
+        size = os.fstat(f.fileno()).st_size
+
+    path = index_path(bundle)
+    with atomic_write(path) as f:
+        f.write(_header.pack(_magic, n, size, digest))
+        for row in rows:
+            f.write(_row.pack(*row))
+        for order in orders:
+            f.write(b''.join([_position.pack(i) for i in order]))
+    return path
+
+
+class BundleIndex(object):
+    """random access to the certificates of a bundle through its index
+
+    The bundle and its index are memory mapped; lookups are binary searches and only the requested
+    records are read.
+
+    Args:
+        bundle(str, optional, default=None):
+            pathname of the bundle; defaulted to `dodcerts.where()`
+
+    Raises:
+        ValueError: if the index is not a bundle index or does not match the bundle (its size or the
+            digest of its records differ from those indexed)
+    """
+
+    def __init__(self, bundle=None):
+        if bundle is None:
+            from .bundle import where
+            bundle = where()
+        self.bundle = os.fspath(bundle)
+        self._files = []
+        try:
+            self._index = self._map(index_path(self.bundle))
+            self._records = self._map(self.bundle)
+            magic, self._count, size, digest = _header.unpack_from(self._index, 0)
+            if magic != _magic:
+                raise ValueError('Not a bundle index: {}'.format(index_path(self.bundle)))
+            if size != len(self._records) or digest != _records_digest(self._records):
+                raise ValueError('Index does not match the bundle: {}'.format(self.bundle))
+            self._records.seek(0)
+        except BaseException:
+            self.close()
+            raise
+        self._rows = _header.size
+        self._orders = self._rows + self._count * _row.size
+
+    def _map(self, path):
+        f = open(path, 'rb')
+        self._files.append(f)
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._files.append(m)
+        return m
+
+    def close(self):
+        for f in reversed(self._files):
+            f.close()
+        self._files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def _get_row(self, i):
+        return _row.unpack_from(self._index, self._rows + i * _row.size)
+
+    def _ordered_row(self, order, i):
+        position = self._orders + (order * self._count + i) * _position.size
+        return self._get_row(_position.unpack_from(self._index, position)[0])
+
+    def _bisect(self, get, key):
+        # first position whose key is not less than `key`
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if get(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _read(self, row):
+        return self._records[row[4]:row[4] + row[5]]
+
+    def _find(self, order, field, key):
+        records = []
+        i = self._bisect(lambda j: self._ordered_row(order, j)[field], key)
+        while i < self._count:
+            row = self._ordered_row(order, i)
+            if row[field] != key:
+                break
+            records.append(self._read(row))
+            i += 1
+        return records
+
+    def get(self, fingerprint):
+        """get the record of a certificate by SHA-256 fingerprint
+
+        Args:
+            fingerprint(str or bytes, required):
+                the fingerprint as a hex string or 32 bytes
+
+        Returns:
+            the record as bytes or None if the certificate is not in the bundle
+        """
+        if isinstance(fingerprint, str):
+            fingerprint = bytes.fromhex(fingerprint.replace(':', ''))
+        i = self._bisect(lambda j: self._get_row(j)[0], fingerprint)
+        if i < self._count:
+            row = self._get_row(i)
+            if row[0] == fingerprint:
+                return self._read(row)
+        return None
+
+    def __contains__(self, fingerprint):
+        return self.get(fingerprint) is not None
+
+    def find_subject_hash(self, value):
+        """get the records of the certificates with an OpenSSL subject hash
+
+        Args:
+            value(str, required):
+                the subject hash as 8 hexadecimal characters; see `dodcerts.capath.subject_hash`
+
+        Returns:
+            list of records as bytes, in the order of the bundle
+        """
+        return self._find(0, 1, bytes.fromhex(value))
+
+    def find_ski(self, ski):
+        """get the records of the certificates with a subject key identifier
+
+        Args:
+            ski(bytes, required):
+                the subject key identifier
+
+        Returns:
+            list of records as bytes, in the order of the bundle
+        """
+        return self._find(1, 2, _ski_key(ski))
+
+    def expiring(self, before=None):
+        """iterate over the certificates by expiry, soonest first
+
+        Args:
+            before(datetime.datetime, optional, default=None):
+                if specified, only certificates expiring before this time are yielded
+
+        Yields:
+            tuple of the expiry as a timezone aware `datetime.datetime` and the record as bytes
+        """
+        for i in range(self._count):
+            row = self._ordered_row(2, i)
+            expires = datetime.fromtimestamp(row[3], tz=timezone.utc)
+            if before is not None and expires >= before:
+                break
+            yield expires, self._read(row)
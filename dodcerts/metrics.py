@@ -0,0 +1,147 @@
+"""structured instrumentation of the bundle pipeline
+
+The functions of `dodcerts.create` accept an `observer`, a callable receiving an `Event` as each
+stage of the pipeline completes for a resource, file or bundle:
+
+* `fetch` (source: url): `bytes` retrieved and `seconds` taken
+* `extract` (source: url): number of `certificates` read from the resource and `seconds` taken
+* `parse` (source: file name): `seconds` taken, whether the certificate `failed` to load and whether
+  its record was `reused` from a previous bundle or the parse cache (in which case `seconds` is 0)
+* `write` (source: bundle pathname): number of `certificates`, `duplicates` dropped and `bytes`
+  written, and `seconds` taken from staging the bundle to publishing it, index and manifest included
+
+Events are delivered from the calling thread, in pipeline order. `Metrics` is an observer
+aggregating the events, which `write_textfile` exports for the Prometheus node exporter's textfile
+collector.
+"""
+from collections import namedtuple
+
+from .atomic import atomic_write
+
+# an event of the pipeline: the `stage`, the `source` it concerns and a dictionary of measured
+# `values`
+Event = namedtuple('Event', ['stage', 'source', 'values'])
+
+
+def observe(observer, stage, source, **values):
+    """deliver an `Event` to `observer`, if any"""
+    if observer is not None:
+        observer(Event(stage, source, values))
+
+
+class Metrics(object):
+    """an observer aggregating the events of the pipeline
+
+    Attributes:
+        fetches(dict):
+            url to a dictionary of the `bytes` and `seconds` of its retrieval
+        extractions(dict):
+            url to a dictionary of the `certificates` and `seconds` of its extraction
+        parsed(int):
+            number of files parsed (excluding reused records)
+        reused(int):
+            number of files whose records were reused
+        failures(list):
+            names of the files that failed to load
+        parse_seconds(float):
+            total time spent parsing
+        slowest_parse(tuple):
+            the (seconds, file name) of the slowest parse
+        writes(dict):
+            bundle pathname to a dictionary of the `certificates`, `duplicates`, `bytes` and
+            `seconds` of its write
+    """
+
+    def __init__(self):
+        self.fetches = {}
+        self.extractions = {}
+        self.parsed = 0
+        self.reused = 0
+        self.failures = []
+        self.parse_seconds = 0.0
+        self.slowest_parse = (0.0, None)
+        self.writes = {}
+
+    def __call__(self, event):
+        if event.stage == 'fetch':
+            self.fetches[event.source] = event.values
+        elif event.stage == 'extract':
+            self.extractions[event.source] = event.values
+        elif event.stage == 'parse':
+            if event.values['reused']:
+                self.reused += 1
+            else:
+                self.parsed += 1
+                self.parse_seconds += event.values['seconds']
+                self.slowest_parse = max(self.slowest_parse,
+                                         (event.values['seconds'], event.source),
+                                         key=lambda item: item[0])
+            if event.values['failed']:
+                self.failures.append(event.source)
+        elif event.stage == 'write':
+            self.writes[event.source] = event.values
+
+    def samples(self):
+        """get the aggregated metrics as Prometheus samples
+
+        Yields:
+            tuple of the metric name, its help text, its type, and a list of (labels dictionary,
+            value) samples
+        """
+        yield ('dodcerts_fetch_bytes', 'Bytes retrieved per resource.', 'gauge',
+               [({'url': url}, values['bytes']) for url, values in self.fetches.items()])
+        yield ('dodcerts_fetch_seconds', 'Time taken to retrieve each resource.', 'gauge',
+               [({'url': url}, values['seconds']) for url, values in self.fetches.items()])
+        yield ('dodcerts_extract_certificates', 'Certificates read per resource.', 'gauge',
+               [({'url': url}, values['certificates']) for url, values in self.extractions.items()])
+        yield ('dodcerts_extract_seconds', 'Time taken to extract each resource.', 'gauge',
+               [({'url': url}, values['seconds']) for url, values in self.extractions.items()])
+        yield ('dodcerts_parse_files', 'Files parsed, or whose records were reused.', 'gauge',
+               [({'reused': 'false'}, self.parsed), ({'reused': 'true'}, self.reused)])
+        yield ('dodcerts_parse_failures', 'Files that failed to load as certificates.', 'gauge',
+               [({}, len(self.failures))])
+        yield ('dodcerts_parse_seconds', 'Total time spent parsing certificates.', 'gauge',
+               [({}, self.parse_seconds)])
+        yield ('dodcerts_parse_seconds_max', 'Time taken by the slowest parse.', 'gauge',
+               [({}, self.slowest_parse[0])])
+        for name, help_text in [('certificates', 'Certificates written per bundle.'),
+                                ('duplicates', 'Duplicate certificates dropped per bundle.'),
+                                ('bytes', 'Bytes written per bundle.'),
+                                ('seconds', 'Time taken to write each bundle.')]:
+            yield ('dodcerts_write_' + name, help_text, 'gauge',
+                   [({'bundle': bundle}, values[name]) for bundle, values in self.writes.items()])
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def write_textfile(path, metrics):
+    """export metrics in the Prometheus text exposition format
+
+    The file is written to a temporary file alongside `path` and moved into place, so the node
+    exporter's textfile collector never reads a partial file.
+
+    Args:
+        path(str, required):
+            pathname of the exported file, conventionally with a `.prom` extension
+        metrics(Metrics, required):
+            the metrics to export
+
+    Returns:
+        the pathname of the exported file
+    """
+    lines = []
+    for name, help_text, kind, samples in metrics.samples():
+        if not samples:
+            continue
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in samples:
+            label_text = ','.join(['{}="{}"'.format(k, _escape(v))
+                                   for k, v in sorted(labels.items())])
+            lines.append('{}{} {}'.format(name, '{' + label_text + '}' if label_text else '',
+                                          repr(float(value))))
+    with atomic_write(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
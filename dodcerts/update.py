@@ -0,0 +1,310 @@
+"""decide whether a bundle needs to be rebuilt before downloading its resources
+
+The resources of a bundle are checked against those it was built from, as recorded in its manifest
+when it was published (see `dodcerts.create.create_pem_bundle`), from cheapest to most expensive
+evidence, stopping at the first conclusive one:
+
+1. HTTP validators: an unchanged ETag, or unchanged Last-Modified and Content-Length, from a HEAD
+   request
+2. zip central directory: the names, CRC-32s and sizes of the certificate members of a zip archive,
+   read with HTTP range requests (a few kilobytes at the end of the archive), so a re-packed archive
+   of the same certificates is unchanged
+3. certificate fingerprints: the resource is retrieved and the SHA-256 fingerprint of each
+   certificate it holds (of its DER encoding, so a certificate re-encoded as PEM is unchanged) is
+   compared with those of the bundled copy
+
+The bundled copy is read from the download cache (see `dodcerts.cache`), and only if it is the copy
+the bundle was built from: a cache updated by a build that was not published, or by another bundle,
+is no evidence for this one. Only resources whose certificates changed require the bundle to be
+rebuilt.
+
+Checks are read-only. When `update_bundle` finds the certificates unchanged without the HTTP
+validators, it records the current validators in the manifest, so that the next check is settled by
+them.
+"""
+import os
+
+from collections import namedtuple
+
+from .cache import DownloadCache
+from .create import Resource, bundle_digest, cert_exts, create_pem_bundle, log, parse_cert
+from .create import _init_logging, _iter_members, _load_manifest, _open_resource, _write_manifest
+
+# outcome of checking a resource: whether its certificates `changed` and the evidence (`reason`)
+# that decided it
+Check = namedtuple('Check', ['url', 'changed', 'reason'])
+
+# bytes read from the end of a zip archive at once: its end of central directory record, with the
+# longest comment
+tail_size = 22 + 0xffff
+
+
+class _NoRanges(Exception):
+    """the server does not honor range requests"""
+
+
+class _RemoteFile(object):
+    """a read-only, seekable file over HTTP range requests, enough for `zipfile` to read a central
+    directory
+
+    The end of the file is fetched once, up front, as zip readers start from there.
+    """
+
+    def __init__(self, url, size):
+        self.url = url
+        self.size = size
+        self.position = 0
+        self.tail_start = max(0, size - tail_size)
+        self.tail = self._fetch(self.tail_start, size - 1)
+
+    def _fetch(self, start, end):
+        from urllib.request import Request, urlopen
+
+        request = Request(self.url, headers={'Range': 'bytes={}-{}'.format(start, end)})
+        with urlopen(request) as response:
+            if response.status != 206:
+                raise _NoRanges(self.url)
+            return response.read()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, n=-1):
+        end = self.size if n is None or n < 0 else min(self.size, self.position + n)
+        if self.position >= end:
+            return b''
+        if self.position >= self.tail_start:
+            data = self.tail[self.position - self.tail_start:end - self.tail_start]
+        else:
+            data = self._fetch(self.position, end - 1)
+        self.position += len(data)
+        return data
+
+
+def _zip_members(fileobj):
+    """get the (CRC-32, size) of each certificate member of a zip archive by name, from its central
+    directory only"""
+    import zipfile
+
+    with zipfile.ZipFile(fileobj) as z:
+        return {info.filename: (info.CRC, info.file_size) for info in z.infolist()
+                if not info.is_dir() and any([info.filename.endswith(ext) for ext in cert_exts])}
+
+
+def _fingerprints(resource, fileobj):
+    """get the sorted SHA-256 fingerprints of the certificates of a resource; files that are not
+    certificates are skipped"""
+    certs = [parse_cert(contents) for _, contents in _iter_members(resource, fileobj)]
+    return sorted({cert.fingerprint for cert in certs if cert is not None})
+
+
+def _validators(url):
+    """get the validators of a resource from a HEAD request
+
+    Returns:
+        dictionary of the `etag`, `last_modified` and `size` (None if unknown), and whether the
+        server advertises range requests (`ranges`)
+    """
+    from urllib.error import URLError
+    from urllib.request import Request, urlopen
+
+    try:
+        with urlopen(Request(url, method='HEAD')) as response:
+            headers = response.headers
+    except (URLError, ValueError):
+        # e.g. HEAD is not allowed, the validators are unknown
+        return {'etag': None, 'last_modified': None, 'size': None, 'ranges': False}
+    size = headers.get('Content-Length')
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'size': int(size) if size is not None else None,
+        'ranges': headers.get('Accept-Ranges') == 'bytes',
+    }
+
+
+def _check_resource(url, cache, bundled):
+    """check a resource; see `check_resource`
+
+    Returns:
+        tuple of the `Check` and, if the certificates are unchanged but the HTTP validators of the
+        resource are not, a dictionary of its current `etag` and `last_modified`, else None
+    """
+    import zipfile
+    from urllib.parse import urlparse
+    from urllib.request import url2pathname
+
+    if bundled is None:
+        return Check(url, True, 'not bundled'), None
+
+    validators = _validators(url)
+    if validators['etag'] is not None and validators['etag'] == bundled.get('etag'):
+        return Check(url, False, 'etag unchanged'), None
+    if validators['etag'] is None and validators['last_modified'] is not None and \
+            (validators['last_modified'], validators['size']) == \
+            (bundled.get('last_modified'), bundled['size']):
+        return Check(url, False, 'last-modified unchanged'), None
+    current = {'etag': validators['etag'], 'last_modified': validators['last_modified']}
+
+    metadata = cache.load(url)
+    payload = None
+    if metadata is not None and metadata['sha256'] == bundled['sha256']:
+        payload = cache.payload_path(url)
+    if payload is not None:
+        with open(payload, 'rb') as f:
+            if zipfile.is_zipfile(f):
+                f.seek(0)
+                cached = _zip_members(f)
+                parsed = urlparse(url)
+                try:
+                    if parsed.scheme == 'file':
+                        with open(url2pathname(parsed.path), 'rb') as remote:
+                            members = _zip_members(remote)
+                    elif validators['size'] is not None and validators['ranges']:
+                        members = _zip_members(_RemoteFile(url, validators['size']))
+                    else:
+                        members = None
+                except (_NoRanges, zipfile.BadZipFile):
+                    members = None
+                if members is not None:
+                    if members == cached:
+                        return Check(url, False, 'archive members unchanged'), current
+                    return Check(url, True, 'archive members changed'), None
+
+    # no cheaper evidence, compare the certificates themselves
+    resource, fileobj = _open_resource(url)
+    with fileobj:
+        if resource.sha256 == bundled['sha256']:
+            return Check(url, False, 'content unchanged'), current
+        if payload is None:
+            return Check(url, True, 'content changed (bundled copy not cached)'), None
+        fingerprints = _fingerprints(resource, fileobj)
+    with open(payload, 'rb') as f:
+        if fingerprints != _fingerprints(Resource(url, bundled['size'], bundled['sha256']), f):
+            return Check(url, True, 'certificates changed'), None
+    return Check(url, False, 'certificates unchanged'), current
+
+
+def check_resource(url, cache, bundled):
+    """check whether the certificates of a resource changed since a bundle was built from it
+
+    Nothing is written: neither the cache nor the bundle's manifest.
+
+    Args:
+        url(str, required):
+            url of the resource
+        cache(DownloadCache, required):
+            the download cache the bundle was built with
+        bundled(dict, required):
+            the resource as recorded in the manifest of the bundle (the fields of a
+            `dodcerts.create.Resource`), or None if the bundle was not built from it
+
+    Returns:
+        the `Check`
+    """
+    return _check_resource(url, cache, bundled)[0]
+
+
+def _bundled_resources(destination):
+    """get the resources recorded in the manifest of a bundle, by url
+
+    Returns:
+        tuple of the manifest (None if the bundle or its manifest are missing or inconsistent) and a
+        dictionary of url to resource; see `dodcerts.create._write_manifest`
+    """
+    manifest = _load_manifest(destination)
+    if manifest is None:
+        return None, {}
+    return manifest, {resource['url']: resource for resource in manifest.get('resources', [])}
+
+
+def _check_all(urls, cache_dir, destination, max_workers=None):
+    from concurrent.futures import ThreadPoolExecutor
+
+    if isinstance(urls, str):
+        urls = [urls, ]
+    cache = DownloadCache(cache_dir)
+    manifest, bundled = _bundled_resources(destination)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_check_resource, urls, [cache] * len(urls),
+                                    [bundled.get(url) for url in urls]))
+    return manifest, results
+
+
+def check_resources(urls, cache_dir, destination, max_workers=None):
+    """check whether the certificates of resources changed since a bundle was built from them; see
+    `check_resource`
+
+    Args:
+        urls(iterable, required):
+            iterable of urls as strings
+        cache_dir(str, required):
+            location of the download cache the bundle was built with (see `create_pem_bundle`)
+        destination(str, required):
+            pathname of the bundle
+        max_workers(int, optional, default=None):
+            maximum number of resources checked concurrently
+
+    Returns:
+        list of the `Check` of each resource, in the order of `urls`
+    """
+    results = _check_all(urls, cache_dir, destination, max_workers=max_workers)[1]
+    return [check for check, _ in results]
+
+
+def update_bundle(destination, urls, cache_dir, check=False, capath=None, max_workers=None):
+    """rebuild a bundle only if the certificates of its resources changed
+
+    The bundle is rebuilt if it has no manifest, if its resources are not those of `urls`, or if the
+    certificates of any of them changed. With `check`, nothing is written.
+
+    Args:
+        destination(str, required):
+            pathname of the bundle
+        urls(iterable, required):
+            iterable of urls of the bundle's resources as strings
+        cache_dir(str, required):
+            location of the download cache; passed to `create_pem_bundle`
+        check(bool, optional, default=False):
+            determines whether only the checks are made, without rebuilding the bundle
+        capath(str, optional, default=None):
+            passed to `create_pem_bundle`
+        max_workers(int, optional, default=None):
+            maximum number of resources checked and fetched concurrently
+
+    Returns:
+        tuple of whether the bundle was (or, with `check`, needs to be) updated and the list of
+        `Check` of each resource
+    """
+    _init_logging()
+    if isinstance(urls, str):
+        urls = [urls, ]
+    manifest, results = _check_all(urls, cache_dir, destination, max_workers=max_workers)
+    checks = [c for c, _ in results]
+    # a resource dropped from `urls` is no longer checked, but its certificates are still bundled
+    needed = manifest is None or any([c.changed for c in checks]) or \
+        set(urls) != set([resource['url'] for resource in manifest['resources']])
+    for c in checks:
+        log.info('Checked resource: {} ({})'.format(c.url, c.reason))
+    if check or not needed:
+        refreshed = {c.url: validators for c, validators in results if validators is not None}
+        if not check and refreshed:
+            # the certificates are unchanged, record the current validators so the next check is
+            # settled by them
+            for resource in manifest['resources']:
+                resource.update(refreshed.get(resource['url'], {}))
+            _write_manifest(destination, manifest['entries'], manifest['resources'])
+        return needed, checks
+
+    previous = bundle_digest(destination) if os.path.exists(destination) else None
+    create_pem_bundle(destination, urls=urls, set_env_var=False, max_workers=max_workers,
+                      cache_dir=cache_dir, capath=capath)
+    return bundle_digest(destination) != previous, checks
@@ -0,0 +1,315 @@
+"""batch validation of certificate chains against the DoD Certificate chain
+
+The bundle is loaded and indexed by subject and subject key identifier once per `Verifier`;
+signature checks between certificates are memoized so that the checks of shared intermediates and
+roots are performed once across all of the certificates validated. With a revoked-serial index (see
+`dodcerts.crl`), each certificate of a chain is also checked against the CRL of its issuer; a
+certificate whose issuer has no current CRL in the index fails validation, since its revocation
+status is unknown.
+
+Issuers must be CA certificates: their basic constraints must allow them to issue certificates, as
+deep in the chain as they are found, and their key usage, when they have one, must include
+certificate signing. Certificates with a critical extension that is not enforced here are invalid,
+whether they are issued or issuers.
+"""
+import os
+
+import logging
+
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from . import der as _der
+from .capath import issuer_hash, subject_hash
+from .certs import cert_exts, key_identifiers, load_cert
+
+log = logging.getLogger('dod-certs')
+
+# maximum number of issuers followed from a certificate to a root
+max_depth = 10
+
+# result of validating a certificate: `chain` lists the subjects of the validated path, from the
+# certificate to the root, and `error` describes why validation failed (None if `valid`)
+Result = namedtuple('Result', ['source', 'valid', 'chain', 'error'])
+
+# extensions which may be critical: those enforced while building chains, and those which constrain
+# the use of the certificate rather than its validity (alternative names and extended key usage)
+handled_extensions = {
+    '2.5.29.19',  # basic constraints
+    '2.5.29.15',  # key usage
+    '2.5.29.14',  # subject key identifier
+    '2.5.29.35',  # authority key identifier
+    '2.5.29.17',  # subject alternative name
+    '2.5.29.37',  # extended key usage
+}
+
+
+class _Cert(object):
+    """a parsed certificate with the fields used to build chains"""
+    __slots__ = ['cert', 'der', 'fingerprint', 'subject', 'issuer', 'ski', 'aki', 'ca',
+                 'path_length', 'cert_sign', 'unhandled']
+
+    def __init__(self, cert):
+        import hashlib
+        from cryptography.hazmat.primitives.serialization import Encoding
+
+        self.cert = cert
+        self.der = cert.public_bytes(Encoding.DER)
+        self.fingerprint = hashlib.sha256(self.der).digest()
+        self.subject = subject_hash(self.der)
+        self.issuer = issuer_hash(self.der)
+        self.ski, self.aki = key_identifiers(cert)
+        self.ca, self.path_length, self.cert_sign, self.unhandled = _constraints(cert)
+
+    @property
+    def name(self):
+        return self.cert.subject.rfc4514_string()
+
+
+def _constraints(cert):
+    """read the extensions of a certificate which constrain the chains it is part of
+
+    Returns:
+        tuple of whether the certificate is a CA, its path length constraint (None if
+        unconstrained), whether its key may sign certificates, and whether it has a critical
+        extension not in `handled_extensions` (or its extensions cannot be read)
+    """
+    from cryptography import x509
+
+    try:
+        extensions = cert.extensions
+    except ValueError:
+        return False, None, False, True
+    try:
+        constraints = extensions.get_extension_for_class(x509.BasicConstraints).value
+        ca, path_length = constraints.ca, constraints.path_length
+    except x509.ExtensionNotFound:
+        ca, path_length = False, None
+    try:
+        cert_sign = extensions.get_extension_for_class(x509.KeyUsage).value.key_cert_sign
+    except x509.ExtensionNotFound:
+        cert_sign = True
+    unhandled = any([e.critical and e.oid.dotted_string not in handled_extensions
+                     for e in extensions])
+    return ca, path_length, cert_sign, unhandled
+
+
+def _load(contents):
+    return _Cert(load_cert(contents))
+
+
+class Verifier(object):
+    """validates certificate chains up to the roots of a bundle
+
+    Args:
+        bundle(str, optional, default=None):
+            pathname of the PEM bundle of trusted certificates; defaulted to `dodcerts.where()`
+        at(datetime.datetime, optional, default=None):
+            time at which the certificates must be valid; defaulted to now
+        crl_dir(str, optional, default=None):
+            if specified, the revoked-serial index (see `dodcerts.crl.ingest_crl`) against which
+            certificates are checked; certificates whose issuer has no CRL in the index, or whose
+            CRL is not current at `at`, are invalid
+    """
+
+    def __init__(self, bundle=None, at=None, crl_dir=None):
+        import re
+
+        if bundle is None:
+            from .bundle import where
+            bundle = where()
+        self.at = at or datetime.now(timezone.utc)
+        self._by_subject = {}
+        self._by_ski = {}
+        self._signatures = {}
+        self._revocations = None
+        if crl_dir is not None:
+            from .crl import RevocationIndex
+            self._revocations = RevocationIndex(crl_dir)
+
+        with open(bundle, 'rb') as f:
+            contents = f.read()
+        for pem in re.findall(rb'-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----', contents,
+                              re.DOTALL):
+            try:
+                cert = _load(pem)
+            except ValueError:
+                log.info('Unable to load bundled certificate with subject hash: {}'.format(
+                    subject_hash(_der.pem_to_der(pem))))
+                continue
+            self._by_subject.setdefault(cert.subject, []).append(cert)
+            if cert.ski is not None:
+                self._by_ski.setdefault(cert.ski, []).append(cert)
+        self._trusted = {cert.fingerprint for certs in self._by_subject.values() for cert in certs}
+
+    def _issuers(self, cert):
+        candidates = self._by_ski.get(cert.aki, []) if cert.aki is not None else []
+        candidates = [c for c in candidates if c.subject == cert.issuer]
+        return candidates or self._by_subject.get(cert.issuer, [])
+
+    def _signed_by(self, cert, issuer):
+        """check, once, that `issuer` signed `cert`"""
+        from cryptography.exceptions import InvalidSignature
+
+        key = (cert.fingerprint, issuer.fingerprint)
+        result = self._signatures.get(key)
+        if result is None:
+            try:
+                cert.cert.verify_directly_issued_by(issuer.cert)
+                result = True
+            except (InvalidSignature, TypeError, ValueError):
+                result = False
+            self._signatures[key] = result
+        return result
+
+    def _revocation_error(self, cert):
+        """check `cert` against the CRL of its issuer
+
+        Returns:
+            the error if the certificate is revoked or its revocation status is unknown, else None
+        """
+        if self._revocations is None:
+            return None
+        updates = self._revocations.updates(cert.issuer)
+        if updates is None:
+            return 'unable to get certificate CRL: {}'.format(cert.name)
+        this_update, next_update = updates
+        if this_update > self.at:
+            return 'CRL is not yet valid: {}'.format(cert.name)
+        if next_update is not None and next_update < self.at:
+            return 'CRL has expired: {}'.format(cert.name)
+        if self._revocations.is_revoked(cert.issuer, cert.cert.serial_number):
+            return 'certificate revoked: {}'.format(cert.name)
+        return None
+
+    def _current(self, cert):
+        return cert.cert.not_valid_before_utc <= self.at <= cert.cert.not_valid_after_utc
+
+    @staticmethod
+    def _issuer_error(issuer, intermediates):
+        """check that `issuer` may issue a certificate with `intermediates` CA certificates below it
+
+        Returns:
+            the error if it may not, else None
+        """
+        if not issuer.ca:
+            return 'invalid CA certificate: {}'.format(issuer.name)
+        if issuer.path_length is not None and intermediates > issuer.path_length:
+            return 'path length constraint exceeded: {}'.format(issuer.name)
+        if not issuer.cert_sign:
+            return 'key usage does not include certificate signing: {}'.format(issuer.name)
+        return None
+
+    def _build(self, cert, depth, seen):
+        """find a validated path from `cert` to a trusted root
+
+        Returns:
+            tuple of the path (list of `_Cert`, or None) and the error if no path was found
+        """
+        if not self._current(cert):
+            return None, 'certificate has expired or is not yet valid: {}'.format(cert.name)
+        if cert.unhandled:
+            return None, 'unhandled critical extension: {}'.format(cert.name)
+        if cert.subject == cert.issuer and cert.fingerprint in self._trusted:
+            return [cert], None
+        if depth >= max_depth:
+            return None, 'certificate chain too long'
+        error = self._revocation_error(cert)
+        if error is not None:
+            return None, error
+        error = 'unable to get local issuer certificate'
+        for issuer in self._issuers(cert):
+            if issuer.fingerprint in seen:
+                continue
+            if not self._signed_by(cert, issuer):
+                error = 'certificate signature failure'
+                continue
+            # the certificates below `issuer` other than the end certificate are the `depth`
+            # intermediates
+            issuer_error = self._issuer_error(issuer, depth)
+            if issuer_error is not None:
+                error = issuer_error
+                continue
+            path, issuer_error = self._build(issuer, depth + 1, seen | {issuer.fingerprint})
+            if path is not None:
+                return [cert] + path, None
+            error = issuer_error
+        return None, error
+
+    def verify(self, contents, source=None):
+        """validate the chain of a certificate
+
+        Args:
+            contents(bytes, required):
+                the DER or PEM encoded certificate
+            source(str, optional, default=None):
+                reported as the `source` of the result
+
+        Returns:
+            the `Result`
+        """
+        try:
+            cert = _load(contents)
+        except ValueError:
+            return Result(source, False, [], 'unable to load certificate')
+        path, error = self._build(cert, 0, {cert.fingerprint})
+        if path is None:
+            return Result(source, False, [], error)
+        return Result(source, True, [c.name for c in path], None)
+
+
+def _sources(paths):
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths, ]
+    for path in paths:
+        path = os.fspath(path)
+        if os.path.isdir(path):
+            for file in sorted(os.listdir(path)):
+                fpath = os.path.join(path, file)
+                if os.path.isfile(fpath) and any([file.endswith(ext) for ext in cert_exts]):
+                    yield fpath
+        else:
+            yield path
+
+
+def _verify_file(verifier, path):
+    try:
+        with open(path, 'rb') as f:
+            contents = f.read()
+    except OSError as e:
+        return Result(path, False, [], str(e))
+    return verifier.verify(contents, source=path)
+
+
+def verify_certificates(paths, bundle=None, at=None, workers=None, crl_dir=None):
+    """validate the chains of many certificates up to the roots of a bundle
+
+    Args:
+        paths(iterable, required):
+            pathname, or iterable of pathnames, of DER or PEM encoded certificates or of directories
+            of certificates
+        bundle(str, optional, default=None):
+            pathname of the PEM bundle of trusted certificates; defaulted to `dodcerts.where()`
+        at(datetime.datetime, optional, default=None):
+            time at which the certificates must be valid; defaulted to now
+        workers(int, optional, default=None):
+            number of threads validating certificates; defaulted to the
+            `concurrent.futures.ThreadPoolExecutor` default, 1 validates the certificates
+            sequentially
+        crl_dir(str, optional, default=None):
+            if specified, the revoked-serial index against which certificates are checked; passed to
+            `Verifier`
+
+    Yields:
+        the `Result` of each certificate, in the order of `paths`
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    verifier = Verifier(bundle=bundle, at=at, crl_dir=crl_dir)
+    sources = list(_sources(paths))
+    if workers == 1:
+        for path in sources:
+            yield _verify_file(verifier, path)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(_verify_file, [verifier] * len(sources), sources)
@@ -21,7 +21,7 @@ setup(
     url='https://github.com/erdc/dodcerts',
     license='BSD',
     packages=['dodcerts'],
-    package_data={'dodcerts': ['dod-ca-certs.pem'],},
+    package_data={'dodcerts': ['dod-ca-certs.pem', 'dod-ca-certs.pem.idx', 'dod-ca-certs/*'],},
     entry_points={'console_scripts': entry_points,},
     install_requires=requirements,
     keywords='dodcerts',
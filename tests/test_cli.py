@@ -1,22 +1,30 @@
 import pytest
 import re
+import subprocess
 import sys
 
 from argparse import ArgumentError
 from io import StringIO
+from pathlib import Path
 from unittest import mock
 
 from dodcerts import __version__
 
 help_msg = [
-    r'usage: .* \[-h\] \[-V\]\n',
+    r'usage: .* \[-h\] \[-V\] {create,verify,update} ...\n',
     r'\n',
     r'dodcerts is a tool that provides the DoD Certificate chain as a PEM bundle.\n',
     r'Returns path to file.\n',
     r'\n',
+    r'positional arguments:\n',
+    r'  {create,verify,update}\n',
+    r'    create              Create a PEM bundle from the specified resources.\n',
+    r'    verify              Validate certificate chains against the PEM bundle.\n',
+    r'    update              Rebuild a PEM bundle if its resources changed.\n',
+    r'\n',
     r'options:\n',
-    r'  -h, --help     Show this help message and exit.\n',
-    r'  -V, --version  Show the dodcerts version number and exit\n',
+    r'  -h, --help            Show this help message and exit.\n',
+    r'  -V, --version         Show the dodcerts version number and exit\n',
 ]
 
 ver_msg = ['dodcerts ' + __version__]
@@ -51,3 +59,75 @@ def test_parser(arg, output, regex):
             assert res.readline().find(line) == 0
     # check for end of output
     assert res.readline() == ''
+
+
+def test_create(tmp_path):
+    try:
+        from dodcerts.cli import cli
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+    bundlepath = tmp_path / 'bundle.pem'
+
+    argv = ['dodcerts', 'create', bundlepath.as_posix(), '--url', fpath.as_uri(), '--workers', '2']
+    with mock.patch('sys.argv', argv), mock.patch('sys.stdout', new_callable=StringIO):
+        cli()
+        res = sys.stdout.getvalue()
+    assert res == bundlepath.as_posix() + '\n'
+    with open(bundlepath, 'r') as f:
+        assert f.read().count('-----BEGIN CERTIFICATE-----') == 1
+
+
+def test_create_workers():
+    from dodcerts.cli import parse_args
+
+    args = ['create', 'bundle.pem', '--url', 'file:///DoDRoot5.cer']
+    assert parse_args(args + ['--workers', '0']).workers == 0
+    with mock.patch('sys.stderr', new_callable=StringIO):
+        with pytest.raises(SystemExit) as e:
+            parse_args(args + ['--workers', '-1'])
+        assert e.value.code == 2
+        assert 'argument -w/--workers: must be 0' in sys.stderr.getvalue()
+
+
+def test_update(tmp_path):
+    from dodcerts.cli import cli
+
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+    bundlepath = tmp_path / 'bundle.pem'
+    cache_dir = tmp_path / 'cache'
+
+    argv = ['dodcerts', 'update', bundlepath.as_posix(), '--url', fpath.as_uri(), '--cache-dir', cache_dir.as_posix()]
+    with mock.patch('sys.argv', argv + ['--check']), mock.patch('sys.stdout', new_callable=StringIO):
+        cli()
+        assert sys.stdout.getvalue() == fpath.as_uri() + ': changed (not bundled)\n'
+    assert not bundlepath.exists()
+
+    with mock.patch('sys.argv', argv), mock.patch('sys.stdout', new_callable=StringIO):
+        cli()
+    with open(bundlepath, 'r') as f:
+        assert f.read().count('-----BEGIN CERTIFICATE-----') == 1
+
+    # unchanged resources, the bundle is left as is
+    with mock.patch('sys.argv', argv), mock.patch('sys.stdout', new_callable=StringIO):
+        with pytest.raises(SystemExit) as e:
+            cli()
+        assert e.value.code == 1
+        assert sys.stdout.getvalue().startswith(fpath.as_uri() + ': unchanged (')
+
+
+def test_cli_import():
+    # locating the bundle from the console script loads neither argparse, the version, nor the bundle creation stack
+    code = (
+        "import sys\n"
+        "sys.argv = ['dodcerts']\n"
+        "from dodcerts.cli import cli\n"
+        "cli()\n"
+        "print(sorted(m for m in sys.modules if m.split('.')[0] in "
+        "['argparse', 'cryptography', 'dodcerts', 'subprocess', 'tarfile', 'urllib', 'zipfile']))\n"
+    )
+    res = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                         cwd=Path(__file__).parent.parent)
+    lines = res.stdout.decode().splitlines()
+    assert Path(lines[0]).name == 'dod-ca-certs.pem'
+    assert lines[1] == "['dodcerts', 'dodcerts.bundle', 'dodcerts.cli']"
@@ -1,14 +1,26 @@
+import hashlib
+import json
 import os
+import pytest
+import re
 import shutil
+import ssl
+import subprocess
+import sys
 
 import tarfile
 import tempfile
+import threading
 import zipfile
 
 from cryptography.hazmat.backends import default_backend
-from cryptography.x509 import load_der_x509_certificate
-from datetime import datetime
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509 import SubjectKeyIdentifier, load_der_x509_certificate, load_pem_x509_certificate
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
 from pathlib import Path
+from unittest import mock
 
 
 def test_where():
@@ -23,7 +35,11 @@ def test_where():
     assert filepath.exists()
     with open(filepath, 'r') as f:
         assert f.readline().find('# Bundle Created: ') == 0
-        assert f.readline().find('\n') == 0
+        line = f.readline()
+        if line.startswith('# Bundle Digest: '):
+            # bundles built since the digest was added to the header
+            line = f.readline()
+        assert line == '\n'
         assert f.readline().find('# Subject: ') == 0
         assert f.readline().find('# Issued by: ') == 0
         assert f.readline().find('# Signed with: ') == 0
@@ -43,6 +59,157 @@ def test_where():
         os.environ.pop('DOD_CA_CERTS_PEM_PATH')
 
 
+def test_ssl_context():
+    try:
+        from dodcerts import ssl_context
+        from dodcerts.create import create_pem_bundle
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+
+    env = os.environ.pop('DOD_CA_CERTS_PEM_PATH', None)
+    try:
+        # the shipped bundle's context is built once and shared
+        context = ssl_context()
+        assert context is ssl_context()
+        assert context.cert_store_stats()['x509_ca'] > 1
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # a new bundle path gets its own context
+            bundlepath = Path(tmpdir) / 'bundle.pem'
+            create_pem_bundle(destination=bundlepath.as_posix(), urls=[fpath.as_uri()], set_env_var=True)
+            bundle_context = ssl_context()
+            assert bundle_context is not context
+            assert bundle_context.cert_store_stats()['x509_ca'] == 1
+            assert bundle_context is ssl_context()
+
+            # modifying the bundle rebuilds the context
+            st = os.stat(bundlepath)
+            os.utime(bundlepath, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+            assert ssl_context() is not bundle_context
+    finally:
+        if env is not None:
+            os.environ['DOD_CA_CERTS_PEM_PATH'] = env
+        else:
+            os.environ.pop('DOD_CA_CERTS_PEM_PATH', None)
+
+
+def test_cadata():
+    try:
+        from dodcerts import cadata, where
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+    with open(fpath, 'rb') as f:
+        der = f.read()
+
+    env = os.environ.pop('DOD_CA_CERTS_PEM_PATH', None)
+    try:
+        # the shipped bundle
+        with open(where(), 'r') as f:
+            assert cadata('pem').count('-----BEGIN CERTIFICATE-----') == f.read().count('-----BEGIN CERTIFICATE-----')
+        assert cadata('der') is cadata('der')
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bundlepath = Path(tmpdir) / 'bundle.pem'
+            with open(bundlepath, 'wb') as f:
+                f.write(b'# comment\n' + ssl.DER_cert_to_PEM_cert(der).encode())
+            os.environ['DOD_CA_CERTS_PEM_PATH'] = bundlepath.as_posix()
+            assert cadata('der') == der
+            assert cadata('pem') == ssl.DER_cert_to_PEM_cert(der)
+            context = ssl.create_default_context(cadata=cadata('der'))
+            assert context.cert_store_stats()['x509_ca'] == 1
+
+            # without revalidation the held blob is returned even when the bundle is gone
+            os.remove(bundlepath)
+            assert cadata('der', revalidate=False) == der
+    finally:
+        if env is not None:
+            os.environ['DOD_CA_CERTS_PEM_PATH'] = env
+        else:
+            os.environ.pop('DOD_CA_CERTS_PEM_PATH', None)
+
+
+def test_where_dir():
+    try:
+        from dodcerts import where_dir
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+    with open(fpath, 'rb') as f:
+        pem = ssl.DER_cert_to_PEM_cert(f.read()).encode()
+
+    dirpath = Path(where_dir())
+    assert dirpath.name == 'dod-ca-certs'
+    assert dirpath.is_dir()
+    # DoD Root CA 5 is filed under its OpenSSL subject hash
+    with open(dirpath / 'e5ad35fa.0', 'rb') as f:
+        assert f.read() == pem
+    context = ssl.create_default_context(capath=dirpath.as_posix())
+    assert context.get_ca_certs() == []  # loaded lazily, by hash, during handshakes
+
+
+def test_create_pem_bundle_capath():
+    try:
+        from dodcerts.capath import subject_hash
+        from dodcerts.create import create_pem_bundle
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+    with open(fpath, 'rb') as f:
+        assert subject_hash(f.read()) == 'e5ad35fa'
+
+    env = os.environ.pop('DOD_CA_CERTS_DIR_PATH', None)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bundlepath = Path(tmpdir) / 'bundle.pem'
+        capath = Path(tmpdir) / 'capath'
+        capath.mkdir()
+        (capath / '00000000.0').touch()  # stale
+        (capath / 'README').touch()  # not a hashed file
+        create_pem_bundle(destination=bundlepath.as_posix(), urls=[fpath.as_uri()], set_env_var=False,
+                          capath=capath.as_posix())
+        assert sorted(os.listdir(capath)) == ['README', 'e5ad35fa.0']
+        mtime = os.stat(capath / 'e5ad35fa.0').st_mtime_ns
+
+        # unchanged certificates are not rewritten
+        create_pem_bundle(destination=bundlepath.as_posix(), urls=[fpath.as_uri()], set_env_var=True,
+                          capath=capath.as_posix())
+        assert os.stat(capath / 'e5ad35fa.0').st_mtime_ns == mtime
+        assert os.environ.pop('DOD_CA_CERTS_DIR_PATH') == capath.as_posix()
+        os.environ.pop('DOD_CA_CERTS_PEM_PATH')
+    if env is not None:
+        os.environ['DOD_CA_CERTS_DIR_PATH'] = env
+
+
+def test_where_import():
+    # importing the package and locating the bundle neither resolves the version (which may run git) nor loads
+    # anything beyond the bundle module
+    code = (
+        "import sys\n"
+        "before = set(sys.modules)\n"
+        "import dodcerts\n"
+        "dodcerts.where()\n"
+        "print(sorted(set(sys.modules) - before))\n"
+    )
+    res = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                         cwd=Path(__file__).parent.parent)
+    assert res.stdout.decode().strip() == "['dodcerts', 'dodcerts.bundle']"
+
+
+def test_create_import():
+    # importing the bundle creation module defers its heavy dependencies and leaves logging unconfigured
+    code = (
+        "import sys\n"
+        "import dodcerts.create\n"
+        "print(dodcerts.create.log.handlers)\n"
+        "print(sorted(m for m in sys.modules if m.split('.')[0] in "
+        "['concurrent', 'cryptography', 'sqlite3', 'subprocess', 'tarfile', 'urllib', 'zipfile']))\n"
+    )
+    res = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                         cwd=Path(__file__).parent.parent)
+    assert res.stdout.decode().splitlines() == ['[]', '[]']
+
+
 def test_describe_cert():
     try:
         from dodcerts.create import describe_cert
@@ -120,6 +287,1083 @@ def test_create_pem_bundle():
 
         res = create_pem_bundle(destination=bundlepath.as_posix(), urls=[fpath.as_uri(),], set_env_var=True)
         assert os.environ.get('DOD_CA_CERTS_PEM_PATH', None) == res
+        os.environ.pop('DOD_CA_CERTS_PEM_PATH')
+
+        # bundling from a resource directory matches bundling in memory
+        resource_dir = Path(tmpdir) / 'resources'
+        dirbundlepath = Path(tmpdir) / 'dir-bundle.pem'
+        create_pem_bundle(destination=dirbundlepath.as_posix(), urls=[fpath.as_uri(),],
+                          resource_dir=resource_dir.as_posix(), set_env_var=False)
+        assert os.listdir(resource_dir) == ['DoDRoot5.cer']
+        create_pem_bundle(destination=dirbundlepath.as_posix(), resource_dir=resource_dir.as_posix(),
+                          set_env_var=False)
+        with open(bundlepath, 'r') as f, open(dirbundlepath, 'r') as g:
+            assert f.readlines()[1:] == g.readlines()[1:]
 
         if env is not None:
             os.environ['DOD_CA_CERTS_PEM_PATH'] = env
+
+
+def test_download_resources_concurrent():
+    try:
+        from dodcerts.create import download_resources
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+
+    with tempfile.TemporaryDirectory() as archive_dir:
+        # serve several resources, including archives, from the local filesystem
+        urls = []
+        for i in range(4):
+            certpath = Path(archive_dir) / 'DoDRoot5_{}.cer'.format(i)
+            shutil.copyfile(fpath, certpath)
+            urls.append(certpath.as_uri())
+        zippath = Path(archive_dir) / 'certs.zip'
+        with zipfile.ZipFile(zippath, 'w') as zip:
+            zip.write(fpath, arcname='DoDRoot5_zip.cer')
+        urls.append(zippath.as_uri())
+
+        listings = []
+        for max_workers in [1, 4]:
+            resource_dir = download_resources(urls, max_workers=max_workers)
+            listings.append(sorted(os.listdir(resource_dir)))
+            shutil.rmtree(resource_dir)
+        assert listings[0] == listings[1]
+        assert listings[0] == ['DoDRoot5_0.cer', 'DoDRoot5_1.cer', 'DoDRoot5_2.cer', 'DoDRoot5_3.cer',
+                               'DoDRoot5_zip.cer']
+
+
+def test_fetch_resource_streaming():
+    try:
+        from dodcerts.create import _fetch_resource
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+    with open(fpath, 'rb') as f:
+        contents = f.read()
+
+    # a buffer smaller than the resource forces several chunks
+    fileobj = BytesIO()
+    resource = _fetch_resource(fpath.as_uri(), fileobj, buffer_size=100)
+    assert resource.size == len(contents)
+    assert resource.sha256 == hashlib.sha256(contents).hexdigest()
+    assert fileobj.getvalue() == contents
+
+
+def test_iter_resources():
+    try:
+        from dodcerts.create import iter_resources
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+    with open(fpath, 'rb') as f:
+        contents = f.read()
+
+    with tempfile.TemporaryDirectory() as archive_dir:
+        zippath = Path(archive_dir) / 'certs.zip'
+        with zipfile.ZipFile(zippath, 'w') as zip:
+            zip.write(fpath, arcname='nested/DoDRoot5_zip.cer')
+            zip.writestr('README.txt', 'not a certificate')
+        tarpath = Path(archive_dir) / 'certs.tar.gz'
+        with tarfile.open(tarpath, 'w:gz') as tar:
+            tar.add(fpath, arcname='DoDRoot5_tar.cer')
+
+        # archives are read in memory (spool_size=0 forces a rollover to a temporary file) and in url order
+        for spool_size in [0, 1024 * 1024]:
+            res = list(iter_resources([tarpath.as_uri(), fpath.as_uri(), zippath.as_uri()], spool_size=spool_size))
+            assert res == [('DoDRoot5_tar.cer', contents), ('DoDRoot5.cer', contents), ('DoDRoot5_zip.cer', contents)]
+
+        # certificates with the same file name, within an archive or across resources, are all kept
+        root, intermediate, _ = _make_chain()
+        samepath = Path(archive_dir) / 'same.zip'
+        with zipfile.ZipFile(samepath, 'w') as zip:
+            zip.writestr('nested/DoDRoot5.cer', root.public_bytes(Encoding.DER))
+            zip.writestr('other/DoDRoot5.cer', intermediate.public_bytes(Encoding.DER))
+        res = list(iter_resources([fpath.as_uri(), samepath.as_uri()]))
+        assert res == [('DoDRoot5.cer', contents), ('DoDRoot5.1.cer', root.public_bytes(Encoding.DER)),
+                       ('DoDRoot5.2.cer', intermediate.public_bytes(Encoding.DER))]
+
+
+class _ETagHandler(BaseHTTPRequestHandler):
+    """serve the test certificate with an ETag, honoring If-None-Match"""
+    etag = '"dodroot5"'
+    bodies_sent = 0
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        with open(Path(__file__).parent / 'input' / 'DoDRoot5.cer', 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        type(self).bodies_sent += 1
+
+    def log_message(self, *args):
+        pass
+
+
+def test_download_resources_cache():
+    try:
+        from dodcerts.create import download_resources
+    except:
+        assert False
+
+    server = HTTPServer(('127.0.0.1', 0), _ETagHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:{}/DoDRoot5.cer'.format(server.server_port)
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for _ in range(3):
+                resource_dir = download_resources(url, cache_dir=cache_dir)
+                assert os.listdir(resource_dir) == ['DoDRoot5.cer']
+                with open(Path(resource_dir) / 'DoDRoot5.cer', 'rb') as f, \
+                        open(Path(__file__).parent / 'input' / 'DoDRoot5.cer', 'rb') as g:
+                    assert f.read() == g.read()
+                shutil.rmtree(resource_dir)
+            # only the first request transferred the payload
+            assert _ETagHandler.bodies_sent == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_classify_files():
+    try:
+        from dodcerts.create import classify_files
+    except:
+        assert False
+    files = ['DoDRoot5.cer', 'DOD_CA-59.cer', 'README.txt', 'ECA_Root_CA_4.crt', 'other.pem', 'JITC_CA.p7b']
+
+    # default ordering, each file lands in the first matching bucket only
+    assert classify_files(files) == [['DOD_CA-59.cer', 'ECA_Root_CA_4.crt'], ['DoDRoot5.cer']]
+
+    # pluggable rules
+    assert classify_files(files, ['root', lambda file: file.startswith('other')]) == \
+        [['DoDRoot5.cer', 'ECA_Root_CA_4.crt'], ['other.pem']]
+
+
+def test_bundle_writer():
+    try:
+        from dodcerts.create import BundleWriter
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+    with open(fpath, 'rb') as f:
+        cert = load_der_x509_certificate(f.read(), backend=default_backend())
+
+    f = BytesIO()
+    writer = BundleWriter(f)
+    writer.write_header()
+    for _ in range(3):
+        writer.write_cert(cert)
+    assert writer.certs_written == 3
+    assert writer.bytes_written == len(f.getvalue())
+    assert f.getvalue().count(b'-----BEGIN CERTIFICATE-----') == 3
+
+
+def test_create_pem_bundle_workers():
+    try:
+        from dodcerts.create import create_pem_bundle
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        resource_dir = Path(tmpdir) / 'resources'
+        resource_dir.mkdir()
+        for i in range(5):
+            shutil.copyfile(fpath, resource_dir / 'DoDRoot5_{}.cer'.format(i))
+        with open(resource_dir / 'Root_bad.cer', 'wb') as f:
+            f.write(b'not a certificate')
+
+        bundles = []
+        for workers in [1, 2]:
+            bundlepath = Path(tmpdir) / 'bundle_{}.pem'.format(workers)
+            create_pem_bundle(destination=bundlepath.as_posix(), resource_dir=resource_dir.as_posix(),
+                              set_env_var=False, workers=workers, dedupe=False)
+            with open(bundlepath, 'r') as f:
+                bundles.append(f.readlines()[1:])
+        assert bundles[0] == bundles[1]
+        assert ''.join(bundles[0]).count('-----BEGIN CERTIFICATE-----') == 5
+
+
+def test_create_pem_bundle_parse_cache():
+    try:
+        from dodcerts import create
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bundlepath = Path(tmpdir) / 'bundle.pem'
+        cache_dir = Path(tmpdir) / 'cache'
+        create.create_pem_bundle(destination=bundlepath.as_posix(), urls=[fpath.as_uri()], set_env_var=False,
+                                 cache_dir=cache_dir.as_posix())
+        with open(bundlepath, 'r') as f:
+            expected = f.readlines()[1:]
+        assert (cache_dir / 'parsed.sqlite').exists()
+
+        # known certificates are not parsed again, neither to be rendered nor to be indexed and ordered
+        with mock.patch.object(create, 'load_cert', side_effect=AssertionError):
+            create.create_pem_bundle(destination=bundlepath.as_posix(), urls=[fpath.as_uri()], set_env_var=False,
+                                     cache_dir=cache_dir.as_posix())
+        with open(bundlepath, 'r') as f:
+            assert f.readlines()[1:] == expected
+
+
+def test_create_pem_bundle_incremental():
+    try:
+        from dodcerts import create
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        resource_dir = Path(tmpdir) / 'resources'
+        resource_dir.mkdir()
+        for i in range(3):
+            shutil.copyfile(fpath, resource_dir / 'DoDRoot5_{}.cer'.format(i))
+        bundlepath = Path(tmpdir) / 'bundle.pem'
+        create.create_pem_bundle(destination=bundlepath.as_posix(), resource_dir=resource_dir.as_posix(),
+                                 set_env_var=False, dedupe=False)
+        with open(bundlepath, 'r') as f:
+            expected = f.readlines()[2:]
+        with open(create.manifest_path(bundlepath.as_posix()), 'r') as f:
+            manifest = json.load(f)
+        assert [e['path'] for e in manifest['entries']] == ['DoDRoot5_0.cer', 'DoDRoot5_1.cer', 'DoDRoot5_2.cer']
+        with open(bundlepath, 'rb') as f:
+            contents = f.read()
+        for entry in manifest['entries']:
+            record = contents[entry['offset']:entry['offset'] + entry['length']]
+            assert record.startswith(b'\n# Subject: DoD Root CA 5\n')
+
+        # an unchanged resource directory is rebuilt without parsing or reading any input
+        with mock.patch.object(create, 'load_cert', side_effect=AssertionError), \
+                mock.patch('builtins.open', wraps=open) as mock_open:
+            create.create_pem_bundle(destination=bundlepath.as_posix(), resource_dir=resource_dir.as_posix(),
+                                     set_env_var=False, dedupe=False)
+            opened = [Path(call.args[0]).name for call in mock_open.call_args_list]
+            assert not any([name.startswith('DoDRoot5_') for name in opened])
+        with open(bundlepath, 'r') as f:
+            assert f.readlines()[2:] == expected
+
+        # changed inputs are picked up
+        os.remove(resource_dir / 'DoDRoot5_1.cer')
+        with open(resource_dir / 'DoDRoot5_2.cer', 'wb') as f:
+            f.write(b'not a certificate')
+        create.create_pem_bundle(destination=bundlepath.as_posix(), resource_dir=resource_dir.as_posix(),
+                                 set_env_var=False, dedupe=False)
+        with open(bundlepath, 'r') as f:
+            assert f.readlines()[2:] == expected[:len(expected) // 3]
+
+        # a file of another resource directory with the same name, size and mtime is read
+        from cryptography.hazmat.primitives.asymmetric import ec
+        by_size = {}
+        while True:
+            root = _make_cert('Test Root', ec.generate_private_key(ec.SECP256R1()))
+            if len(root.public_bytes(Encoding.DER)) in by_size:
+                break
+            by_size[len(root.public_bytes(Encoding.DER))] = root
+        for name, cert in [('a', by_size[len(root.public_bytes(Encoding.DER))]), ('b', root)]:
+            other_dir = Path(tmpdir) / name
+            other_dir.mkdir()
+            with open(other_dir / 'root.cer', 'wb') as f:
+                f.write(cert.public_bytes(Encoding.DER))
+            os.utime(other_dir / 'root.cer', ns=(0, 1577836800 * 10 ** 9))
+            create.create_pem_bundle(destination=bundlepath.as_posix(), resource_dir=other_dir.as_posix(),
+                                     set_env_var=False)
+        with open(bundlepath, 'rb') as f:
+            assert root.public_bytes(Encoding.PEM) in f.read()
+
+
+def test_create_pem_bundle_dedupe():
+    try:
+        from dodcerts.create import create_pem_bundle, manifest_path
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+    with open(fpath, 'rb') as f:
+        cert = load_der_x509_certificate(f.read(), backend=default_backend())
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # the same certificate in DER and PEM encodings
+        resource_dir = Path(tmpdir) / 'resources'
+        resource_dir.mkdir()
+        shutil.copyfile(fpath, resource_dir / 'DoDRoot5.cer')
+        with open(resource_dir / 'DoDRoot5_pem.crt', 'wb') as f:
+            f.write(cert.public_bytes(Encoding.PEM))
+
+        bundlepath = Path(tmpdir) / 'bundle.pem'
+        create_pem_bundle(destination=bundlepath.as_posix(), resource_dir=resource_dir.as_posix(), set_env_var=False)
+        with open(bundlepath, 'r') as f:
+            assert f.read().count('-----BEGIN CERTIFICATE-----') == 1
+        with open(manifest_path(bundlepath.as_posix()), 'r') as f:
+            entries = json.load(f)['entries']
+        assert entries[1]['path'] == 'DoDRoot5_pem.crt'
+        assert entries[1]['duplicate_of'] == 'DoDRoot5.cer'
+
+
+def test_bundle_index():
+    try:
+        from dodcerts import where
+        from dodcerts.create import create_pem_bundle
+        from dodcerts.index import BundleIndex, index_path, write_index
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+    with open(fpath, 'rb') as f:
+        contents = f.read()
+    fingerprint = hashlib.sha256(contents).hexdigest()
+
+    # the shipped bundle is indexed
+    env = os.environ.pop('DOD_CA_CERTS_PEM_PATH', None)
+    try:
+        with BundleIndex() as index, open(where(), 'rb') as f:
+            assert Path(index_path(where())).exists()
+            # certificates cryptography refuses (e.g. DoD Root CA 4) are not indexed
+            pems = re.findall(rb'-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----', f.read(), re.DOTALL)
+            loadable = 0
+            for pem in pems:
+                try:
+                    load_pem_x509_certificate(pem)
+                    loadable += 1
+                except ValueError:
+                    pass
+            assert 0 < len(index) == loadable < len(pems)
+            assert fingerprint in index
+    finally:
+        if env is not None:
+            os.environ['DOD_CA_CERTS_PEM_PATH'] = env
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bundlepath = Path(tmpdir) / 'bundle.pem'
+        create_pem_bundle(destination=bundlepath.as_posix(), urls=[fpath.as_uri()], set_env_var=False)
+        with open(bundlepath, 'rb') as f:
+            f.readline()  # skip timestamp line
+            f.readline()  # skip digest line
+            record = f.read()
+        with BundleIndex(bundlepath) as index:
+            assert len(index) == 1
+            assert index.get(fingerprint) == record
+            assert index.get(bytes(32)) is None
+            assert index.find_subject_hash('e5ad35fa') == [record]
+            assert index.find_subject_hash('00000000') == []
+            ski = load_der_x509_certificate(contents).extensions.get_extension_for_class(SubjectKeyIdentifier)
+            assert index.find_ski(ski.value.digest) == [record]
+            assert list(index.expiring()) == [(datetime(2041, 6, 14, 17, 17, 27, tzinfo=timezone.utc), record)]
+            assert list(index.expiring(before=datetime(2030, 1, 1, tzinfo=timezone.utc))) == []
+
+        # an index is stale once its bundle's records change, even if the bundle's size does not
+        root, intermediate, _ = _make_chain()
+        pems = [root.public_bytes(Encoding.PEM), intermediate.public_bytes(Encoding.PEM)]
+        with open(bundlepath, 'wb') as f:
+            f.write(pems[0] + pems[1])
+        write_index(bundlepath)
+        with BundleIndex(bundlepath) as index:
+            assert index.get(hashlib.sha256(root.public_bytes(Encoding.DER)).digest()) == pems[0]
+        with open(bundlepath, 'wb') as f:
+            f.write(pems[1] + pems[0])
+        try:
+            BundleIndex(bundlepath)
+            assert False
+        except ValueError as e:
+            assert str(e).startswith('Index does not match the bundle')
+
+
+def _make_cert(common_name, key, issuer_name=None, issuer_key=None, ca=True, path_length=None, extensions=()):
+    """issue a test certificate, self-signed unless an issuer is given, with additional (extension, critical)"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.x509.oid import NameOID
+
+    name = x509.Name([
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, 'U.S. Government'),
+        x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, 'Test'),
+        x509.NameAttribute(NameOID.COMMON_NAME, common_name),
+    ])
+    issuer_name = issuer_name or name
+    issuer_key = issuer_key or key
+    builder = x509.CertificateBuilder().subject_name(name).issuer_name(issuer_name).public_key(
+        key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(
+        datetime(2020, 1, 1)).not_valid_after(datetime(2040, 1, 1)).add_extension(
+        x509.BasicConstraints(ca=ca, path_length=path_length), critical=True).add_extension(
+        x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False).add_extension(
+        x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()), critical=False)
+    for extension, critical in extensions:
+        builder = builder.add_extension(extension, critical=critical)
+    return builder.sign(issuer_key, hashes.SHA256())
+
+
+def _make_chain(prefix='Test'):
+    """issue a root, an intermediate and a leaf test certificate"""
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    keys = [ec.generate_private_key(ec.SECP256R1()) for _ in range(3)]
+    root = _make_cert(prefix + ' Root', keys[0])
+    intermediate = _make_cert(prefix + ' Intermediate', keys[1], root.subject, keys[0])
+    leaf = _make_cert('test.example', keys[2], intermediate.subject, keys[1], ca=False)
+    return root, intermediate, leaf
+
+
+def test_create_pem_bundle_chain_order():
+    try:
+        from dodcerts.create import create_pem_bundle
+    except:
+        assert False
+    root, intermediate, leaf = _make_chain()
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # file names neither mention 'ca' nor 'root' nor sort by chain
+        resource_dir = Path(tmpdir) / 'resources'
+        resource_dir.mkdir()
+        for name, cert in [('a.cer', root), ('b.cer', leaf), ('c.crt', intermediate)]:
+            with open(resource_dir / name, 'wb') as f:
+                f.write(cert.public_bytes(Encoding.DER if name.endswith('.cer') else Encoding.PEM))
+        shutil.copyfile(fpath, resource_dir / 'DoDRoot5.cer')
+
+        bundlepath = Path(tmpdir) / 'bundle.pem'
+        create_pem_bundle(destination=bundlepath.as_posix(), resource_dir=resource_dir.as_posix(), set_env_var=False)
+        with open(bundlepath, 'r') as f:
+            subjects = [line[len('# Subject: '):-1] for line in f if line.startswith('# Subject: ')]
+        assert subjects == ['DoD Root CA 5', 'test.example', 'Test Intermediate', 'Test Root']
+
+        # file name rules are still available
+        create_pem_bundle(destination=bundlepath.as_posix(), resource_dir=resource_dir.as_posix(), set_env_var=False,
+                          order=['root'])
+        with open(bundlepath, 'r') as f:
+            subjects = [line[len('# Subject: '):-1] for line in f if line.startswith('# Subject: ')]
+        assert subjects == ['DoD Root CA 5']
+
+
+def test_chain_order():
+    try:
+        from dodcerts.create import chain_order
+    except:
+        assert False
+    # (ski, aki, subject, issuer): two roots, one cross-signing the other, and an issuer cycle
+    nodes = [
+        (b'r1', b'r1', 'root1', 'root1'),
+        (b'i1', b'r1', 'int1', 'root1'),
+        (b'l1', b'i1', 'leaf1', 'int1'),
+        (b'r2', b'r2', 'root2', 'root2'),
+        (b'l2', None, 'leaf2', 'int1'),
+        (b'x1', b'x2', 'cyc1', 'cyc2'),
+        (b'x2', b'x1', 'cyc2', 'cyc1'),
+    ]
+    assert chain_order(nodes) == [2, 4, 1, 0, 3, 6, 5]
+
+
+def test_staged_records():
+    try:
+        from dodcerts.create import _Fingerprints, _staged_records
+    except:
+        assert False
+    # (entry, record, index row, chain node), in the order the inputs were streamed
+    parsed = [
+        ({'path': 'leaf.cer'}, b'leaf', (b'l',), (b'l', b'i', 'leaf', 'int')),
+        ({'path': 'root.cer'}, b'root', (b'r',), (b'r', b'r', 'root', 'root')),
+        ({'path': 'int.cer'}, b'int', (b'i',), (b'i', b'r', 'int', 'root')),
+        ({'path': 'copy.cer'}, b'copy', (b'r',), (b'r', b'r', 'root', 'root')),
+    ]
+    rules = [lambda file: True]
+
+    # duplicates are dropped in file order, before the records are ordered along the issuer graph
+    fingerprints = _Fingerprints()
+    records = list(_staged_records(iter(parsed), rules, fingerprints.keep))
+    assert [record for _, record, _ in records] == [b'leaf', b'int', b'copy']
+    assert parsed[1][0]['duplicate_of'] == 'copy.cer'
+
+    # by file name only, keeping duplicates
+    records = list(_staged_records(iter(parsed), rules, _Fingerprints(dedupe=False).keep, chain=False))
+    assert [record for _, record, _ in records] == [b'copy', b'int', b'leaf', b'root']
+
+
+def test_verify_certificates():
+    try:
+        from dodcerts.create import create_pem_bundle
+        from dodcerts.verify import Verifier, verify_certificates
+    except:
+        assert False
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    root, intermediate, leaf = _make_chain()
+    other_root, _, other_leaf = _make_chain('Other')
+    # issued in the intermediate's name, but signed with another key
+    forged = _make_cert('forged.example', ec.generate_private_key(ec.SECP256R1()), intermediate.subject,
+                        ec.generate_private_key(ec.SECP256R1()), ca=False)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        resource_dir = Path(tmpdir) / 'resources'
+        resource_dir.mkdir()
+        for name, cert in [('root.cer', root), ('intermediate.cer', intermediate)]:
+            with open(resource_dir / name, 'wb') as f:
+                f.write(cert.public_bytes(Encoding.DER))
+        bundlepath = Path(tmpdir) / 'bundle.pem'
+        create_pem_bundle(destination=bundlepath.as_posix(), resource_dir=resource_dir.as_posix(), set_env_var=False)
+
+        leaf_dir = Path(tmpdir) / 'leaves'
+        leaf_dir.mkdir()
+        for name, cert in [('a_leaf.pem', leaf), ('b_other.pem', other_leaf), ('c_forged.pem', forged)]:
+            with open(leaf_dir / name, 'wb') as f:
+                f.write(cert.public_bytes(Encoding.PEM))
+        with open(leaf_dir / 'd_bad.cer', 'wb') as f:
+            f.write(b'not a certificate')
+
+        for workers in [1, 4]:
+            results = list(verify_certificates(leaf_dir, bundle=bundlepath, workers=workers))
+            assert [Path(r.source).name for r in results] == ['a_leaf.pem', 'b_other.pem', 'c_forged.pem',
+                                                              'd_bad.cer']
+            assert [r.valid for r in results] == [True, False, False, False]
+            assert results[0].chain == [c.subject.rfc4514_string() for c in [leaf, intermediate, root]]
+            assert results[1].error == 'unable to get local issuer certificate'
+            assert results[2].error == 'certificate signature failure'
+            assert results[3].error == 'unable to load certificate'
+
+        # expired at the time of validation
+        results = list(verify_certificates(leaf_dir / 'a_leaf.pem', bundle=bundlepath,
+                                           at=datetime(2041, 1, 1, tzinfo=timezone.utc)))
+        assert results[0].error.startswith('certificate has expired')
+
+        # the intermediate's signature is checked once for all of the leaves it issued
+        verifier = Verifier(bundle=bundlepath)
+        for _ in range(3):
+            assert verifier.verify(leaf.public_bytes(Encoding.DER)).valid
+        assert len(verifier._signatures) == 2
+
+
+def test_verify_constraints():
+    try:
+        from dodcerts.create import create_pem_bundle
+        from dodcerts.verify import Verifier
+    except:
+        assert False
+    from cryptography import x509
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import ObjectIdentifier
+
+    def key_usage(key_cert_sign):
+        return x509.KeyUsage(digital_signature=True, content_commitment=False, key_encipherment=False,
+                             data_encipherment=False, key_agreement=False, key_cert_sign=key_cert_sign,
+                             crl_sign=True, encipher_only=False, decipher_only=False), True
+
+    keys = [ec.generate_private_key(ec.SECP256R1()) for _ in range(5)]
+    # the root may only issue CAs that issue end certificates
+    root = _make_cert('Test Root', keys[0], path_length=1, extensions=[key_usage(True)])
+    intermediate = _make_cert('Test Intermediate', keys[1], root.subject, keys[0], extensions=[key_usage(True)])
+    sub = _make_cert('Test Sub', keys[2], intermediate.subject, keys[1])
+    # bundled, but neither may sign certificates
+    end = _make_cert('end.example', keys[3], intermediate.subject, keys[1], ca=False)
+    signer = _make_cert('Test Signer', keys[4], intermediate.subject, keys[1], extensions=[key_usage(False)])
+
+    def leaf(issuer, key, extensions=()):
+        return _make_cert('leaf.example', ec.generate_private_key(ec.SECP256R1()), issuer.subject, key, ca=False,
+                          extensions=extensions).public_bytes(Encoding.DER)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        resource_dir = Path(tmpdir) / 'resources'
+        resource_dir.mkdir()
+        for i, cert in enumerate([root, intermediate, sub, end, signer]):
+            with open(resource_dir / '{}.cer'.format(i), 'wb') as f:
+                f.write(cert.public_bytes(Encoding.DER))
+        bundlepath = Path(tmpdir) / 'bundle.pem'
+        create_pem_bundle(destination=bundlepath.as_posix(), resource_dir=resource_dir.as_posix(), set_env_var=False)
+        verifier = Verifier(bundle=bundlepath)
+
+        assert verifier.verify(leaf(intermediate, keys[1])).valid
+        # issued by an end certificate
+        result = verifier.verify(leaf(end, keys[3]))
+        assert result.error == 'invalid CA certificate: ' + end.subject.rfc4514_string()
+        # one intermediate too many below the root
+        result = verifier.verify(leaf(sub, keys[2]))
+        assert result.error == 'path length constraint exceeded: ' + root.subject.rfc4514_string()
+        # a CA whose key usage excludes certificate signing
+        result = verifier.verify(leaf(signer, keys[4]))
+        assert result.error == 'key usage does not include certificate signing: ' + signer.subject.rfc4514_string()
+        # a critical extension the verifier does not enforce
+        unknown = x509.UnrecognizedExtension(ObjectIdentifier('1.3.6.1.4.1.99999.1'), b'\x05\x00')
+        assert verifier.verify(leaf(intermediate, keys[1], [(unknown, False)])).valid
+        result = verifier.verify(leaf(intermediate, keys[1], [(unknown, True)]))
+        assert result.error == 'unhandled critical extension: CN=leaf.example,OU=Test,O=U.S. Government'
+
+
+def _make_crl(issuer, key, serials=(), last_update=datetime(2020, 1, 1), next_update=datetime(2040, 1, 1)):
+    """issue a test CRL revoking `serials`"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes
+
+    builder = x509.CertificateRevocationListBuilder().issuer_name(issuer.subject).last_update(
+        last_update).next_update(next_update)
+    for serial in serials:
+        builder = builder.add_revoked_certificate(x509.RevokedCertificateBuilder().serial_number(
+            serial).revocation_date(datetime(2021, 1, 1)).build())
+    return builder.sign(key, hashes.SHA256())
+
+
+def test_crl_index():
+    try:
+        from dodcerts.capath import subject_hash
+        from dodcerts.create import create_pem_bundle
+        from dodcerts.crl import RevocationIndex
+        from dodcerts.verify import verify_certificates
+    except:
+        assert False
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    keys = [ec.generate_private_key(ec.SECP256R1()) for _ in range(4)]
+    root = _make_cert('Test Root', keys[0])
+    intermediate = _make_cert('Test Intermediate', keys[1], root.subject, keys[0])
+    revoked = _make_cert('revoked.example', keys[2], intermediate.subject, keys[1], ca=False)
+    good = _make_cert('good.example', keys[3], intermediate.subject, keys[1], ca=False)
+    serials = [revoked.serial_number] + list(range(1, 3000, 7))
+    crl = _make_crl(intermediate, keys[1], serials)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        resource_dir = Path(tmpdir) / 'resources'
+        resource_dir.mkdir()
+        for name, cert in [('root.cer', root), ('intermediate.cer', intermediate)]:
+            with open(resource_dir / name, 'wb') as f:
+                f.write(cert.public_bytes(Encoding.DER))
+        # the CRL is streamed from a zip member, PEM encoded
+        with zipfile.ZipFile(Path(tmpdir) / 'crls.zip', 'w') as z:
+            z.writestr('crls/intermediate.crl', crl.public_bytes(Encoding.PEM))
+        crl_dir = Path(tmpdir) / 'crls'
+        bundlepath = Path(tmpdir) / 'bundle.pem'
+
+        def create():
+            create_pem_bundle(destination=bundlepath.as_posix(), resource_dir=resource_dir.as_posix(),
+                              set_env_var=False, crl_dir=crl_dir.as_posix())
+
+        create_pem_bundle(destination=bundlepath.as_posix(), urls=[(Path(tmpdir) / 'crls.zip').as_uri()],
+                          resource_dir=resource_dir.as_posix(), set_env_var=False, crl_dir=crl_dir.as_posix())
+        assert (resource_dir / 'intermediate.crl').exists()
+
+        issuer = subject_hash(intermediate.public_bytes(Encoding.DER))
+        assert sorted(os.listdir(crl_dir)) == [issuer + '.bloom', issuer + '.rsl']
+        with RevocationIndex(crl_dir.as_posix()) as index:
+            assert index.has_issuer(issuer)
+            assert index.updates(issuer) == (datetime(2020, 1, 1, tzinfo=timezone.utc),
+                                             datetime(2040, 1, 1, tzinfo=timezone.utc))
+            assert all([index.is_revoked(issuer, serial) for serial in serials])
+            assert not any([index.is_revoked(issuer, serial) for serial in range(2, 3000, 7)])
+            assert not index.is_revoked(issuer, good.serial_number)
+            assert not index.has_issuer(subject_hash(root.public_bytes(Encoding.DER)))
+
+        # a DER encoded CRL read from the resource directory replaces the issuer's list
+        with open(resource_dir / 'intermediate.crl', 'wb') as f:
+            f.write(_make_crl(intermediate, keys[1], [good.serial_number]).public_bytes(Encoding.DER))
+        create()
+        with RevocationIndex(crl_dir.as_posix()) as index:
+            assert index.is_revoked(issuer, good.serial_number)
+            assert not index.is_revoked(issuer, revoked.serial_number)
+
+        # CRLs that are forged, older than the indexed CRL, or expired are rejected and the issuer's list is kept
+        for forged in [_make_crl(intermediate, keys[3], last_update=datetime(2021, 1, 1)),
+                       _make_crl(intermediate, keys[1], last_update=datetime(2019, 1, 1)),
+                       _make_crl(intermediate, keys[1], last_update=datetime(2021, 1, 1),
+                                 next_update=datetime(2022, 1, 1))]:
+            with open(resource_dir / 'intermediate.crl', 'wb') as f:
+                f.write(forged.public_bytes(Encoding.DER))
+            with mock.patch('dodcerts.create.log') as log:
+                create()
+            assert 'Rejected CRL intermediate.crl' in log.warning.call_args[0][0]
+            with RevocationIndex(crl_dir.as_posix()) as index:
+                assert index.is_revoked(issuer, good.serial_number)
+                assert not index.is_revoked(issuer, revoked.serial_number)
+        os.remove(resource_dir / 'intermediate.crl')
+
+        leaf_dir = Path(tmpdir) / 'leaves'
+        leaf_dir.mkdir()
+        for name, cert in [('good.pem', good), ('revoked.pem', revoked)]:
+            with open(leaf_dir / name, 'wb') as f:
+                f.write(cert.public_bytes(Encoding.PEM))
+        # the revocation status of the intermediate is unknown without a CRL of the root
+        results = list(verify_certificates(leaf_dir, bundle=bundlepath, crl_dir=crl_dir.as_posix()))
+        assert [r.valid for r in results] == [False, False]
+        assert results[0].error.startswith('certificate revoked')
+        assert results[1].error == 'unable to get certificate CRL: CN=Test Intermediate,OU=Test,O=U.S. Government'
+
+        with open(resource_dir / 'root.crl', 'wb') as f:
+            f.write(_make_crl(root, keys[0], next_update=datetime(2039, 1, 1)).public_bytes(Encoding.DER))
+        create()
+        results = list(verify_certificates(leaf_dir, bundle=bundlepath, crl_dir=crl_dir.as_posix()))
+        assert [r.valid for r in results] == [False, True]
+        assert results[0].error.startswith('certificate revoked')
+        results = list(verify_certificates(leaf_dir, bundle=bundlepath, crl_dir=crl_dir.as_posix(),
+                                           at=datetime(2039, 6, 1, tzinfo=timezone.utc)))
+        assert results[1].error == 'CRL has expired: CN=Test Intermediate,OU=Test,O=U.S. Government'
+
+
+def test_ingest_crl():
+    try:
+        from dodcerts.crl import RevocationIndex, ingest_crl, load_issuers
+    except:
+        assert False
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    root = _make_cert('Test RSA Root', key)
+    crl = _make_crl(root, key, [5, 7])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bundlepath = Path(tmpdir) / 'bundle.pem'
+        with open(bundlepath, 'wb') as f:
+            f.write(root.public_bytes(Encoding.PEM))
+        issuers = load_issuers(bundlepath.as_posix())
+        crl_dir = (Path(tmpdir) / 'crls').as_posix()
+
+        with pytest.raises(ValueError, match='not a trusted certificate'):
+            ingest_crl(BytesIO(crl.public_bytes(Encoding.PEM)), crl_dir, {})
+        with pytest.raises(ValueError, match='not yet valid'):
+            ingest_crl(BytesIO(crl.public_bytes(Encoding.PEM)), crl_dir, issuers,
+                       at=datetime(2019, 1, 1, tzinfo=timezone.utc))
+        issuer, count = ingest_crl(BytesIO(crl.public_bytes(Encoding.PEM)), crl_dir, issuers, bloom=False)
+        assert count == 2
+        assert os.listdir(crl_dir) == [issuer + '.rsl']
+
+        # a CRL whose revoked serials were tampered with does not verify, and the issuer's list is kept
+        der = _make_crl(root, key, [5, 7, 9], last_update=datetime(2021, 1, 1)).public_bytes(Encoding.DER)
+        tampered = der.replace(b'\x02\x01\x09', b'\x02\x01\x0b', 1)
+        with pytest.raises(ValueError, match='does not verify'):
+            ingest_crl(BytesIO(tampered), crl_dir, issuers)
+        with RevocationIndex(crl_dir) as index:
+            assert [index.is_revoked(issuer, serial) for serial in [5, 7, 9]] == [True, True, False]
+
+
+def test_iter_certificates():
+    try:
+        from dodcerts.create import iter_certificates
+    except:
+        assert False
+    root, intermediate, leaf = _make_chain()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        resource_dir = Path(tmpdir) / 'resources'
+        resource_dir.mkdir()
+        for name, contents in [('a_root.cer', root.public_bytes(Encoding.DER)),
+                               ('b_root.pem', root.public_bytes(Encoding.PEM)),
+                               ('c_leaf.pem', leaf.public_bytes(Encoding.PEM)),
+                               ('d_bad.cer', b'not a certificate'),
+                               ('e_notes.txt', b'ignored')]:
+            with open(resource_dir / name, 'wb') as f:
+                f.write(contents)
+
+        for workers in [1, 2]:
+            certs = iter_certificates(resource_dir=resource_dir.as_posix(), workers=workers)
+            first = next(certs)
+            assert first.source == (resource_dir / 'a_root.cer').as_posix()
+            assert first.fingerprint == hashlib.sha256(root.public_bytes(Encoding.DER)).hexdigest()
+            assert first.subject == first.issuer == root.subject.rfc4514_string()
+            assert first.not_after == root.not_valid_after_utc
+            assert first.pem == root.public_bytes(Encoding.PEM)
+            assert [cert.subject for cert in certs] == [leaf.subject.rfc4514_string()]
+
+        assert len(list(iter_certificates(resource_dir=resource_dir.as_posix(), dedupe=False))) == 3
+
+        with tarfile.open(Path(tmpdir) / 'certs.tar.gz', 'w:gz') as tar:
+            tar.add((resource_dir / 'c_leaf.pem').as_posix(), arcname='certs/c_leaf.pem')
+        certs = list(iter_certificates(urls=[(resource_dir / 'a_root.cer').as_uri(),
+                                             (Path(tmpdir) / 'certs.tar.gz').as_uri()]))
+        assert [(cert.source, cert.issuer) for cert in certs] == [('a_root.cer', root.subject.rfc4514_string()),
+                                                                   ('c_leaf.pem', intermediate.subject.rfc4514_string())]
+
+
+def test_create_pem_bundle_metrics():
+    try:
+        from dodcerts.create import create_pem_bundle
+        from dodcerts.metrics import Metrics, write_textfile
+    except:
+        assert False
+    fpath = Path(__file__).parent / 'input' / 'DoDRoot5.cer'
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        zpath = Path(tmpdir) / 'certs.zip'
+        with zipfile.ZipFile(zpath, 'w') as z:
+            z.write(fpath.as_posix(), arcname='certs/DoDRoot5.cer')
+            z.writestr('certs/bad.cer', b'not a certificate')
+        urls = [fpath.as_uri(), zpath.as_uri()]
+        bundlepath = (Path(tmpdir) / 'bundle.pem').as_posix()
+
+        events = []
+        create_pem_bundle(destination=bundlepath, urls=urls, set_env_var=False, observer=events.append)
+        # certificates are parsed as the resources stream
+        assert [(e.stage, e.source) for e in events] == [
+            ('fetch', urls[0]), ('parse', 'DoDRoot5.cer'), ('extract', urls[0]), ('fetch', urls[1]),
+            ('parse', 'DoDRoot5.1.cer'), ('parse', 'bad.cer'), ('extract', urls[1]), ('write', bundlepath)]
+        assert events[0].values['bytes'] == fpath.stat().st_size
+        assert events[6].values['certificates'] == 2
+        assert [e.values['failed'] for e in events if e.stage == 'parse'] == [False, False, True]
+        assert (events[7].values['certificates'], events[7].values['duplicates']) == (1, 1)
+        assert events[7].values['bytes'] == os.path.getsize(bundlepath)
+        assert all([e.values['seconds'] >= 0 for e in events])
+
+        # unchanged inputs reuse their records from the previous bundle
+        metrics = Metrics()
+        create_pem_bundle(destination=bundlepath, urls=urls, set_env_var=False, observer=metrics)
+        assert (metrics.parsed, metrics.reused, metrics.failures) == (1, 2, ['bad.cer'])
+
+        textfile = write_textfile((Path(tmpdir) / 'dodcerts.prom').as_posix(), metrics)
+        with open(textfile) as f:
+            lines = f.read().splitlines()
+        assert '# TYPE dodcerts_fetch_bytes gauge' in lines
+        assert 'dodcerts_fetch_bytes{{url="{}"}} {!r}'.format(urls[0], float(fpath.stat().st_size)) in lines
+        assert 'dodcerts_parse_files{reused="true"} 2.0' in lines
+        assert 'dodcerts_parse_failures 1.0' in lines
+        assert 'dodcerts_write_certificates{{bundle="{}"}} 1.0'.format(bundlepath) in lines
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='file modes are POSIX')
+def test_atomic_write_permissions():
+    try:
+        from dodcerts.atomic import atomic_write
+    except:
+        assert False
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fpath = Path(tmpdir) / 'file'
+        mask = os.umask(0o027)
+        try:
+            # a new file is created as `open` would
+            with atomic_write(fpath.as_posix()) as f:
+                f.write(b'new')
+            assert os.stat(fpath).st_mode & 0o777 == 0o640
+            # the permissions of a replaced file are kept
+            os.chmod(fpath, 0o600)
+            with atomic_write(fpath.as_posix()) as f:
+                f.write(b'replaced')
+            assert os.stat(fpath).st_mode & 0o777 == 0o600
+        finally:
+            os.umask(mask)
+
+
+def test_create_pem_bundle_atomic():
+    try:
+        from dodcerts.create import BundleWriter, create_pem_bundle
+    except:
+        assert False
+    root, intermediate, leaf = _make_chain()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        resource_dir = Path(tmpdir) / 'resources'
+        resource_dir.mkdir()
+        for name, cert in [('root.cer', root), ('intermediate.cer', intermediate)]:
+            with open(resource_dir / name, 'wb') as f:
+                f.write(cert.public_bytes(Encoding.DER))
+        out_dir = Path(tmpdir) / 'out'
+        out_dir.mkdir()
+        bundlepath = (out_dir / 'bundle.pem').as_posix()
+        create_pem_bundle(destination=bundlepath, resource_dir=resource_dir.as_posix(), set_env_var=False)
+        with open(bundlepath, 'rb') as f:
+            contents = f.read()
+
+        # a rebuild failing halfway leaves the previous bundle intact and no staged files behind
+        with open(resource_dir / 'leaf.cer', 'wb') as f:
+            f.write(leaf.public_bytes(Encoding.DER))
+        with mock.patch.object(BundleWriter, 'write_record', side_effect=[None, OSError('disk full')]):
+            try:
+                create_pem_bundle(destination=bundlepath, resource_dir=resource_dir.as_posix(), set_env_var=False)
+                assert False
+            except OSError:
+                pass
+        with open(bundlepath, 'rb') as f:
+            assert f.read() == contents
+        assert sorted(os.listdir(out_dir)) == ['bundle.pem', 'bundle.pem.idx', 'bundle.pem.manifest.json']
+
+        if os.name == 'posix':
+            # published behind a symbolic link to the versioned bundle, keeping the two most recent versions
+            published = []
+            for name in ['leaf2.cer', 'leaf3.cer', 'leaf4.cer']:
+                shutil.copy((resource_dir / 'leaf.cer').as_posix(), (resource_dir / name).as_posix())
+                create_pem_bundle(destination=bundlepath, resource_dir=resource_dir.as_posix(), set_env_var=False,
+                                  dedupe=False, versions=2)
+                assert os.path.islink(bundlepath)
+                with open(bundlepath, 'rb') as f:
+                    f.readline()  # skip timestamp line
+                    f.readline()  # skip digest line
+                    digest = hashlib.sha256(f.read()).hexdigest()
+                published.append(os.readlink(bundlepath))
+                assert published[-1] == 'bundle.pem.' + digest[:16]
+            assert sorted([file for file in os.listdir(out_dir) if file.startswith('bundle.pem.')
+                           and len(file) == len(published[-1])]) == sorted(published[1:])
+            assert os.stat(bundlepath).st_mode & 0o777 == 0o644
+
+
+def test_create_pem_bundle_reproducible():
+    try:
+        from dodcerts.create import bundle_digest, create_pem_bundle, read_header
+    except:
+        assert False
+    root, intermediate, leaf = _make_chain()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        resource_dir = Path(tmpdir) / 'resources'
+        resource_dir.mkdir()
+        for name, cert in [('root.cer', root), ('intermediate.cer', intermediate), ('leaf.cer', leaf)]:
+            with open(resource_dir / name, 'wb') as f:
+                f.write(cert.public_bytes(Encoding.DER))
+
+        # bundles of the same certificates are byte-identical, wherever and whenever they are built
+        bundles = []
+        for name in ['a.pem', 'b.pem']:
+            bundlepath = (Path(tmpdir) / name).as_posix()
+            create_pem_bundle(destination=bundlepath, resource_dir=resource_dir.as_posix(), set_env_var=False,
+                              reproducible=True)
+            with open(bundlepath, 'rb') as f:
+                bundles.append(f.read())
+        assert bundles[0] == bundles[1]
+        header = read_header(bundlepath)
+        assert header.startswith(b'# Bundle Created: 1970-01-01 00:00:00+00:00 \n# Bundle Digest: sha256:')
+        assert bundle_digest(bundlepath) == hashlib.sha256(bundles[1][len(header):]).hexdigest()
+
+        # the digest only depends on the records
+        timestamped = (Path(tmpdir) / 'c.pem').as_posix()
+        create_pem_bundle(destination=timestamped, resource_dir=resource_dir.as_posix(), set_env_var=False)
+        assert read_header(timestamped).startswith(b'# Bundle Created: ')
+        assert bundle_digest(timestamped) == bundle_digest(bundlepath)
+        with mock.patch.dict(os.environ, {'SOURCE_DATE_EPOCH': '1577836800'}):
+            create_pem_bundle(destination=timestamped, resource_dir=resource_dir.as_posix(), set_env_var=False,
+                              reproducible=True)
+        assert read_header(timestamped).startswith(b'# Bundle Created: 2020-01-01 00:00:00+00:00 \n')
+
+        # an unchanged bundle is left in place
+        st = os.stat(bundlepath)
+        create_pem_bundle(destination=bundlepath, resource_dir=resource_dir.as_posix(), set_env_var=False,
+                          reproducible=True)
+        assert (os.stat(bundlepath).st_ino, os.stat(bundlepath).st_mtime_ns) == (st.st_ino, st.st_mtime_ns)
+        os.remove(resource_dir / 'leaf.cer')
+        create_pem_bundle(destination=bundlepath, resource_dir=resource_dir.as_posix(), set_env_var=False,
+                          reproducible=True)
+        assert bundle_digest(bundlepath) != bundle_digest(timestamped)
+
+
+class _ZipHandler(BaseHTTPRequestHandler):
+    """serve a zip archive with an ETag, honoring HEAD and range requests"""
+    body = b''
+    etag = '"v1"'
+    ranges = True
+    bodies_sent = 0
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        if self.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        body = self.body
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range') or '')
+        if match and self.ranges:
+            body = body[int(match.group(1)):int(match.group(2)) + 1]
+            self.send_response(206)
+        else:
+            type(self).bodies_sent += 1
+            self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _zip_bytes(members, compression=zipfile.ZIP_STORED):
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression) as z:
+        for name, contents in members:
+            z.writestr(name, contents)
+    return buffer.getvalue()
+
+
+def test_update_bundle():
+    try:
+        from dodcerts.create import manifest_path
+        from dodcerts.update import check_resources, update_bundle
+    except:
+        assert False
+    root, intermediate, leaf = _make_chain()
+    members = [('certs/root.cer', root.public_bytes(Encoding.DER)),
+               ('certs/intermediate.cer', intermediate.public_bytes(Encoding.DER))]
+
+    server = HTTPServer(('127.0.0.1', 0), _ZipHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/certs.zip'.format(server.server_port)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_dir = (Path(tmpdir) / 'cache').as_posix()
+            bundlepath = (Path(tmpdir) / 'bundle.pem').as_posix()
+            _ZipHandler.body = _zip_bytes(members)
+
+            def cache_contents():
+                return {name: (Path(cache_dir) / name).read_bytes() for name in os.listdir(cache_dir)}
+
+            assert check_resources([url], cache_dir, bundlepath)[0] == (url, True, 'not bundled')
+            assert update_bundle(bundlepath, [url], cache_dir, check=True)[0]
+            assert not os.path.exists(bundlepath) and not cache_contents()
+            assert update_bundle(bundlepath, [url], cache_dir)[0]
+            assert os.path.exists(bundlepath)
+
+            # nothing is downloaded to find that nothing changed
+            _ZipHandler.bodies_sent = 0
+            updated, checks = update_bundle(bundlepath, [url], cache_dir)
+            assert not updated and checks[0].reason == 'etag unchanged'
+
+            # a re-packed archive of the same certificates is read from its central directory only, and a check
+            # writes nothing
+            _ZipHandler.body, _ZipHandler.etag = _zip_bytes(members, zipfile.ZIP_DEFLATED), '"v2"'
+            cached, manifest = cache_contents(), Path(manifest_path(bundlepath)).read_bytes()
+            updated, checks = update_bundle(bundlepath, [url], cache_dir, check=True)
+            assert not updated and checks[0] == (url, False, 'archive members unchanged')
+            assert cache_contents() == cached and Path(manifest_path(bundlepath)).read_bytes() == manifest
+            updated, checks = update_bundle(bundlepath, [url], cache_dir)
+            assert not updated and checks[0] == (url, False, 'archive members unchanged')
+            assert _ZipHandler.bodies_sent == 0
+
+            # the validators of the unchanged archive are recorded in the manifest
+            assert check_resources([url], cache_dir, bundlepath)[0] == (url, False, 'etag unchanged')
+
+            # without range requests, the certificates are compared with those of the bundled copy
+            _ZipHandler.ranges = False
+            _ZipHandler.body, _ZipHandler.etag = _zip_bytes(members[::-1]), '"v2.1"'
+            assert check_resources([url], cache_dir, bundlepath)[0] == (url, False, 'certificates unchanged')
+            assert _ZipHandler.bodies_sent == 1
+            assert cache_contents() == cached
+            update_bundle(bundlepath, [url], cache_dir)
+            assert check_resources([url], cache_dir, bundlepath)[0] == (url, False, 'etag unchanged')
+            assert _ZipHandler.bodies_sent == 2
+
+            # certificates are compared by fingerprint, whatever their encoding
+            pem_members = [(name, load_der_x509_certificate(contents).public_bytes(Encoding.PEM))
+                           for name, contents in members]
+            _ZipHandler.body, _ZipHandler.etag = _zip_bytes(pem_members), '"v2.2"'
+            assert check_resources([url], cache_dir, bundlepath)[0] == (url, False, 'certificates unchanged')
+            _ZipHandler.ranges = True
+
+            _ZipHandler.body, _ZipHandler.etag = _zip_bytes(members + [('certs/leaf.cer',
+                                                                        leaf.public_bytes(Encoding.DER))]), '"v3"'
+            assert check_resources([url], cache_dir, bundlepath)[0] == (url, True, 'archive members changed')
+
+            # a cache refreshed by another build is no evidence that the bundle is current
+            otherpath = (Path(tmpdir) / 'other.pem').as_posix()
+            assert update_bundle(otherpath, [url], cache_dir)[0]
+            assert check_resources([url], cache_dir, bundlepath)[0] == \
+                (url, True, 'content changed (bundled copy not cached)')
+            updated, checks = update_bundle(bundlepath, [url], cache_dir)
+            assert updated
+            with open(bundlepath, 'rb') as f:
+                assert f.read().count(b'-----BEGIN CERTIFICATE-----') == 3
+
+            # a resource dropped from the bundle requires it to be rebuilt
+            assert not update_bundle(bundlepath, [url], cache_dir, check=True)[0]
+            assert update_bundle(bundlepath, [], cache_dir, check=True)[0]
+    finally:
+        server.shutdown()
+        server.server_close()
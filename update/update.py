@@ -1,23 +1,31 @@
 #!/usr/bin/env python
-import hashlib
 import pathlib
 import shutil
 
-from dodcerts.create import create_pem_bundle
+from dodcerts.create import bundle_digest, create_pem_bundle
+from dodcerts.update import check_resources
 
 # certificate resources to bundle
 urls = ['https://militarycac.org/maccerts/AllCerts.zip',]
 this_dir = pathlib.Path(__file__).parent
+# persistent download cache; unchanged resources are revalidated rather than re-downloaded
+cache_dir = this_dir / 'cache'
+# hashed certificate directory shipped with the package; updated in place, files only change with the certificates
+capath = this_dir / '..' / 'dodcerts' / 'dod-ca-certs'
 
-# create new bundle and hash
-bundle_path = create_pem_bundle(destination=(this_dir / 'my_bundle.pem').as_posix(), urls=urls)
-new_bundle_hash = hashlib.sha256()
-with open(bundle_path, 'r') as file:
-    # skip timestamp line
-    file.readline()
-    for line in file.readlines():
-        new_bundle_hash.update(line.encode())
-new_signature = new_bundle_hash.hexdigest()
+# bundle built on the previous run, kept with its manifest for the resources to be checked against
+bundle_path = (this_dir / 'my_bundle.pem').as_posix()
+
+# skip the rebuild unless the certificates of a resource changed since the previous bundle was built from it
+checks = check_resources(urls, cache_dir.as_posix(), bundle_path)
+for check in checks:
+    print('{}: {}'.format(check.url, check.reason))
+if not any([check.changed for check in checks]):
+    exit(1)
+
+# create new bundle; its header holds the digest of its certificates, nothing is re-read to hash it
+create_pem_bundle(destination=bundle_path, urls=urls, cache_dir=cache_dir.as_posix(), capath=capath.as_posix())
+new_signature = bundle_digest(bundle_path)
 print(new_signature)
 
 # get old hash
@@ -31,7 +39,8 @@ if new_signature != old_signature:
     # overwrite existing bundle and hash
     with open(hash_path, 'w') as file:
         file.write(new_signature)
-        shutil.move(bundle_path, (this_dir / '..' / 'dodcerts' / 'dod-ca-certs.pem').as_posix())
+        shutil.copyfile(bundle_path, (this_dir / '..' / 'dodcerts' / 'dod-ca-certs.pem').as_posix())
+        shutil.copyfile(bundle_path + '.idx', (this_dir / '..' / 'dodcerts' / 'dod-ca-certs.pem.idx').as_posix())
     print('update')
     exit(0)
 else:
@@ -11,7 +11,8 @@ if python ./update/update.py ; then
 
     # commit new bundle
     git checkout -b new_bundle
-    git add ./dodcerts/dod-ca-certs.pem
+    git add ./dodcerts/dod-ca-certs.pem ./dodcerts/dod-ca-certs.pem.idx
+    git add --all ./dodcerts/dod-ca-certs
     git commit --message "Travis build: $TRAVIS_BUILD_NUMBER"
 
     # upload